@@ -0,0 +1,183 @@
+import argparse
+import io
+import os
+import time
+import numpy as np
+
+# IVF (inverted file) ANN over the unit-length rows of a NumpyVectorStore.
+# Rows are clustered with spherical k-means; a query only scores the rows of the
+# `nprobe` clusters whose centroids are closest to it.
+# Indices with fewer rows than ANN_MIN_ROWS keep using exact search.
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "20000"))
+# 0 picks about 4 * sqrt(rows) clusters
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))
+# More probes means better recall and slower queries
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+ANN_ITERATIONS = int(os.getenv("ANN_ITERATIONS", "10"))
+# Rows scored at once while assigning clusters, bounds memory on big indices
+ASSIGN_BATCH_ROWS = 8192
+
+
+def default_nlist(num_rows):
+    return int(min(max(4 * np.sqrt(num_rows), 1), max(num_rows, 1)))
+
+
+def _assign(matrix, centroids):
+    # Returns each row's nearest centroid and the per-centroid sums of the rows
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    sums = np.zeros_like(centroids)
+    for start in range(0, len(matrix), ASSIGN_BATCH_ROWS):
+        batch = np.asarray(matrix[start : start + ASSIGN_BATCH_ROWS])
+        batch_assignments = (batch @ centroids.T).argmax(axis=1)
+        assignments[start : start + len(batch)] = batch_assignments
+        one_hot = np.zeros((len(batch), len(centroids)), dtype=np.float32)
+        one_hot[np.arange(len(batch)), batch_assignments] = 1.0
+        sums += one_hot.T @ batch
+    return assignments, sums
+
+
+class IVFIndex:
+    def __init__(self, centroids, list_offsets, list_rows, nprobe=ANN_NPROBE):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        # CSR layout: cluster c owns list_rows[list_offsets[c] : list_offsets[c + 1]]
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_rows = np.asarray(list_rows, dtype=np.int64)
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @property
+    def num_rows(self):
+        return len(self.list_rows)
+
+    @classmethod
+    def build(cls, matrix, nlist=None, iterations=ANN_ITERATIONS, seed=0):
+        nlist = min(nlist or ANN_NLIST or default_nlist(len(matrix)), len(matrix))
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(len(matrix), nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignments, sums = _assign(matrix, centroids)
+            counts = np.bincount(assignments, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # Restart empty clusters from random rows
+                sums[empty] = matrix[rng.choice(len(matrix), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms > 0, norms, 1.0)
+
+        assignments, _ = _assign(matrix, centroids)
+        list_rows = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=nlist)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(centroids, list_offsets, list_rows)
+
+    def candidate_rows(self, query_embedding, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        centroid_scores = self.centroids @ query_embedding
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.concatenate(
+            [
+                self.list_rows[self.list_offsets[c] : self.list_offsets[c + 1]]
+                for c in probes
+            ]
+        )
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_rows=self.list_rows,
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data, nprobe=ANN_NPROBE):
+        with np.load(io.BytesIO(data)) as arrays:
+            return cls(
+                arrays["centroids"],
+                arrays["list_offsets"],
+                arrays["list_rows"],
+                nprobe=nprobe,
+            )
+
+
+def _exact_top_k(matrix, query_embedding, k):
+    scores = matrix @ query_embedding
+    top_rows = np.argpartition(-scores, k - 1)[:k]
+    return set(top_rows.tolist())
+
+
+def recall_report(matrix, ivf_index, k=10, nprobes=None, num_queries=100, seed=0):
+    # Uses stored rows as queries and compares ANN top-k against exact top-k
+    matrix = np.asarray(matrix, dtype=np.float32)
+    k = min(k, len(matrix))
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(matrix), min(num_queries, len(matrix)), replace=False)
+    nprobes = nprobes or sorted({1, 2, 4, ivf_index.nprobe, 16, 32})
+
+    exact_results = []
+    exact_start = time.perf_counter()
+    for row in query_rows:
+        exact_results.append(_exact_top_k(matrix, matrix[row], k))
+    exact_ms = (time.perf_counter() - exact_start) * 1000 / len(query_rows)
+
+    report = []
+    for nprobe in nprobes:
+        if nprobe > ivf_index.nlist:
+            continue
+        hits = 0
+        ann_start = time.perf_counter()
+        for row, exact in zip(query_rows, exact_results):
+            rows = ivf_index.candidate_rows(matrix[row], nprobe)
+            scores = matrix[rows] @ matrix[row]
+            top = rows[np.argsort(-scores)[:k]]
+            hits += len(exact.intersection(top.tolist()))
+        ann_ms = (time.perf_counter() - ann_start) * 1000 / len(query_rows)
+        report.append(
+            {
+                "nprobe": nprobe,
+                f"recall_at_{k}": round(hits / (k * len(query_rows)), 4),
+                "ann_ms": round(ann_ms, 3),
+                "exact_ms": round(exact_ms, 3),
+            }
+        )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build an IVF index for a local .npy index and report recall@k"
+    )
+    parser.add_argument("input_prefix", help="prefix of the .npy/.meta.json pair")
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--save", action="store_true", help="write {prefix}.ivf.npz")
+    args = parser.parse_args()
+
+    matrix = np.load(f"{args.input_prefix}.npy", mmap_mode="r")
+    ivf_path = f"{args.input_prefix}.ivf.npz"
+    if os.path.exists(ivf_path) and not args.save:
+        with open(ivf_path, "rb") as f:
+            ivf_index = IVFIndex.from_bytes(f.read())
+    else:
+        build_start = time.perf_counter()
+        ivf_index = IVFIndex.build(matrix, nlist=args.nlist or None)
+        print(
+            f"Built {ivf_index.nlist} lists in {time.perf_counter() - build_start:.2f}s"
+        )
+        if args.save:
+            with open(ivf_path, "wb") as f:
+                f.write(ivf_index.to_bytes())
+
+    for line in recall_report(matrix, ivf_index, k=args.k, num_queries=args.queries):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
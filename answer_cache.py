@@ -0,0 +1,115 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# Answers are reused for the same question, or one whose query embedding is at
+# least ANSWER_CACHE_SIMILARITY similar, asked against the same generation of
+# the same index. A new generation (indexing, deleting) starts an empty scope.
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.97"))
+
+
+def normalize_question(text):
+    text = re.sub(r"\s+", " ", text.strip().lower())
+    return text.rstrip("?!. ")
+
+
+class AnswerCache:
+    """LRU of chatbot answers per (index blob, generation) with a TTL."""
+
+    def __init__(
+        self,
+        ttl=ANSWER_CACHE_TTL,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES,
+        similarity=ANSWER_CACHE_SIMILARITY,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (blob name, generation, normalized question) -> entry
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get_exact(self, blob, question):
+        key = (blob.name, blob.generation, normalize_question(question))
+        with self._lock:
+            self._check_generation(blob)
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry["answer"]
+
+    def get_similar(self, blob, query_embedding):
+        # Called after get_exact missed, so a miss here is counted as one
+        query_embedding = _unit(query_embedding)
+        with self._lock:
+            self._check_generation(blob)
+            best_key, best_score = None, self.similarity
+            for key, entry in self._entries.items():
+                if key[:2] != (blob.name, blob.generation) or self._expired(entry):
+                    continue
+                score = float(entry["embedding"] @ query_embedding)
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.semantic_hits += 1
+            return self._entries[best_key]["answer"]
+
+    def put(self, blob, question, query_embedding, answer):
+        key = (blob.name, blob.generation, normalize_question(question))
+        with self._lock:
+            self._check_generation(blob)
+            self._entries[key] = {
+                "answer": answer,
+                "embedding": _unit(query_embedding),
+                "created": time.monotonic(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _expired(self, entry):
+        return time.monotonic() - entry["created"] > self.ttl
+
+    def _check_generation(self, blob):
+        # Drops the answers of older generations as soon as a new one is seen
+        if self._generations.get(blob.name) == blob.generation:
+            return
+        self._generations[blob.name] = blob.generation
+        for key in [k for k in self._entries if k[0] == blob.name]:
+            if key[1] != blob.generation:
+                del self._entries[key]
+
+
+def _unit(embedding):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm > 0 else embedding
@@ -0,0 +1,95 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from tracing import span
+
+# OpenAI accepts at most 2048 inputs per embeddings request
+MAX_BATCH_SIZE = 2048
+EMBED_BATCH_SIZE = min(int(os.getenv("EMBED_BATCH_SIZE", "512")), MAX_BATCH_SIZE)
+# Keeps a single request well under the tokens-per-minute limit
+EMBED_BATCH_MAX_TOKENS = int(os.getenv("EMBED_BATCH_MAX_TOKENS", "100000"))
+# Embedding requests in flight at the same time
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
+
+def make_batches(token_counts, batch_size, max_tokens):
+    # Groups consecutive positions, closing a batch at batch_size inputs or once
+    # it would go over max_tokens. An input bigger than max_tokens gets its own.
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for position, tokens in enumerate(token_counts):
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(position)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_texts(
+    embed_model,
+    texts,
+    batch_size=EMBED_BATCH_SIZE,
+    max_tokens=EMBED_BATCH_MAX_TOKENS,
+    concurrency=EMBED_CONCURRENCY,
+):
+    """Embed texts in large batches with a few requests running at once.
+
+    Returns the embeddings in the order of `texts` and records the tokens on
+    the embed model, the same way get_queued_text_embeddings does.
+    """
+    if not texts:
+        return []
+    if getattr(embed_model, "cache", None) is not None:
+        return _embed_texts_cached(
+            embed_model, texts, batch_size, max_tokens, concurrency
+        )
+
+    token_counts = [len(embed_model._tokenizer(text)) for text in texts]
+    batches = make_batches(token_counts, min(batch_size, MAX_BATCH_SIZE), max_tokens)
+
+    def embed_batch(batch):
+        return embed_model._get_text_embeddings([texts[p] for p in batch])
+
+    with span(
+        "embed", chunks=len(texts), tokens=sum(token_counts), requests=len(batches)
+    ):
+        if concurrency > 1 and len(batches) > 1:
+            workers = min(concurrency, len(batches))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                batch_embeddings = list(pool.map(embed_batch, batches))
+        else:
+            batch_embeddings = [embed_batch(batch) for batch in batches]
+
+    embeddings = [None] * len(texts)
+    for batch, results in zip(batches, batch_embeddings):
+        for position, embedding in zip(batch, results):
+            embeddings[position] = embedding
+
+    embed_model._total_tokens_used += sum(token_counts)
+    return embeddings
+
+
+def _embed_texts_cached(embed_model, texts, batch_size, max_tokens, concurrency):
+    # Only texts missing from the cache are batched and sent, identical chunks once
+    with span("embedding_cache", chunks=len(texts)) as cache_span:
+        embeddings = embed_model.cache.get_many(embed_model.model_key, texts)
+        missing = [p for p, embedding in enumerate(embeddings) if embedding is None]
+        new_texts = list(dict.fromkeys(texts[p] for p in missing))
+        cache_span.set(cached=len(texts) - len(missing))
+
+        inner_model = embed_model.embed_model
+        tokens_before = inner_model.total_tokens_used
+        new_embeddings = embed_texts(
+            inner_model, new_texts, batch_size, max_tokens, concurrency
+        )
+        embed_model._total_tokens_used += inner_model.total_tokens_used - tokens_before
+        embed_model.cache.put_many(embed_model.model_key, new_texts, new_embeddings)
+
+    by_text = dict(zip(new_texts, new_embeddings))
+    for position in missing:
+        embeddings[position] = by_text[texts[position]]
+    return embeddings
@@ -0,0 +1,365 @@
+import itertools
+import sys
+import threading
+import time
+import types
+import uuid
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+# In-process stand-ins for the parts of firebase_admin the functions use:
+# Firestore documents, queries, batches and transactions, and Cloud Storage
+# blobs with generations and generation-match preconditions. Every call waits
+# for a configurable latency, blob transfers also for their size / bandwidth.
+
+
+class Latency:
+    def __init__(self, seconds=0.0, bandwidth=None):
+        self.seconds = seconds
+        # Bytes per second, None for unlimited
+        self.bandwidth = bandwidth
+
+    def wait(self, num_bytes=0):
+        delay = self.seconds
+        if self.bandwidth:
+            delay += num_bytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.size = None
+        self.content_type = None
+
+    def _load(self, stored):
+        _, self.generation, self.content_type = stored
+        self.size = len(stored[0])
+
+    def _stored(self, if_generation_match=None):
+        # Checks the precondition the way GCS does, generation 0: doesn't exist
+        stored = self.bucket._blobs.get(self.name)
+        if if_generation_match is not None:
+            current = stored[1] if stored else 0
+            if current != if_generation_match:
+                raise PreconditionFailed(
+                    f"{self.name}: generation {current} != {if_generation_match}"
+                )
+        if stored is None:
+            raise NotFound(f"{self.name} not found")
+        return stored
+
+    def exists(self):
+        self.bucket.latency.wait()
+        return self.name in self.bucket._blobs
+
+    def reload(self):
+        self.bucket.latency.wait()
+        self._load(self._stored())
+
+    def upload_from_string(
+        self, data, content_type=None, if_generation_match=None, **kwargs
+    ):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.bucket.latency.wait(len(data))
+        with self.bucket._lock:
+            if if_generation_match is not None:
+                stored = self.bucket._blobs.get(self.name)
+                current = stored[1] if stored else 0
+                if current != if_generation_match:
+                    raise PreconditionFailed(
+                        f"{self.name}: generation {current} != {if_generation_match}"
+                    )
+            stored = (bytes(data), next(self.bucket._generations), content_type)
+            self.bucket._blobs[self.name] = stored
+        self._load(stored)
+
+    def upload_from_file(self, file_obj, rewind=False, content_type=None, **kwargs):
+        if rewind:
+            file_obj.seek(0)
+        self.upload_from_string(file_obj.read(), content_type=content_type, **kwargs)
+
+    def download_as_bytes(self, if_generation_match=None, **kwargs):
+        with self.bucket._lock:
+            stored = self._stored(if_generation_match)
+        self.bucket.latency.wait(len(stored[0]))
+        return stored[0]
+
+    def download_as_text(self, if_generation_match=None, **kwargs):
+        return self.download_as_bytes(if_generation_match).decode("utf-8")
+
+    def download_to_file(self, file_obj, if_generation_match=None, **kwargs):
+        data = self.download_as_bytes(if_generation_match)
+        # Handed over in pieces, like a streamed response
+        for start in range(0, len(data), 1024 * 1024):
+            file_obj.write(data[start : start + 1024 * 1024])
+
+    def download_to_filename(self, filename, if_generation_match=None, **kwargs):
+        with open(filename, "wb") as f:
+            self.download_to_file(f, if_generation_match)
+
+    def delete(self, if_generation_match=None, **kwargs):
+        self.bucket.latency.wait()
+        with self.bucket._lock:
+            self._stored(if_generation_match)
+            del self.bucket._blobs[self.name]
+
+
+class FakeBucket:
+    def __init__(self, name="bench-bucket", latency=None):
+        self.name = name
+        self.latency = latency or Latency()
+        # blob name -> (data, generation, content type)
+        self._blobs = {}
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        self.latency.wait()
+        with self._lock:
+            stored = self._blobs.get(name)
+        if stored is None:
+            return None
+        blob = FakeBlob(self, name)
+        blob._load(stored)
+        return blob
+
+    def list_blobs(self, prefix=""):
+        self.latency.wait()
+        with self._lock:
+            names = sorted(n for n in self._blobs if n.startswith(prefix))
+        return [self.get_blob(name) for name in names]
+
+    def total_bytes(self, prefix=""):
+        with self._lock:
+            return sum(
+                len(stored[0])
+                for name, stored in self._blobs.items()
+                if name.startswith(prefix)
+            )
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data[field]
+
+
+class FakeDocumentReference:
+    def __init__(self, collection, document_id):
+        self._collection = collection
+        self.id = document_id
+
+    def get(self, transaction=None, **kwargs):
+        self._collection._db.latency.wait()
+        with self._collection._db._lock:
+            data = self._collection._documents.get(self.id)
+            return FakeSnapshot(self, dict(data) if data is not None else None)
+
+    def set(self, data, merge=False):
+        self._collection._db.latency.wait()
+        self._set(data, merge)
+
+    def update(self, data):
+        self._collection._db.latency.wait()
+        self._update(data)
+
+    def delete(self):
+        self._collection._db.latency.wait()
+        self._delete()
+
+    def _set(self, data, merge=False):
+        with self._collection._db._lock:
+            documents = self._collection._documents
+            if merge and self.id in documents:
+                documents[self.id].update(data)
+            else:
+                documents[self.id] = dict(data)
+
+    def _delete(self):
+        with self._collection._db._lock:
+            self._collection._documents.pop(self.id, None)
+
+    def _update(self, data):
+        with self._collection._db._lock:
+            documents = self._collection._documents
+            if self.id not in documents:
+                raise NotFound(f"No document to update: {self.id}")
+            documents[self.id].update(data)
+
+
+class FakeQuery:
+    OPERATORS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a is not None and a < b,
+        "<=": lambda a, b: a is not None and a <= b,
+        ">": lambda a, b: a is not None and a > b,
+        ">=": lambda a, b: a is not None and a >= b,
+        "in": lambda a, b: a in b,
+    }
+
+    def __init__(self, collection, filters=(), max_results=None):
+        self._collection = collection
+        self._filters = list(filters)
+        self._limit = max_results
+
+    def where(self, field, op, value):
+        return FakeQuery(
+            self._collection, self._filters + [(field, op, value)], self._limit
+        )
+
+    def limit(self, count):
+        return FakeQuery(self._collection, self._filters, count)
+
+    def stream(self, transaction=None):
+        self._collection._db.latency.wait()
+        with self._collection._db._lock:
+            matches = [
+                (document_id, dict(data))
+                for document_id, data in sorted(self._collection._documents.items())
+                if all(
+                    self.OPERATORS[op](data.get(field), value)
+                    for field, op, value in self._filters
+                )
+            ]
+        if self._limit is not None:
+            matches = matches[: self._limit]
+        return iter(
+            FakeSnapshot(FakeDocumentReference(self._collection, document_id), data)
+            for document_id, data in matches
+        )
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(self)
+        self._db = db
+        self.id = name
+        self._documents = {}
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+
+class FakeWriteBatch:
+    MAX_WRITES = 500
+
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: reference._set(data, merge))
+
+    def update(self, reference, data):
+        self._writes.append(lambda: reference._update(data))
+
+    def delete(self, reference):
+        self._writes.append(reference._delete)
+
+    def commit(self):
+        if len(self._writes) > self.MAX_WRITES:
+            raise ValueError(f"A batch can hold at most {self.MAX_WRITES} writes")
+        self._db.latency.wait()
+        for write in self._writes:
+            write()
+        self._writes = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    pass
+
+
+def transactional(fn):
+    # The fake applies a transaction's writes at the end, without retries
+    def run(transaction, *args, **kwargs):
+        result = fn(transaction, *args, **kwargs)
+        transaction.commit()
+        return result
+
+    return run
+
+
+class FakeFirestore:
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self._collections = {}
+        self._lock = threading.RLock()
+
+    def collection(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = FakeCollection(self, name)
+            return self._collections[name]
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def get_all(self, references):
+        self.latency.wait()
+        for reference in references:
+            with self._lock:
+                data = reference._collection._documents.get(reference.id)
+            yield FakeSnapshot(reference, dict(data) if data is not None else None)
+
+
+def install(firestore_latency=None, storage_latency=None, bucket_name=None):
+    # Registers a fake firebase_admin package, must run before firebase_utils
+    # is used. Returns the Firestore client and the bucket it hands out.
+    db = FakeFirestore(firestore_latency)
+    bucket = FakeBucket(bucket_name or "bench-bucket", storage_latency)
+
+    firebase_admin = types.ModuleType("firebase_admin")
+    apps = []
+
+    def get_app(name="[DEFAULT]"):
+        if not apps:
+            raise ValueError("The default Firebase app does not exist")
+        return apps[0]
+
+    def initialize_app(credential=None, options=None, name="[DEFAULT]"):
+        apps.append(options)
+        return options
+
+    firebase_admin.get_app = get_app
+    firebase_admin.initialize_app = initialize_app
+
+    firestore = types.ModuleType("firebase_admin.firestore")
+    firestore.client = lambda app=None: db
+    firestore.transactional = transactional
+
+    storage = types.ModuleType("firebase_admin.storage")
+    storage.bucket = lambda name=None, app=None: bucket
+
+    firebase_admin.firestore = firestore
+    firebase_admin.storage = storage
+    sys.modules["firebase_admin"] = firebase_admin
+    sys.modules["firebase_admin.firestore"] = firestore
+    sys.modules["firebase_admin.storage"] = storage
+    return db, bucket
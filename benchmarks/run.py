@@ -0,0 +1,513 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# End-to-end benchmark of index_documents, chatbot and delete_doc_from_index.
+# Firestore and Cloud Storage are replaced by the fakes in fakes.py, the
+# document hosts by a local HTTP server and OpenAI by fake_llm.py, each with a
+# configurable latency. Every index size runs in its own process, so the peak
+# RSS of one size doesn't carry over into the next.
+#
+#   python benchmarks/run.py run --sizes 100,1000,10000
+#   python benchmarks/run.py compare benchmarks/results/a.json benchmarks/results/b.json
+#
+# `run` saves its report to benchmarks/results/{commit}.json.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+INDEX_NAME = "bench"
+ACCESS_KEY = "bench-access-key"
+# Changes above this fraction are flagged by `compare`
+REGRESSION_THRESHOLD = 0.1
+# Single-token English words, so chunk sizes in tokens are predictable
+WORDS = (
+    "the of and to in is you that it he was for on are as with his they at be "
+    "this have from or one had by word but not what all were we when your can "
+    "said there use an each which she do how their if will up other about out "
+    "many then them these so some her would make like him into time has look "
+    "two more write go see number no way could people my than first water been "
+    "call who oil its now find long down day did get come made may part over"
+).split()
+
+
+def percentile(values, p):
+    # Nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class RssSampler:
+    """Peak resident set size of this process while the block runs."""
+
+    INTERVAL = 0.02
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+    def _sample(self):
+        while not self._stop.wait(self.INTERVAL):
+            self.peak = max(self.peak, self.current())
+
+    @staticmethod
+    def current():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # No /proc: the peak of the whole process so far (KB on Linux)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stage:
+    # Runs one entry point repeatedly. The tracing spans that end meanwhile
+    # (download, embed, index load, retrieve, LLM call...) are timed under it.
+    active = None
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.latencies = []
+        self.units = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.spans = {}
+
+    def __enter__(self):
+        self._rss = RssSampler().__enter__()
+        self._start = time.perf_counter()
+        Stage.active = self
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self._start
+        Stage.active = None
+        self._rss.__exit__(*exc_info)
+
+    @classmethod
+    def record_span(cls, finished):
+        # The entry point's own span is timed by time_call already
+        stage = cls.active
+        if stage is not None and finished.parent_id is not None:
+            stage.spans.setdefault(finished.name, []).append(finished.duration_ms)
+
+    def time_call(self, fn, units=1):
+        start = time.perf_counter()
+        ok = fn()
+        self.latencies.append(time.perf_counter() - start)
+        self.units += units
+        if not ok:
+            self.errors += 1
+
+    def summary(self):
+        latencies_ms = [latency * 1000 for latency in self.latencies]
+        return {
+            "count": len(latencies_ms),
+            "errors": self.errors,
+            "p50_ms": round(percentile(latencies_ms, 50), 1),
+            "p95_ms": round(percentile(latencies_ms, 95), 1),
+            "p99_ms": round(percentile(latencies_ms, 99), 1),
+            "max_ms": round(max(latencies_ms), 1),
+            "throughput": round(self.units / self.seconds, 2),
+            "throughput_unit": f"{self.unit}/s",
+            "peak_rss_mb": round(self._rss.peak / 2**20, 1),
+            # Most time first, nested spans are included in their parents
+            "spans": {
+                name: {
+                    "count": len(durations),
+                    "p50_ms": round(percentile(durations, 50), 1),
+                    "p95_ms": round(percentile(durations, 95), 1),
+                    "total_ms": round(sum(durations), 1),
+                }
+                for name, durations in sorted(
+                    self.spans.items(), key=lambda item: -sum(item[1])
+                )
+            },
+        }
+
+
+class DocumentServer:
+    """Serves generated text files over HTTP, like the document hosts."""
+
+    def __init__(self, latency):
+        files = self.files = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(latency)
+                body = files.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def add(self, path, body):
+        self.files[path] = body
+        return self.base_url + path
+
+    def close(self):
+        self._server.shutdown()
+
+
+def make_text(rng, num_words):
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def call_entry_point(app, entry_point, **params):
+    from flask import request
+
+    with app.test_request_context(query_string=params):
+        response = entry_point(request)
+    if isinstance(response, tuple):
+        return response[1], None
+    return response.status_code, response.get_json(silent=True)
+
+
+def run_worker(config):
+    # Environment first, the modules read it when they are imported
+    os.environ.update(
+        {
+            "FAKE_LLM": "1",
+            "FAKE_LLM_LATENCY": str(config["llm_latency"]),
+            "FAKE_LLM_TOKEN_DELAY": str(config["token_delay"]),
+            "FAKE_EMBEDDING_LATENCY": str(config["embedding_latency"]),
+            "INDEX_CHUNK_SIZE": str(config["chunk_tokens"]),
+            "OPENAI_API_KEY": "fake",
+            "ACCESS_KEY": ACCESS_KEY,
+            "FIREBASE_STORAGE_BUCKET_URL": "bench-bucket",
+        }
+    )
+    sys.path.insert(0, REPO_DIR)
+    from fakes import Latency, install
+
+    db, bucket = install(
+        firestore_latency=Latency(config["firestore_latency"]),
+        storage_latency=Latency(
+            config["storage_latency"], config["storage_bandwidth_mb"] * 2**20
+        ),
+    )
+    from flask import Flask
+    import chatbot_fn
+    import embedding_cache
+    import index_store
+    import main
+    import tracing
+
+    tracing.add_listener(Stage.record_span)
+    work_dir = tempfile.mkdtemp(prefix="bench_")
+    index_store.LOCAL_INDEX_DIR = os.path.join(work_dir, "gptIndices")
+    embedding_cache.LOCAL_CACHE_DIR = os.path.join(work_dir, "embeddingCache")
+    app = Flask("benchmark")
+    rng = random.Random(config["seed"])
+    server = DocumentServer(config["download_latency"])
+    docs_ref = db.collection("documents")
+    stages = {}
+
+    # Words per document for chunks_per_doc chunks, the splitter overlaps 20 tokens
+    words_per_doc = (config["chunk_tokens"] - 20) * config["chunks_per_doc"]
+    num_docs = math.ceil(config["size"] / config["chunks_per_doc"])
+    docs_per_call = max(1, config["index_batch_chunks"] // config["chunks_per_doc"])
+    document_ids = [f"doc{i:07d}" for i in range(num_docs)]
+
+    def index_call():
+        status, body = call_entry_point(
+            app, main.index_documents, input_text=ACCESS_KEY, index_name=INDEX_NAME
+        )
+        return status == 200
+
+    with Stage("index_documents", "docs") as stage:
+        for start in range(0, num_docs, docs_per_call):
+            # Seeding the backlog isn't part of the measurement
+            seed_start = time.perf_counter()
+            for document_id in document_ids[start : start + docs_per_call]:
+                url = server.add(
+                    f"/files/{document_id}.txt",
+                    make_text(rng, words_per_doc).encode("utf-8"),
+                )
+                docs_ref.document(document_id)._set({"url": url, "indexed": False})
+            stage._start += time.perf_counter() - seed_start
+            stage.time_call(
+                index_call, units=len(document_ids[start : start + docs_per_call])
+            )
+    unindexed = len(list(docs_ref.where("indexed", "==", False).stream()))
+    stage.errors += unindexed
+    stages[stage.name] = stage.summary()
+
+    index = index_store.load_index(
+        bucket,
+        INDEX_NAME,
+        chatbot_fn.CustomGPTSimpleVectorIndex,
+        service_context=chatbot_fn.load_service_context(temperature=0.2),
+    )
+    chunks = index.vector_store.num_nodes
+    stages["index_documents"]["chunks"] = chunks
+    stages["index_documents"]["chunks_per_s"] = round(chunks / sum(stage.latencies), 1)
+    del index
+
+    def chatbot_call():
+        question = f"what does {' '.join(rng.sample(WORDS, 4))} mean {rng.random()}"
+        status, body = call_entry_point(
+            app, main.chatbot, input_text=question, index_name=INDEX_NAME
+        )
+        return status == 200 and not body["response"].startswith("Error")
+
+    def cold_chatbot_call():
+        # Drop the loaded index, the next question loads it from the bucket
+        chatbot_fn.index_cache = chatbot_fn.IndexCache()
+        return chatbot_call()
+
+    with Stage("chatbot_cold", "questions") as stage:
+        for _ in range(config["cold_queries"]):
+            stage.time_call(cold_chatbot_call)
+    stages[stage.name] = stage.summary()
+
+    with Stage("chatbot", "questions") as stage:
+        for _ in range(config["queries"]):
+            stage.time_call(chatbot_call)
+    stages[stage.name] = stage.summary()
+
+    def delete_call(document_id):
+        status, body = call_entry_point(
+            app,
+            main.delete_doc_from_index,
+            document_id=document_id,
+            input_text=ACCESS_KEY,
+        )
+        return status == 200 and body["response"] == "Delete document successfully"
+
+    to_delete = rng.sample(document_ids, min(config["deletes"], num_docs))
+    with Stage("delete_doc_from_index", "docs") as stage:
+        for document_id in to_delete:
+            stage.time_call(lambda: delete_call(document_id))
+    stages[stage.name] = stage.summary()
+
+    # Loading now also applies the tombstones of the deleted documents
+    with Stage("chatbot_after_delete", "questions") as stage:
+        for _ in range(config["cold_queries"]):
+            stage.time_call(cold_chatbot_call)
+    stages[stage.name] = stage.summary()
+
+    server.close()
+    return {
+        "documents": num_docs,
+        "chunks": chunks,
+        "index_bytes": bucket.total_bytes(f"{index_store.INDEX_PREFIX}/"),
+        "stages": stages,
+    }
+
+
+def git_describe():
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], capture_output=True, text=True, cwd=REPO_DIR
+        ).stdout.strip()
+
+    commit = git("rev-parse", "--short", "HEAD") or "unknown"
+    dirty = bool(git("status", "--porcelain", "--untracked-files=no"))
+    return commit + ("-dirty" if dirty else "")
+
+
+def run_size(config):
+    # Runs one size in a fresh interpreter, the repo's own output is discarded
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "config.json")
+        result_path = os.path.join(tmp, "result.json")
+        stderr_path = os.path.join(tmp, "stderr.log")
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+        with open(stderr_path, "w") as stderr:
+            process = subprocess.run(
+                [sys.executable, __file__, "worker", config_path, result_path],
+                stdout=subprocess.DEVNULL,
+                stderr=stderr,
+                cwd=REPO_DIR,
+            )
+        if process.returncode != 0:
+            with open(stderr_path) as f:
+                tail = f.read().splitlines()[-20:]
+            return {"error": "\n".join(tail)}
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def print_size(size, result):
+    if "error" in result:
+        print(f"\n{size} chunks: failed\n{result['error']}")
+        return
+    print(
+        f"\n{size} chunks ({result['chunks']} indexed from {result['documents']} "
+        f"documents, {result['index_bytes'] / 2**20:.1f} MB stored)"
+    )
+    print(
+        f"  {'entry point / span':<26}{'n':>6}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}"
+        f"{'p99 ms':>10}  {'throughput':>22}  {'peak RSS':>10}"
+    )
+    for name, stage in result["stages"].items():
+        throughput = f"{stage['throughput']:.2f} {stage['throughput_unit']}"
+        print(
+            f"  {name:<26}{stage['count']:>6}{stage['errors']:>5}"
+            f"{stage['p50_ms']:>10.1f}{stage['p95_ms']:>10.1f}{stage['p99_ms']:>10.1f}"
+            f"  {throughput:>22}  {stage['peak_rss_mb']:>7.1f} MB"
+        )
+        for span_name, span in stage.get("spans", {}).items():
+            print(
+                f"    {span_name:<24}{span['count']:>6}{'':>5}"
+                f"{span['p50_ms']:>10.1f}{span['p95_ms']:>10.1f}"
+                f"  {span['total_ms']:>10.1f} ms in total"
+            )
+
+
+def compare(baseline, report):
+    # Prints the change of every metric, flagging the ones that got worse
+    worse = 0
+    # (metric, whether higher is better)
+    metrics = [
+        ("p50_ms", False),
+        ("p95_ms", False),
+        ("throughput", True),
+        ("peak_rss_mb", False),
+    ]
+    print(f"{baseline['commit']} -> {report['commit']}")
+    for size, result in report["sizes"].items():
+        before = baseline["sizes"].get(size)
+        if not before or "error" in before or "error" in result:
+            continue
+        print(f"\n{size} chunks")
+        for name, stage in result["stages"].items():
+            old = before["stages"].get(name)
+            if old is None:
+                continue
+            changes = []
+            for metric, higher_is_better in metrics:
+                change = (
+                    (stage[metric] - old[metric]) / old[metric] if old[metric] else 0
+                )
+                worse_by = -change if higher_is_better else change
+                regressed = worse_by > REGRESSION_THRESHOLD
+                worse += regressed
+                changes.append(
+                    f"{metric} {old[metric]:g} -> {stage[metric]:g} "
+                    f"({change:+.0%}){' !' if regressed else ''}"
+                )
+            print(f"  {name:<24}" + ", ".join(changes))
+    print(f"\n{worse} metrics worse by more than {REGRESSION_THRESHOLD:.0%}")
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the entry points against local fakes"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="run the benchmark and save a report")
+    run.add_argument("--sizes", default="100,1000,10000,100000")
+    run.add_argument("--chunks-per-doc", type=int, default=10)
+    run.add_argument("--chunk-tokens", type=int, default=200)
+    run.add_argument(
+        "--index-batch-chunks",
+        type=int,
+        default=5000,
+        help="chunks added to the index per index_documents call",
+    )
+    run.add_argument("--queries", type=int, default=50)
+    run.add_argument("--cold-queries", type=int, default=3)
+    run.add_argument("--deletes", type=int, default=20)
+    run.add_argument("--firestore-latency", type=float, default=0.01)
+    run.add_argument("--storage-latency", type=float, default=0.03)
+    run.add_argument("--storage-bandwidth-mb", type=float, default=100)
+    run.add_argument("--download-latency", type=float, default=0.05)
+    run.add_argument("--embedding-latency", type=float, default=0.2)
+    run.add_argument("--llm-latency", type=float, default=0.5)
+    run.add_argument("--token-delay", type=float, default=0.01)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--out", help="report path, default results/{commit}.json")
+    run.add_argument("--compare", help="report to compare the new one with")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("report")
+
+    worker = subparsers.add_parser("worker", help=argparse.SUPPRESS)
+    worker.add_argument("config_path")
+    worker.add_argument("result_path")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        with open(args.config_path) as f:
+            result = run_worker(json.load(f))
+        with open(args.result_path, "w") as f:
+            json.dump(result, f)
+        # Skip the interpreter teardown of everything the run loaded
+        os._exit(0)
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.report) as f:
+            report = json.load(f)
+        sys.exit(1 if compare(baseline, report) else 0)
+
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("command", "sizes", "out", "compare")
+    }
+    report = {
+        "commit": git_describe(),
+        "python": platform.python_version(),
+        "created_at": time.time(),
+        "config": config,
+        "sizes": {},
+    }
+    for size in [int(size) for size in args.sizes.split(",")]:
+        start = time.perf_counter()
+        result = run_size(dict(config, size=size))
+        report["sizes"][str(size)] = result
+        print_size(size, result)
+        print(f"  ({time.perf_counter() - start:.0f}s)")
+
+    out = args.out or os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,13 @@
 from langchain.agents import Tool
 from langchain.chains.conversation.memory import ConversationBufferMemory
-from langchain.chat_models import ChatOpenAI
 from langchain.agents import initialize_agent, AgentType
 import logging
 import sys
 from dotenv import load_dotenv
 import os.path
-from llama_index import (
-    GPTSimpleVectorIndex,
-    LLMPredictor,
-    PromptHelper,
-    ServiceContext,
-)
+from custom_class import CustomGPTSimpleVectorIndex
 from llama_index.optimization.optimizer import SentenceEmbeddingOptimizer
+from service_context import load_llm, load_service_context
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
@@ -24,26 +19,9 @@ api_key = os.getenv("OPENAI_API_KEY")
 # Use the API key in your code
 os.environ["OPENAI_API_KEY"] = api_key
 
-# Defining the parameters for the index
-max_input_size = 4096
-num_outputs = 1024
-max_chunk_overlap = 20
-
-prompt_helper = PromptHelper(
-    max_input_size,
-    num_outputs,
-    max_chunk_overlap,
-)
-
-llm_predictor = LLMPredictor(
-    llm=ChatOpenAI(temperature=0.2, model_name="gpt-3.5-turbo", max_tokens=num_outputs)
-)
-
-service_context = ServiceContext.from_defaults(
-    llm_predictor=llm_predictor, prompt_helper=prompt_helper
-)
+service_context = load_service_context(temperature=0.2)
 
-index = GPTSimpleVectorIndex.load_from_disk(
+index = CustomGPTSimpleVectorIndex.load_from_disk(
     "index.json", service_context=service_context
 )
 
@@ -64,7 +42,7 @@ tools = [
 
 # set Logging to DEBUG for more detailed outputs
 memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-llm = ChatOpenAI(temperature=0.2, model_name="gpt-3.5-turbo")
+llm = load_llm(temperature=0.2, max_tokens=None)
 agent_chain = initialize_agent(
     tools,
     llm,
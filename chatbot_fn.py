@@ -3,51 +3,79 @@ from langchain.chat_models import ChatOpenAI
 from langchain.agents import initialize_agent, AgentType
 from langchain.memory import ConversationBufferMemory
 from dotenv import load_dotenv
+import json
 import os.path
-from llama_index import (
-    GPTSimpleVectorIndex,
-    LLMPredictor,
-    PromptHelper,
-    ServiceContext,
-)
+import time
+from concurrent.futures import ThreadPoolExecutor
+from llama_index.indices.query.schema import QueryBundle
+from llama_index.indices.response.response_synthesis import ResponseSynthesizer
+from llama_index.indices.response.type import ResponseMode
+from answer_cache import AnswerCache, normalize_question
+from batch_embedding import embed_texts
+from custom_class import CustomGPTSimpleVectorIndex
 from firebase_utils import bucket
+from index_cache import IndexCache
+from index_store import get_index_blob, load_index_from_blob
+from sentence_pruning import context_pruner
+from service_context import load_service_context
+from tracing import current_context, span, start_span
 
 load_dotenv()
 api_key = os.getenv("OPENAI_API_KEY")
 os.environ["OPENAI_API_KEY"] = api_key
 
+# Chunks given to the answer when several indices are queried at once
+MULTI_INDEX_TOP_K = int(os.getenv("MULTI_INDEX_TOP_K", "3"))
+# Indices loaded and searched at the same time
+MULTI_INDEX_WORKERS = int(os.getenv("MULTI_INDEX_WORKERS", "8"))
 
-def chatbot_fn(input_text, index_name="index.json"):
-    # Defining the parameters for the index
-    max_input_size = 4096
-    num_outputs = 1024
-    max_chunk_overlap = 20
-
-    prompt_helper = PromptHelper(
-        max_input_size,
-        num_outputs,
-        max_chunk_overlap,
-    )
+# Chunks per answer in a batch, the same as index.query uses
+BATCH_TOP_K = 1
+# Completions in flight at once for a batch of questions
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# Loaded indices and recent answers survive between invocations on a warm instance
+index_cache = IndexCache()
+answer_cache = AnswerCache()
+
+
+def cached_answer(blob, input_text, service_context):
+    # Returns the cached answer or None, and the query embedding if one was needed
+    answer = answer_cache.get_exact(blob, input_text)
+    if answer is not None:
+        return answer, None
+    with span("embed_query", characters=len(input_text)):
+        query_embedding = service_context.embed_model.get_query_embedding(input_text)
+    return answer_cache.get_similar(blob, query_embedding), query_embedding
 
-    llm_predictor = LLMPredictor(
-        llm=ChatOpenAI(
-            temperature=0.2, model_name="gpt-3.5-turbo", max_tokens=num_outputs
-        )
-    )
 
-    service_context = ServiceContext.from_defaults(
-        llm_predictor=llm_predictor, prompt_helper=prompt_helper
+def load_chatbot_index(blob, index_name, service_context):
+    # Load the index from Firebase Storage, or reuse it if it hasn't changed
+    index = index_cache.get(
+        blob,
+        lambda blob: load_index_from_blob(
+            bucket,
+            blob,
+            CustomGPTSimpleVectorIndex,
+            service_context=service_context,
+        ),
     )
+    print(f"{index_name} has been loaded successfully.")
+    return index
+
+
+def chatbot_fn(input_text, index_name="index.json"):
+    service_context = load_service_context(temperature=0.2)
 
     try:
-        # Download the index.json file from Firebase Storage
-        blob = bucket.blob(f"gptIndices/{index_name}")
-        index_json_data = blob.download_as_text()
+        # Metadata only, its generation changes whenever the index is written
+        blob = get_index_blob(bucket, index_name)
+        answer, query_embedding = cached_answer(blob, input_text, service_context)
+        if answer is not None:
+            print(f"Answer cache hit: {answer_cache.stats()}")
+            return answer
 
-        index = GPTSimpleVectorIndex.load_from_string(
-            index_json_data, service_context=service_context
-        )
-        print(f"{index_name} has been loaded successfully.")
+        index = load_chatbot_index(blob, index_name, service_context)
 
         # Optimiser reduced time and token usage
         # Tools for langchain agent
@@ -76,11 +104,284 @@ def chatbot_fn(input_text, index_name="index.json"):
         #     memory=memory,
         # )
 
-        response = index.query(input_text, service_context=service_context)
+        # Retrieval reuses the embedding computed for the cache lookup
+        pruner = context_pruner(index)
+        with span("answer") as stage:
+            response = index.query(
+                QueryBundle(input_text, embedding=query_embedding),
+                service_context=service_context,
+                optimizer=pruner,
+            )
+            if pruner is not None:
+                stage.set(**pruner.report())
         print("response: ", response.response)
+        if response.response:
+            answer_cache.put(blob, input_text, query_embedding, response.response)
 
         return response.response
 
     except Exception as e:
         print("Error loading index.json:", e)
         return f"Error loading index. Inform your developer, {e}"
+
+
+def chatbot_multi_fn(input_text, index_names, similarity_top_k=MULTI_INDEX_TOP_K):
+    # One answer from several indices: the question is embedded once, each
+    # index returns its best chunks, and the best of all of them go into a
+    # single completion
+    service_context = load_service_context(temperature=0.2)
+
+    try:
+        with span("embed_query", characters=len(input_text)):
+            query_embedding = service_context.embed_model.get_query_embedding(
+                input_text
+            )
+        parent = current_context()
+
+        def retrieve(index_name):
+            with span("index_retrieve", parent=parent, index_name=index_name):
+                blob = get_index_blob(bucket, index_name)
+                index = load_chatbot_index(blob, index_name, service_context)
+                return index, index.retrieve(query_embedding, similarity_top_k)
+
+        workers = max(1, min(len(index_names), MULTI_INDEX_WORKERS))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(retrieve, index_names))
+        candidates = [node for _, nodes in results for node in nodes]
+
+        # Same embedding model everywhere, so the scores compare across indices
+        candidates.sort(key=lambda node: node.score, reverse=True)
+        pruner = context_pruner(*(index for index, _ in results))
+        synthesizer = ResponseSynthesizer.from_args(
+            service_context=service_context,
+            response_mode=ResponseMode.SIMPLE_SUMMARIZE,
+            optimizer=pruner,
+        )
+        with span("answer") as stage:
+            response = synthesizer.synthesize(
+                QueryBundle(input_text, embedding=query_embedding),
+                candidates[:similarity_top_k],
+            )
+            if pruner is not None:
+                stage.set(**pruner.report())
+        print("response: ", response.response)
+        return response.response
+
+    except Exception as e:
+        print("Error loading indices:", e)
+        return f"Error loading index. Inform your developer, {e}"
+
+
+def chatbot_batch_fn(questions, index_name, concurrency=BATCH_CONCURRENCY):
+    # Many questions against one index: the index is loaded once, the questions
+    # are embedded together and scored with one matrix product, and only the
+    # completions run per question, `concurrency` at a time
+    start = time.perf_counter()
+    service_context = load_service_context(temperature=0.2)
+    blob = get_index_blob(bucket, index_name)
+
+    answers = [
+        {"question": question, "response": None, "cached": False, "timing": {}}
+        for question in questions
+    ]
+
+    def elapsed_ms():
+        return round((time.perf_counter() - start) * 1000, 1)
+
+    pending = []
+    # Questions the answer cache treats as the same are answered once, by the
+    # first of them, and the answer is copied to the others at the end
+    groups = {}
+    for position, question in enumerate(questions):
+        answer = answer_cache.get_exact(blob, question)
+        if answer is not None:
+            answers[position].update(
+                response=answer, cached=True, timing={"total_ms": elapsed_ms()}
+            )
+            continue
+        group = groups.setdefault(normalize_question(question), [])
+        if not group:
+            pending.append(position)
+        group.append(position)
+
+    # ada-002 embeds queries and texts the same way, so they can share batches
+    embed_start = time.perf_counter()
+    embeddings = embed_texts(
+        service_context.embed_model, [questions[p] for p in pending]
+    )
+    embedding_by_position = dict(zip(pending, embeddings))
+    for position in list(pending):
+        answer = answer_cache.get_similar(blob, embedding_by_position[position])
+        if answer is not None:
+            answers[position].update(
+                response=answer, cached=True, timing={"total_ms": elapsed_ms()}
+            )
+            pending.remove(position)
+
+    load_start = time.perf_counter()
+    index = load_chatbot_index(blob, index_name, service_context) if pending else None
+    retrieve_start = time.perf_counter()
+    nodes = (
+        index.retrieve_many([embedding_by_position[p] for p in pending], BATCH_TOP_K)
+        if pending
+        else []
+    )
+    answer_start = time.perf_counter()
+
+    parent = current_context()
+
+    def answer_question(position, question_nodes):
+        question_start = time.perf_counter()
+        question = questions[position]
+        try:
+            # One pruner per question, for its own report of the tokens saved
+            pruner = context_pruner(index)
+            synthesizer = ResponseSynthesizer.from_args(
+                service_context=service_context, optimizer=pruner
+            )
+            with span("answer", parent=parent, position=position) as stage:
+                response = synthesizer.synthesize(
+                    QueryBundle(question, embedding=embedding_by_position[position]),
+                    question_nodes,
+                )
+                if pruner is not None:
+                    answers[position]["pruning"] = pruner.report()
+                    stage.set(**pruner.report())
+            if response.response:
+                answer_cache.put(
+                    blob, question, embedding_by_position[position], response.response
+                )
+            answers[position]["response"] = response.response
+        except Exception as e:
+            print(f"Error answering question {position}:", e)
+            answers[position]["error"] = str(e)
+        answers[position]["timing"] = {
+            "completion_ms": round((time.perf_counter() - question_start) * 1000, 1),
+            # From the start of the batch, waiting for a free slot included
+            "total_ms": elapsed_ms(),
+        }
+
+    if pending:
+        workers = max(1, min(concurrency, len(pending)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(answer_question, pending, nodes))
+
+    for first, *others in groups.values():
+        for position in others:
+            answers[position] = {
+                **answers[first],
+                "question": questions[position],
+                "timing": dict(answers[first]["timing"]),
+            }
+
+    end = time.perf_counter()
+    return {
+        "index_name": index_name,
+        "answers": answers,
+        "timing": {
+            "embed_ms": round((load_start - embed_start) * 1000, 1),
+            "load_ms": round((retrieve_start - load_start) * 1000, 1),
+            "retrieve_ms": round((answer_start - retrieve_start) * 1000, 1),
+            "completions_ms": round((end - answer_start) * 1000, 1),
+            "total_ms": round((end - start) * 1000, 1),
+        },
+    }
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def chatbot_stream_fn(input_text, index_name="index.json", parent=None):
+    # Server-sent events: one "token" event per chunk of the answer, then a
+    # "done" event with the full answer, the source nodes and the timings
+    with span("chatbot_stream", parent=parent, index_name=index_name):
+        yield from _chatbot_stream(input_text, index_name)
+
+
+def _chatbot_stream(input_text, index_name):
+    start = time.perf_counter()
+    service_context = load_service_context(temperature=0.2)
+
+    try:
+        blob = get_index_blob(bucket, index_name)
+        answer, query_embedding = cached_answer(blob, input_text, service_context)
+        if answer is not None:
+            print(f"Answer cache hit: {answer_cache.stats()}")
+            yield sse_event("token", {"token": answer})
+            total_ms = round((time.perf_counter() - start) * 1000, 1)
+            yield sse_event(
+                "done",
+                {
+                    "response": answer,
+                    "source_nodes": [],
+                    "cached": True,
+                    "timing": {"first_token_ms": total_ms, "total_ms": total_ms},
+                },
+            )
+            return
+
+        index = load_chatbot_index(blob, index_name, service_context)
+        loaded = time.perf_counter()
+        pruner = context_pruner(index)
+        # Not the active span, the generator yields while it runs. Ended when
+        # the last token is out or the answer fails.
+        answer_span = start_span("answer")
+        try:
+            response = index.query(
+                QueryBundle(input_text, embedding=query_embedding),
+                service_context=service_context,
+                streaming=True,
+                optimizer=pruner,
+            )
+            retrieved = time.perf_counter()
+
+            first_token = None
+            parts = []
+            for token in response.response_gen:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                parts.append(token)
+                yield sse_event("token", {"token": token})
+            end = time.perf_counter()
+            if pruner is not None:
+                answer_span.set(**pruner.report())
+        except Exception as e:
+            answer_span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            answer_span.end()
+    except Exception as e:
+        print("Error streaming answer:", e)
+        yield sse_event(
+            "error", {"response": f"Error loading index. Inform your developer, {e}"}
+        )
+        return
+
+    print("response: ", "".join(parts))
+    if parts:
+        answer_cache.put(blob, input_text, query_embedding, "".join(parts))
+    yield sse_event(
+        "done",
+        {
+            "response": "".join(parts),
+            "cached": False,
+            "source_nodes": [
+                {
+                    "doc_id": source.node.ref_doc_id,
+                    "score": source.score,
+                    "extra_info": source.node.extra_info,
+                    "text": source.node.get_text()[:300],
+                }
+                for source in response.source_nodes
+            ],
+            "timing": {
+                "load_ms": round((loaded - start) * 1000, 1),
+                "retrieve_ms": round((retrieved - loaded) * 1000, 1),
+                "first_token_ms": round(((first_token or end) - start) * 1000, 1),
+                "total_ms": round((end - start) * 1000, 1),
+            },
+            # Tokens saved by sentence pruning, None when it is off
+            "pruning": pruner.report() if pruner is not None else None,
+        },
+    )
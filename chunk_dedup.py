@@ -0,0 +1,121 @@
+import hashlib
+import os
+import zlib
+import numpy as np
+
+# Brochures and other documents repeat the same boilerplate across files. Chunks
+# that are identical, or nearly (MinHash estimate of the Jaccard similarity of
+# their word shingles), are embedded and stored once. The kept node lists every
+# document it came from in node_info["ref_doc_ids"], and deleting one of them
+# only drops its reference (see CustomGPTSimpleVectorIndex._release_document).
+#
+# Only the chunks of one update are compared with each other, the existing
+# index isn't downloaded to index new documents.
+
+# 0 keeps every chunk
+CHUNK_DEDUP = os.getenv("CHUNK_DEDUP", "1") == "1"
+# Estimated similarity from which two chunks are the same, 1 for exact copies only
+CHUNK_DEDUP_THRESHOLD = float(os.getenv("CHUNK_DEDUP_THRESHOLD", "0.9"))
+SHINGLE_WORDS = 3
+MINHASH_PERMUTATIONS = 128
+# 32 bands of 4 rows: chunks with a similarity of 0.9 share a band with
+# probability 0.99999, the candidates are then checked against the threshold
+MINHASH_BANDS = 32
+# A prime above every crc32, (a * x + b) % p is a permutation of the hashes
+MINHASH_PRIME = (1 << 32) + 15
+REF_DOC_IDS = "ref_doc_ids"
+
+_rng = np.random.default_rng(0)
+_a = _rng.integers(1, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_b = _rng.integers(0, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+def shared_doc_ids(node):
+    # Every document of a deduplicated chunk, [] for a chunk of one document
+    return list((node.node_info or {}).get(REF_DOC_IDS, []))
+
+
+def set_shared_doc_ids(node, doc_ids):
+    node_info = dict(node.node_info or {})
+    if len(doc_ids) > 1:
+        node_info[REF_DOC_IDS] = list(doc_ids)
+    else:
+        node_info.pop(REF_DOC_IDS, None)
+    node.node_info = node_info
+
+
+def minhash(words):
+    # Signature of the set of word shingles, cheap to compare in bulk
+    shingles = {
+        " ".join(words[i : i + SHINGLE_WORDS])
+        for i in range(max(1, len(words) - SHINGLE_WORDS + 1))
+    }
+    hashes = np.fromiter(
+        (zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+    # a < 2**32 and hashes < 2**32, so a * x + b can't overflow 64 bits
+    return ((_a[:, None] * hashes[None, :] + _b[:, None]) % MINHASH_PRIME).min(axis=1)
+
+
+def dedup_nodes(nodes, threshold=CHUNK_DEDUP_THRESHOLD):
+    """Keeps the first of each group of duplicate chunks.
+
+    Returns the kept nodes, in order, and counts of what was dropped. The
+    extra_info header isn't compared, it differs between documents.
+    """
+    kept = []
+    references = {}
+    by_hash = {}
+    bands = [{} for _ in range(MINHASH_BANDS)]
+    signatures = {}
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    exact = near = 0
+
+    for node in nodes:
+        words = node.text.lower().split()
+        key = hashlib.sha1(" ".join(words).encode("utf-8")).hexdigest()
+        original = by_hash.get(key)
+
+        if original is None and threshold < 1 and words:
+            signature = minhash(words)
+            band_keys = [
+                signature[band * rows : (band + 1) * rows].tobytes()
+                for band in range(MINHASH_BANDS)
+            ]
+            candidates = dict.fromkeys(
+                bands[band][band_key]
+                for band, band_key in enumerate(band_keys)
+                if band_key in bands[band]
+            )
+            for candidate in candidates:
+                if np.mean(signatures[candidate] == signature) >= threshold:
+                    original = candidate
+                    near += 1
+                    break
+            if original is None:
+                # Only kept chunks are registered, so groups can't drift apart
+                signatures[len(kept)] = signature
+                for band, band_key in enumerate(band_keys):
+                    bands[band].setdefault(band_key, len(kept))
+        elif original is not None:
+            exact += 1
+
+        if original is None:
+            by_hash[key] = len(kept)
+            references[len(kept)] = [node.ref_doc_id]
+            kept.append(node)
+        elif node.ref_doc_id not in references[original]:
+            references[original].append(node.ref_doc_id)
+
+    for position, doc_ids in references.items():
+        if len(doc_ids) > 1:
+            set_shared_doc_ids(kept[position], doc_ids)
+    return kept, {
+        "chunks": len(nodes),
+        "kept": len(kept),
+        "exact_duplicates": exact,
+        "near_duplicates": near,
+        "shared": sum(len(doc_ids) > 1 for doc_ids in references.values()),
+    }
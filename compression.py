@@ -0,0 +1,123 @@
+import codecs
+import json
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # Optional, needed to write INDEX_COMPRESSION=zstd blobs and to read them
+    zstandard = None
+
+# JSON blobs (index sidecars, legacy indices) are written gzip or zstd
+# compressed. Readers recognise the format by its magic bytes, so blobs written
+# uncompressed before still load.
+INDEX_COMPRESSION = os.getenv("INDEX_COMPRESSION", "gzip")
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CONTENT_TYPES = {
+    "gzip": "application/gzip",
+    "zstd": "application/zstd",
+    "none": "application/json",
+}
+# Characters of JSON text encoded and compressed at a time
+ENCODE_CHUNK_SIZE = 1024 * 1024
+
+
+def encode_json(obj, compression=INDEX_COMPRESSION):
+    # Returns the blob data and its content type. The text is compressed a
+    # chunk at a time, so there's never a full uncompressed bytes copy of it.
+    if compression == "zstd" and zstandard is None:
+        print("zstandard is not installed, compressing with gzip")
+        compression = "gzip"
+    text = json.dumps(obj, separators=(",", ":"))
+    if compression == "zstd":
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    elif compression == "gzip":
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    else:
+        return text.encode("utf-8"), CONTENT_TYPES["none"]
+
+    parts = [
+        compressor.compress(text[start : start + ENCODE_CHUNK_SIZE].encode("utf-8"))
+        for start in range(0, len(text), ENCODE_CHUNK_SIZE)
+    ]
+    parts.append(compressor.flush())
+    return b"".join(parts), CONTENT_TYPES[compression]
+
+
+class _Uncompressed:
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+def _decompressor(head):
+    if head.startswith(GZIP_MAGIC):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if head.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("zstandard must be installed to read zstd blobs")
+        return zstandard.ZstdDecompressor().decompressobj()
+    return _Uncompressed()
+
+
+class JsonDecoder:
+    """Writable file object that decompresses and decodes JSON as it arrives.
+
+    Passed to blob.download_to_file(), so the compressed blob is never held in
+    memory, only the text, which is released once it is parsed.
+    """
+
+    def __init__(self):
+        self.compressed_size = 0
+        self.text_size = 0
+        self._head = b""
+        self._decompressor = None
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._parts = []
+
+    def write(self, data):
+        size = len(data)
+        self.compressed_size += size
+        if self._decompressor is None:
+            # Wait for enough bytes to tell the format
+            self._head += bytes(data)
+            if len(self._head) < len(ZSTD_MAGIC):
+                return size
+            self._decompressor = _decompressor(self._head)
+            data, self._head = self._head, b""
+        self._decode(self._decompressor.decompress(data))
+        return size
+
+    def _decode(self, data):
+        if data:
+            self.text_size += len(data)
+            self._parts.append(self._decoder.decode(data))
+
+    def load(self):
+        if self._decompressor is None:
+            self._decompressor = _decompressor(self._head)
+            self._decode(self._decompressor.decompress(self._head))
+        self._decode(self._decompressor.flush())
+        self._parts.append(self._decoder.decode(b"", final=True))
+        text = "".join(self._parts)
+        self._parts = []
+        return json.loads(text)
+
+
+def download_json(blob, generation):
+    # Returns the parsed blob and the size of its uncompressed text
+    decoder = JsonDecoder()
+    blob.download_to_file(decoder, if_generation_match=generation)
+    return decoder.load(), decoder.text_size
+
+
+def decode_json(data):
+    decoder = JsonDecoder()
+    decoder.write(data)
+    return decoder.load()
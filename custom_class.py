@@ -1,19 +1,177 @@
 from llama_index import GPTSimpleVectorIndex
-from typing import Any
+from llama_index.indices.vector_store.base import GPTVectorStoreIndex
+from llama_index.data_structs.data_structs_v2 import IndexDict
+from llama_index.data_structs.node_v2 import DocumentRelationship, Node, NodeWithScore
+from llama_index.vector_stores.types import NodeEmbeddingResult, VectorStoreQuery
+from typing import Any, Dict, List, Optional, Sequence, Set
+from batch_embedding import embed_texts
+from chunk_dedup import set_shared_doc_ids, shared_doc_ids
+from numpy_vector_store import NumpyVectorStore
+from sentence_pruning import SentenceStore
 
 
 class CustomGPTSimpleVectorIndex(GPTSimpleVectorIndex):
-    def _delete(self, doc_id: str, **delete_kwargs: Any) -> None:
-        # Add your custom code here before the deletion
+    def __init__(self, *args: Any, vector_store: Optional[Any] = None, **kwargs: Any):
+        # Vectorized retrieval over one embedding matrix instead of a dict scan
+        if vector_store is None:
+            vector_store = NumpyVectorStore()
+        super().__init__(*args, vector_store=vector_store, **kwargs)
+        # Sentence embeddings of the chunks, saved and loaded by index_store
+        self.sentence_store = SentenceStore()
+
+    @property
+    def vector_store(self) -> NumpyVectorStore:
+        return self._vector_store
+
+    @classmethod
+    def load_from_dict(
+        cls,
+        result_dict: Dict[str, Any],
+        vector_store: Optional[NumpyVectorStore] = None,
+        **kwargs: Any,
+    ) -> "CustomGPTSimpleVectorIndex":
+        if vector_store is None:
+            vector_store = NumpyVectorStore.from_dict(
+                result_dict["vector_store"]["__data__"]
+            )
+        # Skip GPTVectorStoreIndex.load_from_dict, it would build a SimpleVectorStore
+        return super(GPTVectorStoreIndex, cls).load_from_dict(
+            result_dict, vector_store=vector_store, **kwargs
+        )
+
+    def save_to_dict(
+        self, include_vector_store: bool = True, **save_kwargs: Any
+    ) -> dict:
+        out_dict = super(GPTVectorStoreIndex, self).save_to_dict(**save_kwargs)
+        if include_vector_store:
+            # Written as a "simple" store so plain GPTSimpleVectorIndex can load it
+            out_dict["vector_store"] = {
+                "__type__": "simple",
+                "__data__": self._vector_store.config_dict,
+            }
+        return out_dict
+
+    def retrieve(
+        self, query_embedding: List[float], similarity_top_k: int
+    ) -> List[NodeWithScore]:
+        # Retrieval only, for callers that synthesize the answer themselves
+        result = self._vector_store.query(
+            VectorStoreQuery(
+                query_embedding=query_embedding, similarity_top_k=similarity_top_k
+            )
+        )
+        nodes = self._docstore.get_nodes(
+            [self._index_struct.nodes_dict[text_id] for text_id in result.ids]
+        )
+        return [
+            NodeWithScore(node, score)
+            for node, score in zip(nodes, result.similarities)
+        ]
+
+    def retrieve_many(
+        self, query_embeddings: List[List[float]], similarity_top_k: int
+    ) -> List[List[NodeWithScore]]:
+        # retrieve() for many queries, scored together as one matrix product
+        results = self._vector_store.query_many(query_embeddings, similarity_top_k)
+        return [
+            [
+                NodeWithScore(
+                    self._docstore.get_node(self._index_struct.nodes_dict[text_id]),
+                    score,
+                )
+                for text_id, score in zip(result.ids, result.similarities)
+            ]
+            for result in results
+        ]
+
+    def _get_node_embedding_results(
+        self, nodes: Sequence[Node], existing_node_ids: Set
+    ) -> List[NodeEmbeddingResult]:
+        # Same contract as the parent, but the chunks are embedded in large
+        # concurrent batches instead of embed_batch_size requests one after another
+        # (not stored on the nodes, the docstore would save them a second time)
+        pending = [n for n in nodes if n.embedding is None]
+        embeddings = embed_texts(
+            self._service_context.embed_model, [n.get_text() for n in pending]
+        )
+        new_embeddings = dict(zip(map(id, pending), embeddings))
+
+        results = []
+        for node in nodes:
+            if node.ref_doc_id is None:
+                raise ValueError("Reference doc id is None.")
+            embedding = new_embeddings.get(id(node), node.embedding)
+            results.append(
+                NodeEmbeddingResult(
+                    node.get_doc_id(), node, embedding, doc_id=node.ref_doc_id
+                )
+            )
+        return results
 
+    def _add_nodes_to_index(
+        self, index_struct: IndexDict, nodes: Sequence[Node]
+    ) -> None:
+        super()._add_nodes_to_index(index_struct, nodes)
+        # The vector store ids are the node ids
+        for node in nodes:
+            _add_references(index_struct, node, node.get_doc_id())
+
+    def merge_index(self, other: "CustomGPTSimpleVectorIndex") -> None:
+        # Appends another index's rows, nodes and documents without re-embedding
+        ids, doc_ids, matrix, norms = other.vector_store.to_arrays()
+        self.vector_store.add_arrays(ids, doc_ids, matrix, norms)
+        for text_id in ids:
+            node = other.docstore.get_node(other.index_struct.nodes_dict[text_id])
+            self._index_struct.add_node(node, text_id=text_id)
+            _add_references(self._index_struct, node, text_id)
+        self._docstore.update_docstore(other.docstore)
+        self.sentence_store.merge(other.sentence_store)
+        for doc_id, ref_doc_info in other.docstore._ref_doc_info.items():
+            self._docstore._ref_doc_info[doc_id].update(ref_doc_info)
+
+    def apply_tombstones(self, doc_ids) -> None:
+        # Quiet bulk _delete for documents deleted since the last compaction
+        for doc_id in doc_ids:
+            self._release_document(doc_id)
+
+    def _release_document(self, doc_id: str) -> None:
+        # Deletes the chunks of a document. A chunk shared with other documents
+        # (see chunk_dedup.py) only loses this reference, and if it belonged to
+        # this document it is handed to the next one.
+        for text_id in self._index_struct.doc_id_dict.pop(doc_id, []):
+            node_id = self._index_struct.nodes_dict.get(text_id)
+            if node_id is None:
+                continue
+            node = self._docstore.get_document(node_id, raise_error=False)
+            others = [d for d in shared_doc_ids(node) if d != doc_id] if node else []
+            if others:
+                set_shared_doc_ids(node, others)
+                if node.ref_doc_id == doc_id:
+                    node.relationships[DocumentRelationship.SOURCE] = others[0]
+                    self._vector_store.reassign(text_id, others[0])
+            else:
+                self._docstore.delete_document(node_id, raise_error=False)
+                del self._index_struct.nodes_dict[text_id]
+                self._vector_store.delete_nodes([text_id])
+        # Shared rows were handed over above, any row still on it goes
+        self._vector_store.delete(doc_id)
+        self._docstore._ref_doc_info.pop(doc_id, None)
+
+    def _delete(self, doc_id: str, **delete_kwargs: Any) -> None:
         # Check if the doc_id key exists in the doc_id_dict
         if doc_id in self._index_struct.doc_id_dict:
             document_ids = self._index_struct.doc_id_dict[doc_id]
             print("Deleting documents: \n", document_ids)
-            for doc in document_ids:
-                self._docstore.delete_document(doc)
         else:
             print(f"Document ID {doc_id} not found in the index")
 
-        # Call the original _delete method from the parent class
-        super()._delete(doc_id, **delete_kwargs)
+        # Reference counted instead of the parent's _delete, shared chunks stay
+        self._release_document(doc_id)
+
+
+def _add_references(index_struct: IndexDict, node: Node, text_id: str) -> None:
+    # add_node lists a chunk under its first document, a shared chunk is also
+    # listed under the others so deleting any of them finds it
+    for doc_id in shared_doc_ids(node):
+        if doc_id != node.ref_doc_id:
+            index_struct.doc_id_dict.setdefault(doc_id, []).append(text_id)
@@ -1,46 +1,53 @@
 from custom_class import CustomGPTSimpleVectorIndex
-from firebase_admin import storage
-import os
-from firebase_utils import db
+from firebase_utils import bucket
 import logging
 from service_context import load_service_context
+from index_store import index_exists
+from index_writer import index_writer
 
-storage_url = os.getenv("FIREBASE_STORAGE_BUCKET_URL")
-docs_ref = db.collection("documents")
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
 
 def delete_doc_fn(file):
-    service_context = load_service_context()
-
     index_name = file["index_name"]
     doc_id = file["doc_id"]
     print("index_name: ", index_name)
     print("doc_id: ", doc_id)
 
-    try:
-        # Download the index.json file from Firebase Storage
-        bucket = storage.bucket(name=storage_url)
-        blob = bucket.blob(f"gptIndices/{index_name}.json")
-
-        # Check if the file exists in Firebase Storage
-        if blob.exists():
-            print(f"{index_name}.json exists in Firebase Storage")
-            index_json_data = blob.download_as_text()
-            index = CustomGPTSimpleVectorIndex.load_from_string(
-                index_json_data, service_context=service_context
-            )
+    return delete_docs_fn([file])[index_name]
 
-            index.delete(doc_id)
 
-            index_json_data = index.save_to_string()
+def delete_docs_fn(files):
+    # Groups the documents per index, so each index is updated once
+    service_context = load_service_context()
+    doc_ids_by_index = {}
+    for file in files:
+        doc_ids_by_index.setdefault(file["index_name"], []).append(file["doc_id"])
 
-            # Upload the JSON string to Firebase Storage
-            blob = bucket.blob(f"gptIndices/{index_name}.json")
-            blob.upload_from_string(index_json_data)
+    return {
+        index_name: delete_from_index(bucket, index_name, doc_ids, service_context)
+        for index_name, doc_ids in doc_ids_by_index.items()
+    }
+
+
+def delete_from_index(bucket, index_name, doc_ids, service_context):
+    try:
+        # Check if the index exists in Firebase Storage
+        if index_exists(bucket, index_name):
+            print(f"{index_name} exists in Firebase Storage")
+
+            # Tombstones hide the documents right away, the nodes are removed
+            # from the blobs when the index is next compacted
+            index_writer.delete_documents(
+                bucket,
+                index_name,
+                doc_ids,
+                CustomGPTSimpleVectorIndex,
+                service_context=service_context,
+            )
 
-            print(f"{index_name}.json saved to Firebase Storage")
+            print(f"{index_name} saved to Firebase Storage")
             return "Delete document successfully"
 
         else:
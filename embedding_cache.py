@@ -0,0 +1,217 @@
+import glob
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from google.api_core.exceptions import PreconditionFailed
+from llama_index.embeddings.base import BaseEmbedding
+
+# Embeddings of chunk texts already seen, keyed by sha256(model + text). Each
+# model's entries are split over NUM_SHARDS blobs so a flush only rewrites the
+# shards that changed.
+CACHE_PREFIX = "embeddingCache"
+LOCAL_CACHE_DIR = "/tmp/embeddingCache"
+NUM_SHARDS = 16
+# Memory budget for cached embeddings, also caps what is written back
+EMBEDDING_CACHE_MAX_BYTES = int(
+    os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 * 1024))
+)
+FLUSH_RETRIES = 3
+
+
+def model_key(embed_model):
+    # Enum values, their str() differs between Python versions
+    parts = (
+        type(embed_model).__name__,
+        getattr(embed_model, "mode", ""),
+        getattr(embed_model, "model", ""),
+    )
+    return ":".join(str(getattr(part, "value", part)) for part in parts)
+
+
+def text_key(model, text):
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+def _model_slug(model):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", model)
+
+
+class EmbeddingCache:
+    """Bucket-backed embedding cache with a /tmp copy of every shard it reads."""
+
+    def __init__(self, bucket, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.bucket = bucket
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, model, texts):
+        # Returns one embedding or None per text
+        keys = [text_key(model, text) for text in texts]
+        results = []
+        with self._lock:
+            for key in keys:
+                shard = self._shard(model, key)
+                embedding = shard["entries"].get(key)
+                if embedding is None:
+                    self.misses += 1
+                else:
+                    shard["entries"].move_to_end(key)
+                    self.hits += 1
+                    embedding = embedding.tolist()
+                results.append(embedding)
+        return results
+
+    def put_many(self, model, texts, embeddings):
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                key = text_key(model, text)
+                shard = self._shard(model, key)
+                self._put(shard, key, np.asarray(embedding, dtype=np.float32))
+                shard["dirty"] = True
+
+    def flush(self):
+        # Writes back every shard changed since it was loaded
+        with self._lock:
+            dirty = [(k, s) for k, s in self._shards.items() if s["dirty"]]
+            for (model, shard_id), shard in dirty:
+                self._flush_shard(model, shard_id, shard)
+        if dirty:
+            print(f"Embedding cache flushed {len(dirty)} shards: {self.stats()}")
+
+    def stats(self):
+        entries = sum(len(s["entries"]) for s in self._shards.values())
+        return {
+            "entries": entries,
+            "bytes": sum(s["bytes"] for s in self._shards.values()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _blob_path(self, model, shard_id):
+        return f"{CACHE_PREFIX}/{_model_slug(model)}/{shard_id:02d}.npz"
+
+    def _local_path(self, model, shard_id, generation):
+        return f"{LOCAL_CACHE_DIR}/{_model_slug(model)}-{shard_id:02d}-{generation}.npz"
+
+    def _shard(self, model, key):
+        shard_id = int(key[:4], 16) % NUM_SHARDS
+        shard = self._shards.get((model, shard_id))
+        if shard is None:
+            shard = {"entries": OrderedDict(), "bytes": 0, "dirty": False}
+            shard["generation"] = self._load_shard(model, shard_id, shard)
+            self._shards[(model, shard_id)] = shard
+        return shard
+
+    def _load_shard(self, model, shard_id, shard):
+        # Returns the generation read, 0 when the shard does not exist yet
+        blob = self.bucket.get_blob(self._blob_path(model, shard_id))
+        if blob is None:
+            return 0
+
+        local_path = self._local_path(model, shard_id, blob.generation)
+        if not os.path.exists(local_path):
+            os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+            stale_pattern = self._local_path(model, shard_id, "*")
+            for stale_path in glob.glob(stale_pattern):
+                if stale_path != local_path:
+                    try:
+                        os.remove(stale_path)
+                    except FileNotFoundError:
+                        pass
+            # A temp file of its own, caches loading the same shard at once
+            # each download and the last replace wins
+            fd, tmp_path = tempfile.mkstemp(dir=LOCAL_CACHE_DIR, suffix=".part")
+            os.close(fd)
+            try:
+                blob.download_to_filename(tmp_path, if_generation_match=blob.generation)
+                os.replace(tmp_path, local_path)
+            except FileNotFoundError:
+                if not os.path.exists(local_path):
+                    raise
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        with np.load(local_path) as arrays:
+            # Stored least recently used first
+            for key, embedding in zip(arrays["keys"].tolist(), arrays["embeddings"]):
+                self._put(shard, key, embedding)
+        return blob.generation
+
+    def _put(self, shard, key, embedding):
+        previous = shard["entries"].pop(key, None)
+        if previous is not None:
+            shard["bytes"] -= previous.nbytes
+        shard["entries"][key] = embedding
+        shard["bytes"] += embedding.nbytes
+        while shard["bytes"] > self.max_bytes // NUM_SHARDS:
+            _, evicted = shard["entries"].popitem(last=False)
+            shard["bytes"] -= evicted.nbytes
+            self.evictions += 1
+
+    def _flush_shard(self, model, shard_id, shard):
+        blob = self.bucket.blob(self._blob_path(model, shard_id))
+        for _ in range(FLUSH_RETRIES):
+            keys = list(shard["entries"].keys())
+            buffer = io.BytesIO()
+            np.savez(
+                buffer,
+                keys=np.array(keys, dtype="U64"),
+                embeddings=np.stack(list(shard["entries"].values())),
+            )
+            try:
+                blob.upload_from_string(
+                    buffer.getvalue(),
+                    content_type="application/octet-stream",
+                    if_generation_match=shard["generation"],
+                )
+            except PreconditionFailed:
+                # Another instance wrote this shard, merge its entries under ours
+                ours = shard["entries"]
+                shard["entries"], shard["bytes"] = OrderedDict(), 0
+                shard["generation"] = self._load_shard(model, shard_id, shard)
+                for key, embedding in ours.items():
+                    self._put(shard, key, embedding)
+                continue
+            shard["generation"] = blob.generation
+            shard["dirty"] = False
+            return
+        print(f"Gave up writing embedding cache shard {shard_id} for {model}")
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Wraps an embed model, text embeddings are served from an EmbeddingCache."""
+
+    def __init__(self, embed_model, cache):
+        super().__init__(tokenizer=embed_model._tokenizer)
+        self.embed_model = embed_model
+        self.cache = cache
+        self.model_key = model_key(embed_model)
+
+    def _get_query_embedding(self, query):
+        return self.embed_model._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        embeddings = self.cache.get_many(self.model_key, texts)
+        missing = [p for p, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            new_texts = [texts[p] for p in missing]
+            new_embeddings = self.embed_model._get_text_embeddings(new_texts)
+            self.cache.put_many(self.model_key, new_texts, new_embeddings)
+            for position, embedding in zip(missing, new_embeddings):
+                embeddings[position] = embedding
+        return embeddings
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import time
+from typing import List, Optional
+import numpy as np
+from langchain.llms.base import LLM
+from llama_index.embeddings.base import BaseEmbedding
+
+# Stand-ins for the OpenAI models, enabled with FAKE_LLM=1, so the entry points
+# (including streaming) can run locally without an API key or token costs
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.3"))
+FAKE_LLM_TOKEN_DELAY = float(os.getenv("FAKE_LLM_TOKEN_DELAY", "0.02"))
+FAKE_LLM_ANSWER_WORDS = 40
+# Seconds per embeddings request, a batch of texts is one request
+FAKE_EMBEDDING_LATENCY = float(os.getenv("FAKE_EMBEDDING_LATENCY", "0"))
+# Same dimension as text-embedding-ada-002, so stored indices can be queried
+FAKE_EMBEDDING_DIM = 1536
+
+
+class FakeLLM(LLM):
+    """Answers with the first words of the context after a fixed latency."""
+
+    latency: float = FAKE_LLM_LATENCY
+    token_delay: float = FAKE_LLM_TOKEN_DELAY
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return "".join(self.stream_tokens(prompt))
+
+    def stream_tokens(self, prompt: str):
+        time.sleep(self.latency)
+        words = prompt.split()
+        # Skip the instructions at the top of the QA prompt
+        start = len(words) // 4
+        for word in words[start : start + FAKE_LLM_ANSWER_WORDS]:
+            time.sleep(self.token_delay)
+            yield word + " "
+
+
+class FakeEmbedding(BaseEmbedding):
+    """Deterministic unit vectors derived from a hash of the text."""
+
+    latency = FAKE_EMBEDDING_LATENCY
+
+    def _embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        vector = np.random.default_rng(seed).standard_normal(FAKE_EMBEDDING_DIM)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        time.sleep(self.latency)
+        return self._embed(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
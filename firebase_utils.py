@@ -1,10 +1,44 @@
-import firebase_admin
-from firebase_admin import firestore
-from firebase_admin import storage
 import os
+import threading
+from typing import Any
 
 storage_url = os.getenv("FIREBASE_STORAGE_BUCKET_URL")
 
-firebase_admin.initialize_app(options={"storageBucket": storage_url})
-db = firestore.client()
-bucket = storage.bucket(name=storage_url)
+# `db` and `bucket` are created on first access, so importing this module is
+# free and an entry point only loads the client it uses: the chatbot never
+# imports Firestore and its gRPC stack.
+_lock = threading.Lock()
+
+# Declared for `from firebase_utils import db`, only assigned on first access
+db: Any
+bucket: Any
+
+
+def _initialize_app():
+    import firebase_admin
+
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(options={"storageBucket": storage_url})
+
+
+def _create_client(name):
+    _initialize_app()
+    if name == "db":
+        from firebase_admin import firestore
+
+        return firestore.client()
+    from firebase_admin import storage
+
+    return storage.bucket(name=storage_url)
+
+
+def __getattr__(name):
+    if name not in ("db", "bucket"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _lock:
+        if name not in globals():
+            # Later lookups find the module global and skip __getattr__
+            globals()[name] = _create_client(name)
+    return globals()[name]
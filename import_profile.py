@@ -0,0 +1,180 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# Import-time profile of the entry points. Each one is imported in a fresh
+# interpreter with `python -X importtime`, the way a cold start would, and the
+# report shows the median import time and the packages it is spent in.
+# Run it with the functions' environment (see .env.yaml), the modules read it
+# when they are imported:
+#
+#   python import_profile.py                          print the report
+#   python import_profile.py --save profile.json      keep it, e.g. per release
+#   python import_profile.py --baseline profile.json  exit 1 on regressions
+
+# What each entry point in main.py imports on its first call
+ENTRY_POINTS = {
+    "main": "",
+    "index_documents": "from firebase_utils import db\n"
+    "from index_docs_fn import index_docs",
+    "chatbot": "from chatbot_fn import chatbot_fn, chatbot_stream_fn",
+    "chatbot_batch": "from chatbot_fn import chatbot_batch_fn",
+    "delete_doc_from_index": "from firebase_utils import db\n"
+    "from delete_doc_fn import delete_doc_fn",
+    "delete_docs_from_index": "from firebase_utils import db\n"
+    "from delete_doc_fn import delete_docs_fn",
+    "index_job": "from index_jobs import run_job, start_job",
+    "index_job_status": "from index_jobs import job_status",
+}
+TOP_PACKAGES = 10
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(stderr):
+    # Microseconds spent importing each top-level package, by its own code
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    return packages
+
+
+def profile_entry_point(code, runs):
+    wall_ms = []
+    import_ms = []
+    packages = {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import main\n{code}"],
+            capture_output=True,
+            text=True,
+            cwd=REPO_DIR,
+        )
+        wall_ms.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            errors = [
+                line
+                for line in result.stderr.splitlines()
+                if not line.startswith("import time:")
+            ]
+            return {"error": "\n".join(errors[-5:])}
+        run_packages = parse_importtime(result.stderr)
+        import_ms.append(sum(run_packages.values()) / 1000)
+        for package, us in run_packages.items():
+            packages.setdefault(package, []).append(us / 1000)
+
+    package_ms = {
+        package: round(statistics.median(times + [0.0] * (runs - len(times))), 1)
+        for package, times in packages.items()
+    }
+    top = sorted(package_ms.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "wall_ms": round(statistics.median(wall_ms), 1),
+        "import_ms": round(statistics.median(import_ms), 1),
+        "top_packages": dict(top[:TOP_PACKAGES]),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=REPO_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    print(
+        f"commit {report['commit']}, python {report['python']}, {report['runs']} runs"
+    )
+    for name, result in report["entry_points"].items():
+        if "error" in result:
+            print(f"\n{name}: failed\n{result['error']}")
+            continue
+        print(
+            f"\n{name}: {result['import_ms']:.0f} ms importing, "
+            f"{result['wall_ms']:.0f} ms wall"
+        )
+        for package, ms in result["top_packages"].items():
+            print(f"  {ms:8.1f} ms  {package}")
+
+
+def regressions(report, baseline, tolerance, min_ms):
+    found = []
+    for name, result in report["entry_points"].items():
+        before = baseline["entry_points"].get(name)
+        if not before or "error" in before or "error" in result:
+            continue
+        growth = result["import_ms"] - before["import_ms"]
+        if growth > min_ms and growth > before["import_ms"] * tolerance:
+            found.append(
+                f"{name}: {before['import_ms']:.0f} -> {result['import_ms']:.0f} ms"
+            )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Profile the import time of the Cloud Functions entry points"
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--entry-point", action="append", choices=ENTRY_POINTS)
+    parser.add_argument("--save", help="write the report to this JSON file")
+    parser.add_argument("--baseline", help="compare with a report saved before")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative growth of an import time counted as a regression",
+    )
+    parser.add_argument(
+        "--min-ms",
+        type=float,
+        default=50,
+        help="ignore growth below this many milliseconds",
+    )
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "runs": args.runs,
+        "created_at": time.time(),
+        "entry_points": {
+            name: profile_entry_point(ENTRY_POINTS[name], args.runs)
+            for name in args.entry_point or ENTRY_POINTS
+        },
+    }
+    print_report(report)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(report, baseline, args.tolerance, args.min_ms)
+        if found:
+            print("\nImport time regressions:\n  " + "\n  ".join(found))
+            sys.exit(1)
+        print(f"\nNo import time regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Memory budget for indices kept loaded on a warm instance, measured in blob bytes
+INDEX_CACHE_MAX_BYTES = int(os.getenv("INDEX_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class IndexCache:
+    """LRU registry of loaded indices, revalidated against the blob generation."""
+
+    def __init__(self, max_bytes=INDEX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        # (blob path, generation) -> Future of the load in progress
+        self._loading = {}
+
+    def get(self, blob, load_fn):
+        # `blob` comes from a metadata-only lookup, which is much cheaper than
+        # downloading the index again. load_fn(blob) returns (index, size).
+        key = (blob.name, blob.generation)
+        with self._lock:
+            entry = self._entries.get(blob.name)
+            if entry is not None and entry["generation"] == blob.generation:
+                self._entries.move_to_end(blob.name)
+                self.hits += 1
+                return entry["index"]
+            loading = self._loading.get(key)
+            if loading is None:
+                self.misses += 1
+                loading = self._loading[key] = Future()
+                load = True
+            else:
+                load = False
+
+        if not load:
+            # Another request is loading this generation, share its result
+            return loading.result()
+
+        try:
+            index, size = load_fn(blob)
+            self.put(blob.name, blob.generation, index, size)
+        except BaseException as e:
+            loading.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        loading.set_result(index)
+        print(f"{blob.name} (generation {blob.generation}) loaded into cache")
+        return index
+
+    def put(self, blob_path, generation, index, size):
+        with self._lock:
+            self._pop(blob_path)
+            if size > self.max_bytes:
+                # Too big to keep around, serve it once without caching
+                return
+            self._entries[blob_path] = {
+                "generation": generation,
+                "index": index,
+                "size": size,
+            }
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                evicted_path, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted["size"]
+                print(f"{evicted_path} evicted from index cache")
+
+    def _pop(self, blob_path):
+        entry = self._entries.pop(blob_path, None)
+        if entry is not None:
+            self._total_bytes -= entry["size"]
@@ -1,20 +1,37 @@
-from llama_index import (
-    GPTSimpleVectorIndex,
-    SimpleDirectoryReader,
-    LLMPredictor,
-    PromptHelper,
-    ServiceContext,
-)
-from langchain.chat_models import ChatOpenAI
-from firebase_admin import storage
+from llama_index import SimpleDirectoryReader
+from custom_class import CustomGPTSimpleVectorIndex
+from chunk_dedup import CHUNK_DEDUP, dedup_nodes
 import os
-from firebase_utils import db
+import firebase_utils
+from service_context import load_service_context
+from embedding_cache import EmbeddingCache
+from index_store import legacy_blob_path, manifest_blob_path
+from index_writer import index_writer
+from sentence_pruning import SENTENCE_EMBEDDINGS
+from tracing import current_context, span
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import unquote, urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import logging
-
-storage_url = os.getenv("FIREBASE_STORAGE_BUCKET_URL")
-docs_ref = db.collection("documents")
+import multiprocessing
+import shutil
+import tempfile
+import time
+
+# The Firebase clients are only created when used: the parse workers import
+# this module and must not start them
+
+# Number of files downloaded at the same time
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Worker processes for parsing downloaded files, 0 or 1 parses in-process
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "2"))
+# Firestore allows at most 500 writes in one batch
+FIRESTORE_BATCH_SIZE = 500
+download_session = None
+embedding_cache = None
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
@@ -22,31 +39,17 @@ logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
 def index_docs(files, index_name):
     try:
-        # Defining the parameters for the index
-        max_input_size = 4096
-        num_outputs = 1024
-        max_chunk_overlap = 20
-
-        prompt_helper = PromptHelper(
-            max_input_size,
-            num_outputs,
-            max_chunk_overlap,
-        )
-
-        llm_predictor = LLMPredictor(
-            llm=ChatOpenAI(
-                temperature=0.3, model_name="gpt-3.5-turbo", max_tokens=num_outputs
-            )
-        )
-
-        service_context = ServiceContext.from_defaults(
-            llm_predictor=llm_predictor, prompt_helper=prompt_helper
+        service_context = load_service_context(
+            temperature=0.3, embedding_cache=get_embedding_cache()
         )
 
         urls = [f["url"] for f in files]
-        documents = download_files_and_create_documents(urls)
-
-        print("documents:", documents)
+        with span("download_and_parse", files=len(urls)) as stage:
+            documents = download_files_and_create_documents(urls)
+            stage.set(
+                documents=len(documents),
+                characters=sum(len(document.text) for document in documents),
+            )
 
     except Exception as e:
         print("Error loading service context", e)
@@ -56,129 +59,263 @@ def index_docs(files, index_name):
         )
 
     try:
-        # Download the index.json file from Firebase Storage
-        bucket = storage.bucket(name=storage_url)
-        blob = bucket.blob(f"gptIndices/{index_name}.json")
-
-        # Check if the file exists in Firebase Storage
-        if blob.exists():
-            print(f"{index_name}.json exists in Firebase Storage")
-            index_json_data = blob.download_as_text()
-            index = GPTSimpleVectorIndex.load_from_string(
-                index_json_data, service_context=service_context
-            )
+        upload_documents(documents, index_name, service_context)
 
-            for doc in documents:
-                doc_id = doc.get_doc_id()
-                extra_info = doc.extra_info
-                url = extra_info["url"]
-
-                index.insert(doc, service_context=service_context)
-
-                for file in files:
-                    if file["url"] == url:
-                        document_id = file["id"]
-                        doc_ref = docs_ref.document(document_id)
-                        doc_ref.update(
-                            {
-                                "doc_id": doc_id,
-                                "indexed": True,
-                                "index_name": index_name,
-                                "index_path": f"gptIndices/{index_name}.json",
-                            }
-                        )
-                        break
-
-            # Serialize the index to a JSON string
-            index_json_data = index.save_to_string()
-
-            # Upload the JSON string to Firebase Storage
-            blob = bucket.blob(f"gptIndices/{index_name}.json")
-            blob.upload_from_string(index_json_data)
-
-            print(f"{index_name}.json saved to Firebase Storage")
-            return "Indexed successfully"
-
-        else:
-            print("File does not exist in Firebase Storage")
-            # Index file doesn't exist, so we'll create a new index from scratch
-
-            index = GPTSimpleVectorIndex.from_documents(
-                documents, service_context=service_context
-            )
-
-            for doc in documents:
-                doc_id = doc.get_doc_id()
-                extra_info = doc.extra_info
-                url = extra_info["url"]
-
-                for file in files:
-                    if file["url"] == url:
-                        document_id = file["id"]
-                        doc_ref = docs_ref.document(document_id)
-                        doc_ref.update(
-                            {
-                                "doc_id": doc_id,
-                                "indexed": True,
-                                "index_name": index_name,
-                                "index_path": f"gptIndices/{index_name}.json",
-                            }
-                        )
-                        break
-
-            # Serialize the index to a JSON string
-            index_json_data = index.save_to_string()
-
-            # Upload the JSON string to Firebase Storage
-            blob = bucket.blob(f"gptIndices/{index_name}.json")
-            blob.upload_from_string(index_json_data)
-
-            print(f"{index_name}.json saved to Firebase Storage")
-            return "Indexed successfully"
+        # Only after the upload, so a document is never marked indexed without it
+        mark_documents_indexed(files, documents, index_name)
+        return "Indexed successfully"
 
     except Exception as e:
         print("Error loading index.json:", e)
         return "Error loading index. Inform your developer", ""
 
 
-def download_files_and_create_documents(url_list, timeout=10):
-    documents = []
+def upload_documents(documents, index_name, service_context, replace=False):
+    # Bucket holding the indices
+    bucket = firebase_utils.bucket
 
-    for url in url_list:
-        # Extract the file name from the URL
-        url_path = urlparse(url).path
-        file_name = unquote(os.path.basename(url_path)).split("?")[0]
+    with span("chunk", documents=len(documents)) as stage:
+        nodes = service_context.node_parser.get_nodes_from_documents(documents)
+        stage.set(chunks=len(nodes))
 
-        # Get the portion of the file name after the '/'
-        file_name_after_slash = file_name.split("/")[-1]
+    if CHUNK_DEDUP:
+        # Repeated boilerplate is embedded and stored once for all its documents
+        with span("dedup", chunks=len(nodes)) as stage:
+            nodes, report = dedup_nodes(nodes)
+            stage.set(**report)
 
-        try:
-            # Download the file with a timeout
-            response = requests.get(url, timeout=timeout)
+    # Only the new documents are embedded, in a few large batches
+    index = CustomGPTSimpleVectorIndex(nodes=nodes, service_context=service_context)
+    for document in documents:
+        index.docstore.set_document_hash(document.get_doc_id(), document.get_doc_hash())
 
-            # Ensure the response is valid
+    if SENTENCE_EMBEDDINGS:
+        # Saved with the segment, the chatbot prunes retrieved chunks with them
+        with span("embed_sentences", chunks=len(nodes)) as stage:
+            sentences = index.sentence_store.add_chunks(
+                [node.get_text() for node in nodes], service_context.embed_model
+            )
+            stage.set(sentences=sentences)
+
+    # Uploaded as a new segment, the existing index isn't downloaded. A new
+    # index starts with these documents as its base. With replace, earlier
+    # copies of them are deleted in the same write: a job chunk redone after a
+    # crash may already have been stored.
+    replaces = [document.get_doc_id() for document in documents] if replace else ()
+    index_writer.append_segment(bucket, index_name, index, replaces=replaces)
+
+    flush_embedding_cache()
+    print(f"{index_name} saved to Firebase Storage")
+
+
+def indexed_documents(files, documents):
+    # [{"id": Firestore document id, "doc_id": index doc_id}] for the parsed files.
+    # First file wins when two share a URL, like the old nested loop.
+    files_by_url = {}
+    for file in files:
+        files_by_url.setdefault(file["url"], file)
+
+    indexed = []
+    for doc in documents:
+        file = files_by_url.get(doc.extra_info["url"])
+        if file is not None:
+            indexed.append({"id": file["id"], "doc_id": doc.get_doc_id()})
+    return indexed
+
+
+def set_documents_indexed(indexed, index_name):
+    db = firebase_utils.db
+    docs_ref = db.collection("documents")
+    with span("firestore_write", writes=len(indexed)) as stage:
+        for start in range(0, len(indexed), FIRESTORE_BATCH_SIZE):
+            batch = db.batch()
+            for document in indexed[start : start + FIRESTORE_BATCH_SIZE]:
+                fields = {
+                    "doc_id": document["doc_id"],
+                    "indexed": True,
+                    "index_name": index_name,
+                    # Kept as before for the clients that read it, the index
+                    # itself is now found through the manifest
+                    "index_path": legacy_blob_path(index_name),
+                    "manifest_path": manifest_blob_path(index_name),
+                }
+                batch.update(docs_ref.document(document["id"]), fields)
+            batch.commit()
+            stage.add(batches=1)
+
+
+def mark_documents_indexed(files, documents, index_name):
+    set_documents_indexed(indexed_documents(files, documents), index_name)
+
+
+def get_embedding_cache():
+    global embedding_cache
+    if embedding_cache is None:
+        # Kept across warm invocations, shards are only read once per instance
+        embedding_cache = EmbeddingCache(firebase_utils.bucket)
+    return embedding_cache
+
+
+def flush_embedding_cache():
+    # The index is already saved, a failed flush only costs re-embedding later
+    try:
+        get_embedding_cache().flush()
+    except Exception as e:
+        print("Error writing the embedding cache:", e)
+
+
+def get_download_session():
+    global download_session
+    if download_session is None:
+        # Shared across warm invocations, keeps connections to the file hosts open
+        session = requests.Session()
+        retries = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+        )
+        adapter = HTTPAdapter(
+            pool_connections=DOWNLOAD_WORKERS,
+            pool_maxsize=DOWNLOAD_WORKERS,
+            max_retries=retries,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        download_session = session
+    return download_session
+
+
+def get_file_name(url):
+    # Extract the file name from the URL
+    url_path = urlparse(url).path
+    file_name = unquote(os.path.basename(url_path)).split("?")[0]
+
+    # Get the portion of the file name after the '/'
+    return file_name.split("/")[-1]
+
+
+def download_file(url, file_dir, timeout=10, parent=None):
+    # Runs in a download thread, parent is the span of the caller
+    with span("download", parent=parent, url=url) as stage:
+        result = _download_file(url, file_dir, timeout)
+        stage.set(bytes=result.get("bytes", 0), status_code=result.get("status_code"))
+        stage.error = result.get("error")
+    return result
+
+
+def _download_file(url, file_dir, timeout):
+    file_name_after_slash = get_file_name(url)
+    result = {"url": url, "file_name": file_name_after_slash, "path": None}
+
+    try:
+        # Stream the body to disk instead of holding it in memory
+        with get_download_session().get(url, timeout=timeout, stream=True) as response:
+            result["status_code"] = response.status_code
             if response.status_code == 200:
-                # Save the file to the /tmp folder in Google Cloud Functions
-                tmp_file_path = f"/tmp/{file_name_after_slash}"
+                tmp_file_path = os.path.join(file_dir, file_name_after_slash)
+                size = 0
                 with open(tmp_file_path, "wb") as f:
-                    f.write(response.content)
-                    logging.info(
-                        f"Successfully downloaded {file_name_after_slash} to /tmp"
-                    )
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+                result["path"] = tmp_file_path
+                result["bytes"] = size
+            else:
+                result["error"] = f"HTTP {response.status_code}"
+    except requests.exceptions.RequestException as e:
+        result["error"] = str(e)
+
+    return result
+
+
+def parse_file(tmp_file_path, file_name, url, parent=None):
+    # Runs in a worker process, PDF parsing is CPU bound
+    with span(
+        "parse",
+        parent=parent,
+        file_name=file_name,
+        bytes=os.path.getsize(tmp_file_path),
+    ) as stage:
+        document = SimpleDirectoryReader(input_files=[tmp_file_path]).load_data()[0]
+        stage.set(characters=len(document.text))
+    document.doc_id = f"doc_id_{file_name}"
+    document.extra_info = {"url": url}
+    return document
+
+
+def start_parse_pool(num_files):
+    if PARSE_WORKERS <= 1 or num_files <= 1:
+        return None
+    try:
+        # Workers are forked from a fork server, a fresh single-threaded
+        # process started once per instance, never from this one: the download
+        # threads and the gRPC threads of the Firestore client don't survive a
+        # fork. The server imports this module once, so the workers start
+        # without importing llama_index again.
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        workers = min(PARSE_WORKERS, num_files)
+        parse_pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        # Started now, while the files download. One short job per worker makes
+        # Python 3.10 (which starts them on demand) start all of them.
+        warm_up = [parse_pool.submit(time.sleep, 0.05) for _ in range(workers)]
+        for future in warm_up:
+            future.result()
+        return parse_pool
+    except (OSError, NotImplementedError, ValueError) as e:
+        logging.warning(f"Parsing in-process, no process pool available: {e}")
+        return None
 
-                # Load the file and create a Document object
-                document = SimpleDirectoryReader(
-                    input_files=[tmp_file_path]
-                ).load_data()[0]
-                document.doc_id = f"doc_id_{file_name_after_slash}"
-                document.extra_info = {"url": url}
-                documents.append(document)
 
-            else:
-                logging.error(
-                    f"Failed to download {file_name_after_slash}: {response.status_code}"
+def download_files_and_create_documents(url_list, timeout=10):
+    # Pipeline: each file is handed to the parse pool as soon as its download
+    # finishes, while the other downloads are still running
+    parse_pool = start_parse_pool(len(url_list))
+    parse_futures = {}
+    parent = current_context()
+
+    # Save the files to the /tmp folder in Google Cloud Functions, one directory
+    # per URL because different URLs can share a file name
+    download_dir = tempfile.mkdtemp(prefix="downloads_", dir="/tmp")
+    try:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as download_pool:
+            download_futures = {}
+            for position, url in enumerate(url_list):
+                file_dir = os.path.join(download_dir, str(position))
+                os.makedirs(file_dir)
+                future = download_pool.submit(
+                    download_file, url, file_dir, timeout, parent
                 )
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error downloading {file_name_after_slash}: {e}")
+                download_futures[future] = position
+
+            for future in as_completed(download_futures):
+                result = future.result()
+                if result["path"] is None:
+                    continue
+                args = (result["path"], result["file_name"], result["url"], parent)
+                if parse_pool is not None:
+                    parse_futures[download_futures[future]] = parse_pool.submit(
+                        parse_file, *args
+                    )
+                else:
+                    parse_futures[download_futures[future]] = args
+
+        # Collect in url_list order so documents and doc_ids are deterministic
+        documents = []
+        for position in sorted(parse_futures):
+            parse_job = parse_futures[position]
+            try:
+                if parse_pool is not None:
+                    documents.append(parse_job.result())
+                else:
+                    documents.append(parse_file(*parse_job))
+            except Exception as e:
+                # The document stays unindexed and is picked up by the next run
+                logging.error(f"Error parsing {url_list[position]}: {e}")
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown(cancel_futures=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
 
     return documents
@@ -0,0 +1,289 @@
+import os
+import time
+import uuid
+from firebase_admin import firestore
+from firebase_utils import db
+from index_docs_fn import (
+    download_files_and_create_documents,
+    get_embedding_cache,
+    indexed_documents,
+    set_documents_indexed,
+    upload_documents,
+)
+from service_context import load_service_context
+
+# A job indexes the `indexed == False` backlog a chunk at a time. Every chunk
+# is its own segment and is checkpointed in indexJobs/{job_id}, so a run that
+# times out or crashes is resumed by calling run_job again.
+# The backlog is shared by every job, so only the job holding the backlog lease
+# works on it, and starting a job for an index that has an unfinished one
+# continues that job.
+jobs_ref = db.collection("indexJobs")
+docs_ref = db.collection("documents")
+backlog_lease_ref = db.collection("indexJobLeases").document("backlog")
+
+JOB_CHUNK_SIZE = int(os.getenv("JOB_CHUNK_SIZE", "50"))
+# Seconds of work per invocation, below the function timeout (540s max)
+JOB_TIME_BUDGET = float(os.getenv("JOB_TIME_BUDGET", "420"))
+# Another invocation may take over a job whose runner stopped renewing this
+JOB_LEASE_SECONDS = JOB_TIME_BUDGET + 120
+# Documents that failed to download or parse are skipped for the rest of the job
+MAX_FAILED_IDS = 1000
+
+
+def start_job(index_name, chunk_size=JOB_CHUNK_SIZE):
+    unfinished = (
+        jobs_ref.where("index_name", "==", index_name)
+        .where("status", "in", ["pending", "running", "paused", "error"])
+        .limit(1)
+    )
+    for snapshot in unfinished.stream():
+        print(f"Continuing indexing job {snapshot.id} for {index_name}")
+        return snapshot.id
+
+    job_ref = jobs_ref.document()
+    job_ref.set(
+        {
+            "index_name": index_name,
+            "status": "pending",
+            "chunk_size": chunk_size,
+            "documents_done": 0,
+            "documents_failed": 0,
+            "failed_ids": [],
+            "chunks_done": 0,
+            "seconds_spent": 0.0,
+            "checkpoint": None,
+            "last_error": None,
+            "lease_until": 0,
+            "created_at": time.time(),
+            "updated_at": time.time(),
+        }
+    )
+    print(f"Started indexing job {job_ref.id} for {index_name}")
+    return job_ref.id
+
+
+@firestore.transactional
+def _acquire_lease(transaction, job_ref, runner):
+    snapshot = job_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    backlog_lease = backlog_lease_ref.get(transaction=transaction)
+    job = snapshot.to_dict()
+    now = time.time()
+    if job["status"] == "done" or job["lease_until"] > now:
+        return None
+    if (
+        backlog_lease.exists
+        and backlog_lease.get("job_id") != job_ref.id
+        and backlog_lease.get("lease_until") > now
+    ):
+        # Another job is working on the backlog
+        return None
+    lease = {
+        "status": "running",
+        "runner": runner,
+        "lease_until": now + JOB_LEASE_SECONDS,
+        "updated_at": now,
+    }
+    transaction.update(job_ref, lease)
+    transaction.set(
+        backlog_lease_ref,
+        {"job_id": job_ref.id, "runner": runner, "lease_until": lease["lease_until"]},
+    )
+    job.update(lease)
+    return job
+
+
+@firestore.transactional
+def _update_lease(transaction, job_ref, runner, fields):
+    # Renews the lease of the job and of the backlog, or releases them with
+    # lease_until 0. The backlog lease is left alone if it expired and another
+    # job took it.
+    backlog_lease = backlog_lease_ref.get(transaction=transaction)
+    transaction.update(job_ref, fields)
+    if backlog_lease.exists and backlog_lease.get("runner") == runner:
+        transaction.update(backlog_lease_ref, {"lease_until": fields["lease_until"]})
+
+
+def run_job(job_id, time_budget=JOB_TIME_BUDGET):
+    # Returns the job status. Jobs that are done or running elsewhere are
+    # left alone.
+    job_ref = jobs_ref.document(job_id)
+    runner = uuid.uuid4().hex
+    job = _acquire_lease(db.transaction(), job_ref, runner)
+    if job is None:
+        return job_status(job_id)
+
+    deadline = time.monotonic() + time_budget
+    service_context = load_service_context(
+        temperature=0.3, embedding_cache=get_embedding_cache()
+    )
+    status = "paused"
+    try:
+        if job["checkpoint"]:
+            _resume_checkpoint(job_ref, job, service_context)
+
+        while True:
+            # Don't start a chunk that probably won't finish in time
+            expected = _seconds_per_chunk(job) * 1.5
+            if time.monotonic() + expected > deadline:
+                break
+            files = _next_chunk(job)
+            if not files:
+                status = "done"
+                break
+            _process_chunk(job_ref, job, files, service_context)
+            _update_lease(
+                db.transaction(),
+                job_ref,
+                runner,
+                {"lease_until": time.time() + JOB_LEASE_SECONDS},
+            )
+
+        _update_lease(
+            db.transaction(),
+            job_ref,
+            runner,
+            {"status": status, "lease_until": 0, "updated_at": time.time()},
+        )
+    except Exception as e:
+        print(f"Indexing job {job_id} stopped:", e)
+        _update_lease(
+            db.transaction(),
+            job_ref,
+            runner,
+            {
+                "status": "error",
+                "last_error": str(e),
+                "lease_until": 0,
+                "updated_at": time.time(),
+            },
+        )
+    return job_status(job_id)
+
+
+def _next_chunk(job):
+    failed_ids = set(job["failed_ids"])
+    query = docs_ref.where("indexed", "==", False).limit(
+        job["chunk_size"] + len(failed_ids)
+    )
+    files = [
+        {"id": doc.id, **doc.to_dict()}
+        for doc in query.stream()
+        if doc.id not in failed_ids
+    ]
+    return files[: job["chunk_size"]]
+
+
+def _process_chunk(job_ref, job, files, service_context, replace=False):
+    start = time.perf_counter()
+    document_ids = [file["id"] for file in files]
+    _checkpoint(job_ref, job, {"stage": "indexing", "document_ids": document_ids})
+
+    documents = download_files_and_create_documents([file["url"] for file in files])
+    if documents:
+        upload_documents(documents, job["index_name"], service_context, replace=replace)
+    indexed = indexed_documents(files, documents)
+    # Uploaded: a resumed run only has to mark these documents
+    _checkpoint(
+        job_ref,
+        job,
+        {"stage": "uploaded", "document_ids": document_ids, "indexed": indexed},
+    )
+    set_documents_indexed(indexed, job["index_name"])
+
+    indexed_ids = {document["id"] for document in indexed}
+    failed = [i for i in document_ids if i not in indexed_ids]
+    job["failed_ids"] = (job["failed_ids"] + failed)[-MAX_FAILED_IDS:]
+    job["documents_done"] += len(indexed)
+    job["documents_failed"] += len(failed)
+    job["chunks_done"] += 1
+    job["seconds_spent"] += time.perf_counter() - start
+    job["checkpoint"] = None
+    job_ref.update(
+        {
+            key: job[key]
+            for key in (
+                "failed_ids",
+                "documents_done",
+                "documents_failed",
+                "chunks_done",
+                "seconds_spent",
+                "checkpoint",
+            )
+        }
+    )
+    print(
+        f"Job chunk {job['chunks_done']}: {len(indexed)} indexed, "
+        f"{len(failed)} failed in {time.perf_counter() - start:.1f}s"
+    )
+
+
+def _checkpoint(job_ref, job, checkpoint):
+    job["checkpoint"] = checkpoint
+    job_ref.update({"checkpoint": checkpoint, "updated_at": time.time()})
+
+
+def _resume_checkpoint(job_ref, job, service_context):
+    checkpoint = job["checkpoint"]
+    print(f"Resuming from a {checkpoint['stage']} checkpoint")
+    if checkpoint["stage"] == "uploaded":
+        # The segment is stored, only the status updates are missing
+        set_documents_indexed(checkpoint["indexed"], job["index_name"])
+        job["documents_done"] += len(checkpoint["indexed"])
+        job["chunks_done"] += 1
+        job_ref.update(
+            {"documents_done": job["documents_done"], "chunks_done": job["chunks_done"]}
+        )
+        _checkpoint(job_ref, job, None)
+        return
+
+    # An "indexing" chunk is still unindexed in Firestore, but its segment may
+    # have been committed before the run stopped. It is redone as a
+    # replacement, so its documents don't end up in the index twice.
+    files = _unindexed_files(checkpoint["document_ids"])
+    if files:
+        _process_chunk(job_ref, job, files, service_context, replace=True)
+    else:
+        _checkpoint(job_ref, job, None)
+
+
+def _unindexed_files(document_ids):
+    files = {}
+    for snapshot in db.get_all([docs_ref.document(i) for i in document_ids]):
+        data = snapshot.to_dict()
+        if data is not None and not data.get("indexed"):
+            files[snapshot.id] = {"id": snapshot.id, **data}
+    return [files[i] for i in document_ids if i in files]
+
+
+def _seconds_per_chunk(job):
+    if not job["chunks_done"]:
+        return 0.0
+    return job["seconds_spent"] / job["chunks_done"]
+
+
+def job_status(job_id):
+    snapshot = jobs_ref.document(job_id).get()
+    if not snapshot.exists:
+        return None
+    job = snapshot.to_dict()
+    seconds = job["seconds_spent"]
+    return {
+        "job_id": job_id,
+        "index_name": job["index_name"],
+        "status": job["status"],
+        "documents_done": job["documents_done"],
+        "documents_failed": job["documents_failed"],
+        "chunks_done": job["chunks_done"],
+        "seconds_spent": round(seconds, 1),
+        "documents_per_minute": (
+            round(job["documents_done"] * 60 / seconds, 1) if seconds else 0.0
+        ),
+        "seconds_per_chunk": round(_seconds_per_chunk(job), 1),
+        "checkpoint": job["checkpoint"] and job["checkpoint"]["stage"],
+        "last_error": job["last_error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
@@ -0,0 +1,793 @@
+import argparse
+import glob
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import uuid
+import numpy as np
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from ann_index import ANN_MIN_ROWS, ANN_NPROBE, IVFIndex, recall_report
+from compression import decode_json, download_json, encode_json
+from custom_class import CustomGPTSimpleVectorIndex
+from numpy_vector_store import NumpyVectorStore, normalize_rows
+from sentence_pruning import SentenceStore
+from tracing import span
+
+# Indices are stored as two blobs: the embeddings as a contiguous float32 .npy
+# array that can be memory-mapped, and a compact JSON sidecar holding the index
+# struct, the docstore and the row order of the embeddings. The sidecar is
+# compressed (see compression.py), the embeddings stay mappable.
+# Since format 2 the rows are stored unit-length with their norms in the
+# sidecar, so NumpyVectorStore can search the mapped array directly.
+# Legacy indices saved with save_to_string() are still read from {name}.json.
+#
+# An index is a base pair plus append-only segments ({name}.seg-*), each a
+# complete pair holding the documents of one update. The manifest
+# {name}.manifest.json lists them, pinned to their generations, along with
+# tombstones: documents deleted since the last compaction, dropped at load time.
+# Readers try the manifest, then a bare pair, then the legacy JSON.
+# A pair can have a third blob, {name}.sentences.npy, with the float16 sentence
+# embeddings of its chunks (see sentence_pruning.py), mapped like the embeddings.
+#
+# Bases and segments get unique names and are never overwritten. The manifest
+# is only replaced if its generation is still the one the writer read, a
+# writer that lost the race applies its changes to the new manifest instead.
+INDEX_PREFIX = "gptIndices"
+FORMAT_VERSION = 2
+MANIFEST_VERSION = 1
+LOCAL_INDEX_DIR = "/tmp/gptIndices"
+# Appending beyond this many segments compacts the index into a new base
+INDEX_MAX_SEGMENTS = int(os.getenv("INDEX_MAX_SEGMENTS", "16"))
+# Same for deleted documents waiting to be removed from the blobs
+INDEX_MAX_TOMBSTONES = int(os.getenv("INDEX_MAX_TOMBSTONES", "1000"))
+# Attempts at replacing the manifest before an update gives up
+MANIFEST_RETRIES = 10
+
+
+def base_name(index_name):
+    # chatbot callers pass "name.json", index_docs passes "name"
+    if index_name.endswith(".json"):
+        return index_name[: -len(".json")]
+    return index_name
+
+
+def meta_blob_path(index_name):
+    return f"{INDEX_PREFIX}/{base_name(index_name)}.meta.json"
+
+
+def embeddings_blob_path(index_name):
+    return f"{INDEX_PREFIX}/{base_name(index_name)}.npy"
+
+
+def sentences_blob_path(index_name):
+    return f"{INDEX_PREFIX}/{base_name(index_name)}.sentences.npy"
+
+
+def legacy_blob_path(index_name):
+    return f"{INDEX_PREFIX}/{base_name(index_name)}.json"
+
+
+def ann_blob_path(index_name):
+    return f"{INDEX_PREFIX}/{base_name(index_name)}.ivf.npz"
+
+
+def manifest_blob_path(index_name):
+    return f"{INDEX_PREFIX}/{base_name(index_name)}.manifest.json"
+
+
+def segment_name(index_name):
+    return f"{base_name(index_name)}.seg-{uuid.uuid4().hex[:12]}"
+
+
+def new_base_name(index_name):
+    return f"{base_name(index_name)}.base-{uuid.uuid4().hex[:12]}"
+
+
+def segment_sequence(segment):
+    # Segments written before the sequence was stored carry it in their name
+    if "sequence" in segment:
+        return segment["sequence"]
+    return int(segment["name"].rsplit(".seg", 1)[1])
+
+
+def dict_to_binary(index_dict):
+    vector_store = index_dict["vector_store"]
+    data = vector_store["__data__"]["simple_vector_store_data_dict"]
+    embedding_dict = data["embedding_dict"]
+
+    ids = list(embedding_dict.keys())
+    if ids:
+        embeddings, norms = normalize_rows([embedding_dict[i] for i in ids])
+    else:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+        norms = np.zeros(0, dtype=np.float32)
+
+    text_id_to_doc_id = data["text_id_to_doc_id"]
+    return embeddings, _build_meta(
+        index_dict,
+        vector_store["__type__"],
+        ids,
+        [text_id_to_doc_id[i] for i in ids],
+        norms,
+    )
+
+
+def _build_meta(index_dict, vector_store_type, ids, doc_ids, norms):
+    return {
+        "format_version": FORMAT_VERSION,
+        "index_struct": index_dict["index_struct"],
+        "docstore": index_dict["docstore"],
+        "vector_store_type": vector_store_type,
+        "ids": ids,
+        "text_id_to_doc_id": dict(zip(ids, doc_ids)),
+        "norms": np.asarray(norms, dtype=np.float32).tolist(),
+    }
+
+
+def _raw_embeddings(embeddings, meta):
+    embeddings = np.asarray(embeddings)
+    if "norms" not in meta:
+        # Format 1 stored the embeddings as they came from the model
+        return embeddings
+    return embeddings * np.asarray(meta["norms"], dtype=np.float32)[:, None]
+
+
+def binary_to_dict(embeddings, meta):
+    embedding_dict = dict(zip(meta["ids"], _raw_embeddings(embeddings, meta).tolist()))
+    return {
+        "index_struct": meta["index_struct"],
+        "docstore": meta["docstore"],
+        "vector_store": {
+            "__type__": meta["vector_store_type"],
+            "__data__": {
+                "simple_vector_store_data_dict": {
+                    "embedding_dict": embedding_dict,
+                    "text_id_to_doc_id": meta["text_id_to_doc_id"],
+                }
+            },
+        },
+    }
+
+
+def json_to_binary(index_json_data):
+    return dict_to_binary(json.loads(index_json_data))
+
+
+def binary_to_json(embeddings, meta):
+    return json.dumps(binary_to_dict(embeddings, meta))
+
+
+def index_to_binary(index):
+    if not isinstance(index, CustomGPTSimpleVectorIndex):
+        return dict_to_binary(index.save_to_dict())
+
+    # Take the matrix as it is instead of going through lists of floats
+    index_dict = index.save_to_dict(include_vector_store=False)
+    ids, doc_ids, embeddings, norms = index.vector_store.to_arrays()
+    if not ids:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+    return embeddings, _build_meta(index_dict, "simple", ids, doc_ids, norms)
+
+
+def index_from_binary(embeddings, meta, index_cls, **kwargs):
+    if not issubclass(index_cls, CustomGPTSimpleVectorIndex):
+        return index_cls.load_from_dict(binary_to_dict(embeddings, meta), **kwargs)
+
+    ids = meta["ids"]
+    text_id_to_doc_id = meta["text_id_to_doc_id"]
+    vector_store = NumpyVectorStore.from_arrays(
+        ids,
+        [text_id_to_doc_id[i] for i in ids],
+        embeddings,
+        norms=meta.get("norms"),
+    )
+    index_dict = {"index_struct": meta["index_struct"], "docstore": meta["docstore"]}
+    return index_cls.load_from_dict(index_dict, vector_store=vector_store, **kwargs)
+
+
+def dumps_meta(meta):
+    return json.dumps(meta, separators=(",", ":"))
+
+
+def embeddings_to_bytes(embeddings):
+    return embeddings_to_file(embeddings).getvalue()
+
+
+def embeddings_to_file(embeddings):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(embeddings, dtype=np.float32))
+    return buffer
+
+
+def get_index_blob(bucket, index_name):
+    # The manifest and the sidecar are written last, so they mark a complete index
+    for blob_path in (
+        manifest_blob_path(index_name),
+        meta_blob_path(index_name),
+        legacy_blob_path(index_name),
+    ):
+        blob = bucket.get_blob(blob_path)
+        if blob is not None:
+            return blob
+    raise FileNotFoundError(
+        f"{base_name(index_name)} does not exist in Firebase Storage"
+    )
+
+
+def index_exists(bucket, index_name):
+    return (
+        bucket.blob(manifest_blob_path(index_name)).exists()
+        or bucket.blob(meta_blob_path(index_name)).exists()
+        or bucket.blob(legacy_blob_path(index_name)).exists()
+    )
+
+
+def load_index(bucket, index_name, index_cls, **kwargs):
+    return load_index_from_blob(
+        bucket, get_index_blob(bucket, index_name), index_cls, **kwargs
+    )[0]
+
+
+def load_index_from_blob(bucket, blob, index_cls, **kwargs):
+    # Returns the index and its size in bytes, uncompressed
+    name = os.path.basename(blob.name)
+    if name.endswith(".manifest.json"):
+        return _load_manifest_index(bucket, blob, index_cls, **kwargs)
+    if name.endswith(".meta.json"):
+        return _load_binary(
+            bucket, name[: -len(".meta.json")], blob.generation, index_cls, **kwargs
+        )
+
+    # The JSON text is already released when the index is built from the dict
+    with span("index_load", blob=blob.name) as stage:
+        index_dict, size = download_json(blob, blob.generation)
+        stage.set(bytes=size)
+    with span("index_parse", blob=blob.name):
+        return index_cls.load_from_dict(index_dict, **kwargs), size
+
+
+def _load_manifest_index(bucket, blob, index_cls, **kwargs):
+    index_name = os.path.basename(blob.name)[: -len(".manifest.json")]
+    for attempt in range(MANIFEST_RETRIES):
+        try:
+            manifest_data = blob.download_as_bytes(if_generation_match=blob.generation)
+            manifest = json.loads(manifest_data)
+            index, size = _load_manifest(bucket, manifest, index_cls, **kwargs)
+            break
+        except (NotFound, PreconditionFailed):
+            # Replaced since the lookup, and a compaction may have deleted the
+            # blobs it listed. The current manifest lists the new ones.
+            print(f"{index_name} was updated while loading, reloading")
+            blob = bucket.get_blob(blob.name)
+            if blob is None:
+                raise FileNotFoundError(
+                    f"{index_name} does not exist in Firebase Storage"
+                )
+            _backoff(attempt)
+    else:
+        raise RuntimeError(
+            f"Gave up loading {index_name} after {MANIFEST_RETRIES} attempts"
+        )
+    _prune_local_copies(
+        index_name,
+        [manifest["base"]["name"]] + [s["name"] for s in manifest["segments"]],
+    )
+    return index, size + len(manifest_data)
+
+
+def _load_manifest(bucket, manifest, index_cls, **kwargs):
+    base = manifest["base"]
+    # doc_id -> next_segment at deletion, later segments may index it again
+    tombstones = manifest.get("tombstones", {})
+    index, size = _load_binary(
+        bucket, base["name"], base["meta_generation"], index_cls, **kwargs
+    )
+    index.apply_tombstones(tombstones)
+    for segment in manifest["segments"]:
+        segment_index, segment_size = _load_binary(
+            bucket, segment["name"], segment["meta_generation"], index_cls, **kwargs
+        )
+        sequence = segment_sequence(segment)
+        segment_index.apply_tombstones(
+            [doc_id for doc_id, before in tombstones.items() if sequence < before]
+        )
+        index.merge_index(segment_index)
+        size += segment_size
+    return index, size
+
+
+def _load_binary(bucket, name, meta_generation, index_cls, **kwargs):
+    with span("index_load", blob=name) as stage:
+        meta, meta_size = download_json(
+            bucket.blob(meta_blob_path(name)), meta_generation
+        )
+        embeddings, embeddings_size = _download_embeddings(
+            bucket, name, meta.get("embeddings_generation")
+        )
+        stage.set(bytes=meta_size + embeddings_size, rows=len(embeddings))
+    with span("index_parse", blob=name):
+        index = index_from_binary(embeddings, meta, index_cls, **kwargs)
+    size = meta_size + embeddings_size
+
+    if "ann" in meta and isinstance(index, CustomGPTSimpleVectorIndex):
+        with span("index_load", blob=ann_blob_path(name)) as stage:
+            ann_data = bucket.blob(ann_blob_path(name)).download_as_bytes(
+                if_generation_match=meta["ann"]["generation"]
+            )
+            stage.set(bytes=len(ann_data))
+        index.vector_store.attach_ann(IVFIndex.from_bytes(ann_data))
+        size += len(ann_data)
+
+    if "sentences" in meta and isinstance(index, CustomGPTSimpleVectorIndex):
+        with span("index_load", blob=sentences_blob_path(name)) as stage:
+            sentences, sentences_size = _download_array(
+                bucket.blob(sentences_blob_path(name)),
+                f"{name}.sentences",
+                meta["sentences"]["generation"],
+            )
+            stage.set(bytes=sentences_size, rows=len(sentences))
+        index.sentence_store = SentenceStore.from_arrays(
+            sentences, meta["sentences"]["chunks"]
+        )
+        size += sentences_size
+    return index, size
+
+
+def _download_embeddings(bucket, name, generation):
+    blob = bucket.blob(embeddings_blob_path(name))
+    if generation is None:
+        # Sidecar produced by the converter and uploaded by hand
+        blob.reload()
+        generation = blob.generation
+    return _download_array(blob, name, generation)
+
+
+def _download_array(blob, local_name, generation):
+    os.makedirs(LOCAL_INDEX_DIR, exist_ok=True)
+    local_path = f"{LOCAL_INDEX_DIR}/{local_name}-{generation}.npy"
+    if not os.path.exists(local_path):
+        # /tmp is memory backed, so drop older generations of this array first.
+        # Anchored, "foo" must not match the copies of "foo-bar".
+        stale = re.compile(re.escape(local_name) + r"-\d+\.npy")
+        for stale_path in glob.glob(
+            f"{LOCAL_INDEX_DIR}/{glob.escape(local_name)}-*.npy"
+        ):
+            filename = os.path.basename(stale_path)
+            if stale_path != local_path and stale.fullmatch(filename):
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    pass
+        # A temp file of its own, requests loading the same index at once
+        # each download and the last replace wins
+        fd, tmp_path = tempfile.mkstemp(dir=LOCAL_INDEX_DIR, suffix=".part")
+        os.close(fd)
+        try:
+            blob.download_to_filename(tmp_path, if_generation_match=generation)
+            os.replace(tmp_path, local_path)
+        except FileNotFoundError:
+            if not os.path.exists(local_path):
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    array = np.load(local_path, mmap_mode="r")
+    return array, os.path.getsize(local_path)
+
+
+def _prune_local_copies(index_name, keep):
+    # Every compaction and update writes blobs under new names, so copies of
+    # bases and segments the manifest no longer lists are dropped from /tmp
+    name = base_name(index_name)
+    pattern = re.compile(
+        "(?P<name>"
+        + re.escape(name)
+        + r"(\.(seg|base)-[0-9a-f]+|\.seg\d+)?)(\.sentences)?-\d+\.npy"
+    )
+    for path in glob.glob(f"{LOCAL_INDEX_DIR}/{glob.escape(name)}*.npy"):
+        match = pattern.fullmatch(os.path.basename(path))
+        if match and match.group("name") not in keep:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def read_manifest(bucket, index_name):
+    return _read_manifest_for_update(bucket, index_name)[0]
+
+
+def _read_manifest_for_update(bucket, index_name):
+    # Returns the manifest and its generation. A bare pair gets a manifest with
+    # generation 0 (doesn't exist yet), a legacy JSON index or none at all None.
+    for attempt in range(MANIFEST_RETRIES):
+        manifest_blob = bucket.get_blob(manifest_blob_path(index_name))
+        if manifest_blob is None:
+            break
+        try:
+            manifest_data = manifest_blob.download_as_bytes(
+                if_generation_match=manifest_blob.generation
+            )
+            return json.loads(manifest_data), manifest_blob.generation
+        except (NotFound, PreconditionFailed):
+            # Replaced between the lookup and the download, read the new one
+            _backoff(attempt)
+    else:
+        raise RuntimeError(
+            f"Gave up reading the manifest of {base_name(index_name)} "
+            f"after {MANIFEST_RETRIES} attempts"
+        )
+    base_meta_blob = bucket.get_blob(meta_blob_path(index_name))
+    if base_meta_blob is not None:
+        return _new_manifest(index_name, base_meta_blob.generation), 0
+    return None, 0
+
+
+def _new_manifest(index_name, meta_generation, next_segment=1):
+    return {
+        "format_version": MANIFEST_VERSION,
+        "base": {"name": base_name(index_name), "meta_generation": meta_generation},
+        "segments": [],
+        "tombstones": {},
+        "next_segment": next_segment,
+    }
+
+
+def _write_manifest(bucket, index_name, manifest, generation):
+    # Fails with PreconditionFailed if another writer replaced the manifest
+    # since it was read, generation 0 if one was created
+    manifest_blob = bucket.blob(manifest_blob_path(index_name))
+    manifest_data = dumps_meta(manifest)
+    with span("upload", blob=manifest_blob.name, bytes=len(manifest_data)):
+        manifest_blob.upload_from_string(
+            manifest_data,
+            content_type="application/json",
+            if_generation_match=generation,
+        )
+    return manifest_blob
+
+
+def _backoff(attempt):
+    # GCS allows about one write per second to the same object
+    time.sleep(random.uniform(0, min(2.0, 0.1 * 2**attempt)))
+
+
+def update_index(bucket, index_name, changes, index_cls, **kwargs):
+    # Applies ("insert", segment_index) and ("delete", doc_ids) changes, in
+    # order, with a single segment upload and manifest write. Creates the index
+    # if it doesn't exist yet.
+    segment, doc_ids = _coalesce_changes(changes)
+    if segment is None and not doc_ids:
+        return None
+
+    segment_entry = None
+    for attempt in range(MANIFEST_RETRIES):
+        manifest, generation = _read_manifest_for_update(bucket, index_name)
+        try:
+            if manifest is None:
+                manifest_blob = _create_index(
+                    bucket, index_name, segment, doc_ids, index_cls, **kwargs
+                )
+                if segment_entry is not None:
+                    _delete_binary(bucket, segment_entry["name"])
+                return manifest_blob
+
+            if segment is not None and segment_entry is None:
+                # Uploaded once, a retry only writes the manifest again
+                segment_entry = _save_segment(bucket, index_name, segment)
+            _add_changes(manifest, segment_entry, doc_ids)
+            manifest_blob = _write_manifest(bucket, index_name, manifest, generation)
+            break
+        except PreconditionFailed:
+            print(f"{base_name(index_name)} was updated concurrently, retrying")
+            _backoff(attempt)
+    else:
+        if segment_entry is not None:
+            _delete_binary(bucket, segment_entry["name"])
+        raise RuntimeError(
+            f"Gave up updating {base_name(index_name)} after {MANIFEST_RETRIES} attempts"
+        )
+
+    if segment_entry is not None:
+        print(f"{segment_entry['name']} appended to {base_name(index_name)}")
+    if doc_ids:
+        print(f"{len(doc_ids)} documents deleted from {base_name(index_name)}")
+
+    if (
+        len(manifest["segments"]) > INDEX_MAX_SEGMENTS
+        or len(manifest["tombstones"]) > INDEX_MAX_TOMBSTONES
+    ):
+        # The changes are committed at this point, a failed compaction is
+        # retried by the next update and mustn't make the caller redo them
+        try:
+            return (
+                compact_index(bucket, index_name, index_cls, **kwargs) or manifest_blob
+            )
+        except Exception as e:
+            print(f"Compacting {base_name(index_name)} failed: {e}")
+    return manifest_blob
+
+
+def _coalesce_changes(changes):
+    # Returns one segment with every inserted document and the deleted doc_ids.
+    # A delete also removes the documents inserted before it from the segment.
+    # Its tombstone only hides older segments, so a later insert is kept.
+    segment = None
+    doc_ids = []
+    for kind, value in changes:
+        if kind == "insert":
+            if segment is None:
+                segment = value
+            else:
+                segment.merge_index(value)
+        else:
+            if segment is not None:
+                segment.apply_tombstones(value)
+            doc_ids.extend(value)
+    if segment is not None and segment.vector_store.num_nodes == 0:
+        segment = None
+    return segment, list(dict.fromkeys(doc_ids))
+
+
+def _save_segment(bucket, index_name, segment):
+    # Only the new documents are written, the cost doesn't grow with the index
+    name = segment_name(index_name)
+    meta_blob = _save_binary(bucket, name, segment, build_ann=False)
+    return {
+        "name": name,
+        "meta_generation": meta_blob.generation,
+        "num_rows": segment.vector_store.num_nodes,
+    }
+
+
+def _add_changes(manifest, segment_entry, doc_ids):
+    tombstones = manifest.setdefault("tombstones", {})
+    for doc_id in doc_ids:
+        tombstones[doc_id] = manifest["next_segment"]
+    if segment_entry is not None:
+        manifest["segments"].append(
+            dict(segment_entry, sequence=manifest["next_segment"])
+        )
+        manifest["next_segment"] += 1
+
+
+def _create_index(bucket, index_name, segment, doc_ids, index_cls, **kwargs):
+    # First manifest of an index: a legacy JSON index is converted to a binary
+    # base, otherwise the inserted documents become the base
+    legacy_blob = bucket.get_blob(legacy_blob_path(index_name))
+    if legacy_blob is not None:
+        index, _ = load_index_from_blob(bucket, legacy_blob, index_cls, **kwargs)
+        index.apply_tombstones(doc_ids)
+        if segment is not None:
+            index.merge_index(segment)
+    elif segment is not None:
+        index = segment
+    else:
+        print(f"{base_name(index_name)} does not exist, nothing to delete")
+        return None
+    return _commit_base(bucket, index_name, index, None, 0)
+
+
+def _commit_base(bucket, index_name, index, snapshot, generation):
+    # Saves `index`, loaded from the manifest `snapshot` (None when creating
+    # the manifest), as the new base. Segments and tombstones added meanwhile
+    # aren't part of it and are carried over. Returns None if another writer
+    # replaced the base first.
+    name = new_base_name(index_name)
+    meta_blob = _save_binary(bucket, name, index)
+    manifest = _new_manifest(
+        name, meta_blob.generation, snapshot["next_segment"] if snapshot else 1
+    )
+    current = snapshot
+    for attempt in range(MANIFEST_RETRIES):
+        if current is not None:
+            manifest["segments"] = [
+                s for s in current["segments"] if s not in snapshot["segments"]
+            ]
+            manifest["tombstones"] = {
+                doc_id: before
+                for doc_id, before in current["tombstones"].items()
+                if snapshot["tombstones"].get(doc_id) != before
+            }
+            manifest["next_segment"] = current["next_segment"]
+        try:
+            manifest_blob = _write_manifest(bucket, index_name, manifest, generation)
+            break
+        except PreconditionFailed:
+            if snapshot is None:
+                # Another writer created the index, update_index starts over
+                _delete_binary(bucket, name)
+                raise
+            current, generation = _read_manifest_for_update(bucket, index_name)
+            if current is None or current["base"] != snapshot["base"]:
+                print(f"{base_name(index_name)} was compacted concurrently")
+                _delete_binary(bucket, name)
+                return None
+            _backoff(attempt)
+    else:
+        _delete_binary(bucket, name)
+        raise RuntimeError(
+            f"Gave up replacing the base of {base_name(index_name)} "
+            f"after {MANIFEST_RETRIES} attempts"
+        )
+
+    # A slow reader may still fetch the old blobs, they are only gone once the
+    # manifest no longer lists them
+    if snapshot is not None:
+        _delete_binary(bucket, snapshot["base"]["name"])
+        for segment in snapshot["segments"]:
+            _delete_binary(bucket, segment["name"])
+    return manifest_blob
+
+
+def compact_index(bucket, index_name, index_cls, **kwargs):
+    # Merges the base and every segment into a new base, dropping tombstoned
+    # documents. Returns None if the index was compacted by someone else.
+    for attempt in range(MANIFEST_RETRIES):
+        manifest, generation = _read_manifest_for_update(bucket, index_name)
+        try:
+            if manifest is None:
+                legacy_blob = get_index_blob(bucket, index_name)
+                index, _ = load_index_from_blob(
+                    bucket, legacy_blob, index_cls, **kwargs
+                )
+            else:
+                index, _ = _load_manifest(bucket, manifest, index_cls, **kwargs)
+            break
+        except (NotFound, PreconditionFailed):
+            # Another compaction deleted the blobs of the manifest we read
+            print(f"{base_name(index_name)} was compacted while loading, reloading")
+            _backoff(attempt)
+    else:
+        raise RuntimeError(
+            f"Gave up loading {base_name(index_name)} after {MANIFEST_RETRIES} attempts"
+        )
+    print(f"Compacting {base_name(index_name)}")
+    try:
+        return _commit_base(bucket, index_name, index, manifest, generation)
+    except PreconditionFailed:
+        # A legacy index that got its manifest meanwhile
+        print(f"{base_name(index_name)} was converted concurrently")
+        return None
+
+
+def _delete_binary(bucket, name):
+    for blob_path in (
+        meta_blob_path(name),
+        embeddings_blob_path(name),
+        ann_blob_path(name),
+        sentences_blob_path(name),
+    ):
+        blob = bucket.blob(blob_path)
+        if blob.exists():
+            blob.delete()
+
+
+def _save_binary(bucket, index_name, index, build_ann=True):
+    with span("serialize", blob=index_name) as stage:
+        embeddings, meta = index_to_binary(index)
+        embeddings_file = embeddings_to_file(embeddings)
+        stage.set(rows=len(embeddings), bytes=embeddings_file.tell())
+
+    # Upload the embeddings first and pin the sidecar to that generation,
+    # so readers never pair a sidecar with embeddings from another save
+    embeddings_blob = bucket.blob(embeddings_blob_path(index_name))
+    with span("upload", blob=embeddings_blob.name, bytes=embeddings_file.tell()):
+        # Uploaded from the buffer, without a bytes copy of the array
+        embeddings_blob.upload_from_file(
+            embeddings_file,
+            rewind=True,
+            content_type="application/octet-stream",
+        )
+    meta["embeddings_generation"] = embeddings_blob.generation
+
+    if build_ann and len(embeddings) >= ANN_MIN_ROWS:
+        meta["ann"] = _save_ann(bucket, index_name, embeddings)
+
+    if len(getattr(index, "sentence_store", ())):
+        sentences = _save_sentences(bucket, index_name, index, meta["ids"])
+        if sentences is not None:
+            meta["sentences"] = sentences
+
+    meta_blob = bucket.blob(meta_blob_path(index_name))
+    with span("serialize", blob=meta_blob.name) as stage:
+        meta_data, content_type = encode_json(meta)
+        stage.set(bytes=len(meta_data))
+    with span("upload", blob=meta_blob.name, bytes=len(meta_data)):
+        meta_blob.upload_from_string(meta_data, content_type=content_type)
+    return meta_blob
+
+
+def _save_ann(bucket, index_name, embeddings):
+    # Rebuilt on every save, row numbers change when deleted rows are dropped
+    ivf_index = IVFIndex.build(embeddings)
+    report = recall_report(embeddings, ivf_index, nprobes=[ANN_NPROBE], num_queries=50)
+    print(f"ANN index for {index_name}: {ivf_index.nlist} lists, {report}")
+
+    ann_blob = bucket.blob(ann_blob_path(index_name))
+    ann_blob.upload_from_string(
+        ivf_index.to_bytes(), content_type="application/octet-stream"
+    )
+    return {
+        "generation": ann_blob.generation,
+        "nlist": ivf_index.nlist,
+        "num_rows": ivf_index.num_rows,
+        "recall_report": report,
+    }
+
+
+def _save_sentences(bucket, index_name, index, ids):
+    # Only the chunks still in the index, in the order of its rows
+    texts = [
+        index.docstore.get_node(index.index_struct.nodes_dict[text_id]).get_text()
+        for text_id in ids
+    ]
+    with span("serialize", blob=sentences_blob_path(index_name)) as stage:
+        sentences, chunks = index.sentence_store.to_arrays(texts)
+        if not chunks:
+            return None
+        sentences_file = io.BytesIO()
+        np.save(sentences_file, sentences)
+        stage.set(rows=len(sentences), bytes=sentences_file.tell())
+
+    sentences_blob = bucket.blob(sentences_blob_path(index_name))
+    with span("upload", blob=sentences_blob.name, bytes=sentences_file.tell()):
+        sentences_blob.upload_from_file(
+            sentences_file,
+            rewind=True,
+            content_type="application/octet-stream",
+        )
+    return {"generation": sentences_blob.generation, "chunks": chunks}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert indices between the JSON and the binary format"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    to_binary = subparsers.add_parser("to-binary", help="index.json -> .npy/.meta.json")
+    to_binary.add_argument("json_path")
+    to_binary.add_argument("output_prefix")
+    to_json = subparsers.add_parser("to-json", help=".npy/.meta.json -> index.json")
+    to_json.add_argument("input_prefix")
+    to_json.add_argument("json_path")
+    compact = subparsers.add_parser(
+        "compact", help="merge the segments of a stored index into its base"
+    )
+    compact.add_argument("index_name")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        # Needs the Firebase and OpenAI environment of the functions
+        from firebase_utils import bucket
+        from service_context import load_service_context
+
+        compact_index(
+            bucket,
+            args.index_name,
+            CustomGPTSimpleVectorIndex,
+            service_context=load_service_context(),
+        )
+    elif args.command == "to-binary":
+        with open(args.json_path) as f:
+            embeddings, meta = json_to_binary(f.read())
+        np.save(f"{args.output_prefix}.npy", embeddings)
+        with open(f"{args.output_prefix}.meta.json", "w") as f:
+            f.write(dumps_meta(meta))
+        print(f"Wrote {args.output_prefix}.npy and {args.output_prefix}.meta.json")
+    else:
+        embeddings = np.load(f"{args.input_prefix}.npy", mmap_mode="r")
+        # A sidecar downloaded from the bucket is compressed
+        with open(f"{args.input_prefix}.meta.json", "rb") as f:
+            meta = decode_json(f.read())
+        with open(args.json_path, "w") as f:
+            f.write(binary_to_json(embeddings, meta))
+        print(f"Wrote {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
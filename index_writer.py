@@ -0,0 +1,81 @@
+import threading
+from concurrent.futures import Future
+from index_store import base_name, update_index
+
+# Changes to an index that arrive while this instance is writing it wait for
+# that write, then go out together as one segment and one manifest update.
+# Writers in other instances are reconciled by update_index's retries.
+
+
+class IndexWriter:
+    """Group commit of inserts and deletes per index."""
+
+    def __init__(self):
+        self.writes = 0
+        self.changes = 0
+        # (bucket name, index name) -> [(change, future)] waiting to be written
+        self._pending = {}
+        self._writing = set()
+        self._lock = threading.Lock()
+
+    def append_segment(self, bucket, index_name, segment_index, replaces=()):
+        # `replaces`: doc_ids whose earlier copies the segment supersedes, they
+        # are deleted in the same manifest write
+        changes = [("insert", segment_index)]
+        if replaces:
+            changes.insert(0, ("delete", list(replaces)))
+        return self.submit(
+            bucket,
+            index_name,
+            changes,
+            type(segment_index),
+            service_context=segment_index.service_context,
+        )
+
+    def delete_documents(self, bucket, index_name, doc_ids, index_cls, **kwargs):
+        return self.submit(
+            bucket, index_name, [("delete", list(doc_ids))], index_cls, **kwargs
+        )
+
+    def submit(self, bucket, index_name, changes, index_cls, **kwargs):
+        # Returns the manifest blob of the write that included `changes`
+        key = (bucket.name, base_name(index_name))
+        future = Future()
+        with self._lock:
+            self._pending.setdefault(key, []).append((changes, future))
+            leader = key not in self._writing
+            self._writing.add(key)
+        if leader:
+            self._write_pending(key, bucket, index_name, index_cls, kwargs)
+        return future.result()
+
+    def _write_pending(self, key, bucket, index_name, index_cls, kwargs):
+        # The first caller writes until nothing is pending, the others wait
+        while True:
+            with self._lock:
+                batch = self._pending.pop(key, [])
+                if not batch:
+                    self._writing.discard(key)
+                    return
+                self.writes += 1
+                self.changes += len(batch)
+            if len(batch) > 1:
+                print(f"Coalesced {len(batch)} changes to {key[1]} into one write")
+            try:
+                result = update_index(
+                    bucket,
+                    index_name,
+                    [change for changes, _ in batch for change in changes],
+                    index_cls,
+                    **kwargs,
+                )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(result)
+
+
+# Shared by index_docs_fn and delete_doc_fn, so their changes are coalesced too
+index_writer = IndexWriter()
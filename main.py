@@ -1,15 +1,19 @@
 import os
-from flask import jsonify, make_response
-from index_docs_fn import index_docs
-from firebase_utils import db
-from chatbot_fn import chatbot_fn
-from delete_doc_fn import delete_doc_fn
+from flask import Response, jsonify, make_response, stream_with_context
+from tracing import current_context, traced
+
+# Every entry point imports the modules it needs when it is first called, so a
+# cold start doesn't load llama_index, Firebase or the indexing code for entry
+# points that aren't deployed on that function. See import_profile.py.
 
 api_key = os.getenv("OPENAI_API_KEY")
 access_key = os.getenv("ACCESS_KEY")
+# Questions accepted by one chatbot_batch call
+batch_max_questions = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
 os.environ["OPENAI_API_KEY"] = api_key
 
 
+@traced
 def index_documents(request):
     # Set CORS headers for the preflight request
     if request.method == "OPTIONS":
@@ -37,6 +41,9 @@ def index_documents(request):
         )
     try:
         if input_text == access_key:
+            from firebase_utils import db
+            from index_docs_fn import index_docs
+
             # Fetch documents with indexed == false
             docs_ref = db.collection("documents")
             query = docs_ref.where("indexed", "==", False)
@@ -63,6 +70,7 @@ def index_documents(request):
         )
 
 
+@traced
 def chatbot(request):
     if request.method == "OPTIONS":
         headers = {
@@ -76,10 +84,35 @@ def chatbot(request):
 
     input_text = request.args.get("input_text", "")
     index_name = request.args.get("index_name", "")
+    # Comma separated, one answer from the best chunks of all of them
+    index_names = [
+        name for name in request.args.get("index_names", "").split(",") if name
+    ]
+
+    # stream=1 sends the answer as server-sent events while it is generated
+    stream = request.args.get("stream", "") in ("1", "true")
 
     print(input_text)
     try:
-        if input_text:
+        from chatbot_fn import chatbot_fn, chatbot_multi_fn, chatbot_stream_fn
+
+        if input_text and index_names:
+            if stream:
+                response = "stream=1 isn't supported with index_names"
+                return make_response(jsonify({"response": response}), 400, headers)
+            response = chatbot_multi_fn(input_text, index_names)
+            return make_response(jsonify({"response": response}), 200, headers)
+        elif input_text and stream:
+            headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+            return Response(
+                stream_with_context(
+                    # The answer is generated after this span ended, in its own
+                    chatbot_stream_fn(input_text, index_name, current_context())
+                ),
+                mimetype="text/event-stream",
+                headers=headers,
+            )
+        elif input_text:
             response = chatbot_fn(input_text, index_name)
             return make_response(jsonify({"response": response}), 200, headers)
         else:
@@ -99,6 +132,43 @@ def chatbot(request):
         )
 
 
+@traced
+def chatbot_batch(request):
+    # POST {"input_text": access key, "index_name": ..., "questions": [...]},
+    # for evaluation runs and prefilling the answer cache
+    headers = {"Access-Control-Allow-Origin": "*"}
+
+    if request.method == "OPTIONS":
+        headers.update(
+            {
+                "Access-Control-Allow-Methods": "POST",
+                "Access-Control-Allow-Headers": "Content-Type",
+                "Access-Control-Max-Age": "3600",
+            }
+        )
+        return "", 204, headers
+
+    body = request.get_json(silent=True) or {}
+    index_name = body.get("index_name", "")
+    questions = [question for question in body.get("questions", []) if question]
+
+    if body.get("input_text") != access_key or not index_name or not questions:
+        response = "Please provide the access key, an index name and questions"
+        return make_response(jsonify({"response": response}), 400, headers)
+    if len(questions) > batch_max_questions:
+        response = f"At most {batch_max_questions} questions per batch"
+        return make_response(jsonify({"response": response}), 400, headers)
+
+    from chatbot_fn import chatbot_batch_fn
+
+    try:
+        result = chatbot_batch_fn(questions, index_name)
+    except FileNotFoundError as e:
+        return make_response(jsonify({"response": str(e)}), 404, headers)
+    return make_response(jsonify(result), 200, headers)
+
+
+@traced
 def delete_doc_from_index(request):
     headers = {"Access-Control-Allow-Origin": "*"}
 
@@ -116,6 +186,9 @@ def delete_doc_from_index(request):
     input_text = request.args.get("input_text", "")
 
     if input_text == access_key:
+        from firebase_utils import db
+        from delete_doc_fn import delete_doc_fn
+
         doc_ref = db.collection("documents").document(document_id)
         doc = doc_ref.get()
 
@@ -142,3 +215,133 @@ def delete_doc_from_index(request):
             400,
             headers,
         )
+
+
+@traced
+def delete_docs_from_index(request):
+    headers = {"Access-Control-Allow-Origin": "*"}
+
+    if request.method == "OPTIONS":
+        headers.update(
+            {
+                "Access-Control-Allow-Methods": "GET, POST",
+                "Access-Control-Allow-Headers": "Content-Type",
+                "Access-Control-Max-Age": "3600",
+            }
+        )
+        return "", 204, headers
+
+    # Comma separated in the query string, or a JSON list in a POST body
+    body = request.get_json(silent=True) or {}
+    document_ids = body.get("document_ids") or [
+        document_id
+        for document_id in request.args.get("document_ids", "").split(",")
+        if document_id
+    ]
+    input_text = body.get("input_text") or request.args.get("input_text", "")
+
+    if input_text != access_key or not document_ids:
+        response = "Invalid request method, missing access key or document ids."
+        return make_response(
+            jsonify({"response": response}),
+            400,
+            headers,
+        )
+
+    from firebase_utils import db
+    from delete_doc_fn import delete_docs_fn
+
+    # One batched read for all the documents
+    docs_ref = db.collection("documents")
+    snapshots = db.get_all([docs_ref.document(i) for i in document_ids])
+    files = []
+    not_indexed = []
+    missing = set(document_ids)
+    for doc in snapshots:
+        if doc.exists:
+            missing.discard(doc.id)
+            file = doc.to_dict()
+            if file.get("index_name") and file.get("doc_id"):
+                files.append(file)
+            else:
+                not_indexed.append(doc.id)
+
+    if missing:
+        print(f"No documents found with IDs: {sorted(missing)}")
+
+    response = delete_docs_fn(files) if files else {}
+    return make_response(
+        jsonify(
+            {
+                "response": response,
+                "not_found": sorted(missing),
+                "not_indexed": not_indexed,
+            }
+        ),
+        200,
+        headers,
+    )
+
+
+@traced
+def index_job(request):
+    # Starts a job (index_name) or continues one (job_id), then works on it for
+    # up to JOB_TIME_BUDGET seconds. Call again, e.g. from Cloud Scheduler,
+    # until the status is "done".
+    headers = {"Access-Control-Allow-Origin": "*"}
+
+    if request.method == "OPTIONS":
+        headers.update(
+            {
+                "Access-Control-Allow-Methods": "GET",
+                "Access-Control-Allow-Headers": "Content-Type",
+                "Access-Control-Max-Age": "3600",
+            }
+        )
+        return "", 204, headers
+
+    input_text = request.args.get("input_text", "")
+    index_name = request.args.get("index_name", "")
+    job_id = request.args.get("job_id", "")
+
+    if input_text != access_key or not (index_name or job_id):
+        response = "Please provide the access key and an index name or job id"
+        return make_response(
+            jsonify({"response": response}),
+            400,
+            headers,
+        )
+
+    from index_jobs import run_job, start_job
+
+    if not job_id:
+        job_id = start_job(index_name)
+    status = run_job(job_id)
+    if status is None:
+        response = f"No indexing job found with ID: {job_id}"
+        return make_response(jsonify({"response": response}), 404, headers)
+    return make_response(jsonify(status), 200, headers)
+
+
+@traced
+def index_job_status(request):
+    headers = {"Access-Control-Allow-Origin": "*"}
+
+    if request.method == "OPTIONS":
+        headers.update(
+            {
+                "Access-Control-Allow-Methods": "GET",
+                "Access-Control-Allow-Headers": "Content-Type",
+                "Access-Control-Max-Age": "3600",
+            }
+        )
+        return "", 204, headers
+
+    from index_jobs import job_status
+
+    job_id = request.args.get("job_id", "")
+    status = job_status(job_id) if job_id else None
+    if status is None:
+        response = f"No indexing job found with ID: {job_id}"
+        return make_response(jsonify({"response": response}), 404, headers)
+    return make_response(jsonify(status), 200, headers)
@@ -0,0 +1,345 @@
+from typing import Any, Dict, List, Optional
+import numpy as np
+from llama_index.indices.query.embedding_utils import get_top_k_embeddings_learner
+from llama_index.vector_stores.simple import SimpleVectorStore
+from llama_index.vector_stores.types import (
+    NodeEmbeddingResult,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+from tracing import span
+
+# Rows are allocated in blocks so incremental inserts don't copy the matrix each time
+GROWTH_FACTOR = 1.5
+MIN_CAPACITY = 64
+# Score matrix elements computed at once by query_many, 64 MB of float32
+MAX_SCORE_ELEMENTS = 2**24
+
+
+def normalize_rows(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+    safe_norms = np.where(norms > 0, norms, 1.0).astype(np.float32)
+    return embeddings / safe_norms[:, None], norms
+
+
+class NumpyVectorStore(SimpleVectorStore):
+    """SimpleVectorStore that keeps every embedding in one pre-normalized matrix.
+
+    Top-k is a single matrix-vector product plus argpartition. Deleted rows are
+    masked out and only dropped when the store is exported again.
+    """
+
+    stores_text: bool = False
+
+    def __init__(
+        self,
+        simple_vector_store_data_dict: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> None:
+        self._ids: List[str] = []
+        self._doc_ids: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._doc_rows: Dict[str, List[int]] = {}
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._size = 0
+        # Optional IVF index over the first ann_index.num_rows rows
+        self._ann_index = None
+        self.ann_nprobe = None
+
+        if simple_vector_store_data_dict is not None:
+            embedding_dict = simple_vector_store_data_dict["embedding_dict"]
+            text_id_to_doc_id = simple_vector_store_data_dict["text_id_to_doc_id"]
+            ids = list(embedding_dict.keys())
+            if ids:
+                matrix, norms = normalize_rows([embedding_dict[i] for i in ids])
+                self._load(ids, [text_id_to_doc_id[i] for i in ids], matrix, norms)
+
+    @classmethod
+    def from_arrays(cls, ids, doc_ids, embeddings, norms=None) -> "NumpyVectorStore":
+        # With norms given the rows are already unit length and are used as-is,
+        # which keeps a memory-mapped array mapped until the first insert
+        vector_store = cls()
+        if len(ids):
+            if norms is None:
+                embeddings, norms = normalize_rows(embeddings)
+            vector_store._load(
+                list(ids), list(doc_ids), embeddings, np.asarray(norms, np.float32)
+            )
+        return vector_store
+
+    def _load(self, ids, doc_ids, matrix, norms):
+        self._ids = ids
+        self._doc_ids = doc_ids
+        self._matrix = matrix
+        self._norms = norms
+        self._size = len(ids)
+        self._alive = np.ones(self._size, dtype=bool)
+        for row, (text_id, doc_id) in enumerate(zip(ids, doc_ids)):
+            self._rows[text_id] = row
+            self._doc_rows.setdefault(doc_id, []).append(row)
+
+    @property
+    def dim(self) -> int:
+        return self._matrix.shape[1] if self._matrix.ndim == 2 else 0
+
+    @property
+    def num_nodes(self) -> int:
+        # Not __len__: llama_index tests vector stores for truthiness
+        return len(self._rows)
+
+    @property
+    def config_dict(self) -> dict:
+        # Same layout as SimpleVectorStore, so save_to_string() stays compatible
+        ids, doc_ids, matrix, norms = self.to_arrays()
+        embeddings = (matrix * norms[:, None]).tolist() if ids else []
+        return {
+            "simple_vector_store_data_dict": {
+                "embedding_dict": dict(zip(ids, embeddings)),
+                "text_id_to_doc_id": dict(zip(ids, doc_ids)),
+            }
+        }
+
+    def to_arrays(self):
+        # Live rows only: (ids, doc_ids, unit-length matrix, norms)
+        alive = self._alive[: self._size]
+        if alive.all():
+            rows = slice(0, self._size)
+            ids = list(self._ids)
+            doc_ids = list(self._doc_ids)
+        else:
+            rows = np.flatnonzero(alive)
+            ids = [self._ids[r] for r in rows]
+            doc_ids = [self._doc_ids[r] for r in rows]
+        return ids, doc_ids, self._matrix[rows], self._norms[rows]
+
+    def get(self, text_id: str) -> List[float]:
+        row = self._rows[text_id]
+        return (self._matrix[row] * self._norms[row]).tolist()
+
+    def add(
+        self,
+        embedding_results: List[NodeEmbeddingResult],
+    ) -> List[str]:
+        if not embedding_results:
+            return []
+
+        matrix, norms = normalize_rows([r.embedding for r in embedding_results])
+        ids = [result.id for result in embedding_results]
+        doc_ids = [result.doc_id for result in embedding_results]
+        self.add_arrays(ids, doc_ids, matrix, norms)
+        return ids
+
+    def add_arrays(self, ids, doc_ids, matrix, norms) -> None:
+        # Appends rows that are already unit length, e.g. another store's to_arrays()
+        if not len(ids):
+            return
+        self._reserve(self._size + len(ids), matrix.shape[1])
+
+        start = self._size
+        self._matrix[start : start + len(ids)] = matrix
+        self._norms[start : start + len(ids)] = norms
+        self._alive[start : start + len(ids)] = True
+        for offset, (text_id, doc_id) in enumerate(zip(ids, doc_ids)):
+            row = start + offset
+            # Re-adding an id replaces its previous row
+            self._mask_row(self._rows.get(text_id))
+            self._ids.append(text_id)
+            self._doc_ids.append(doc_id)
+            self._rows[text_id] = row
+            self._doc_rows.setdefault(doc_id, []).append(row)
+        self._size += len(ids)
+
+    def _reserve(self, size, dim):
+        if self._size and dim != self.dim:
+            raise ValueError(f"Embedding dimension {dim} does not match {self.dim}")
+        capacity = len(self._matrix)
+        if size <= capacity:
+            return
+        capacity = max(size, int(capacity * GROWTH_FACTOR), MIN_CAPACITY)
+        matrix = np.zeros((capacity, dim), dtype=np.float32)
+        norms = np.zeros(capacity, dtype=np.float32)
+        alive = np.zeros(capacity, dtype=bool)
+        if self._size:
+            matrix[: self._size] = self._matrix[: self._size]
+            norms[: self._size] = self._norms[: self._size]
+            alive[: self._size] = self._alive[: self._size]
+        self._matrix, self._norms, self._alive = matrix, norms, alive
+
+    def _mask_row(self, row):
+        if row is None or not self._alive[row]:
+            return
+        self._alive[row] = False
+        if self._rows.get(self._ids[row]) == row:
+            del self._rows[self._ids[row]]
+        doc_rows = self._doc_rows.get(self._doc_ids[row])
+        if doc_rows is not None and row in doc_rows:
+            doc_rows.remove(row)
+            if not doc_rows:
+                del self._doc_rows[self._doc_ids[row]]
+
+    def delete(self, doc_id: str, **delete_kwargs: Any) -> None:
+        for row in list(self._doc_rows.get(doc_id, [])):
+            self._mask_row(row)
+
+    def delete_nodes(self, text_ids: List[str]) -> None:
+        for text_id in text_ids:
+            self._mask_row(self._rows.get(text_id))
+
+    def reassign(self, text_id: str, doc_id: str) -> None:
+        # Moves a row to another document, e.g. a shared chunk whose first
+        # document is deleted
+        row = self._rows.get(text_id)
+        if row is None:
+            return
+        doc_rows = self._doc_rows.get(self._doc_ids[row])
+        if doc_rows is not None and row in doc_rows:
+            doc_rows.remove(row)
+            if not doc_rows:
+                del self._doc_rows[self._doc_ids[row]]
+        self._doc_ids[row] = doc_id
+        self._doc_rows.setdefault(doc_id, []).append(row)
+
+    def live_rows_mask(self, doc_ids: Optional[List[str]] = None):
+        mask = self._alive[: self._size]
+        if doc_ids is not None:
+            allowed = np.zeros(self._size, dtype=bool)
+            for doc_id in doc_ids:
+                allowed[self._doc_rows.get(doc_id, [])] = True
+            mask = mask & allowed
+        return mask
+
+    @property
+    def ann_index(self):
+        return self._ann_index
+
+    def attach_ann(self, ann_index, nprobe=None):
+        if ann_index is not None and ann_index.num_rows > self._size:
+            raise ValueError("ANN index covers more rows than the vector store")
+        self._ann_index = ann_index
+        self.ann_nprobe = nprobe
+
+    def normalize_query(self, query_embedding):
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query_embedding)
+        if query_norm > 0:
+            query_embedding = query_embedding / query_norm
+        return query_embedding
+
+    def query_scores(self, query_embedding):
+        return self._matrix[: self._size] @ self.normalize_query(query_embedding)
+
+    def _ann_top_k(self, query_embedding, similarity_top_k):
+        query_embedding = self.normalize_query(query_embedding)
+        rows = self._ann_index.candidate_rows(query_embedding, self.ann_nprobe)
+        if self._ann_index.num_rows < self._size:
+            # Rows inserted after the ANN index was built are always scored
+            rows = np.concatenate(
+                [rows, np.arange(self._ann_index.num_rows, self._size)]
+            )
+        rows = rows[self._alive[rows]]
+        if len(rows) < similarity_top_k:
+            return None
+        scores = self._matrix[rows] @ query_embedding
+        top = np.argpartition(-scores, similarity_top_k - 1)[:similarity_top_k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return VectorStoreQueryResult(
+            similarities=scores[top].tolist(),
+            ids=[self._ids[r] for r in rows[top]],
+        )
+
+    def top_k_rows(self, scores, mask, similarity_top_k):
+        scores = np.where(mask, scores, -np.inf)
+        k = min(similarity_top_k, int(mask.sum()))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), scores
+        top_rows = np.argpartition(-scores, k - 1)[:k]
+        top_rows = top_rows[np.argsort(-scores[top_rows], kind="stable")]
+        return top_rows, scores
+
+    def query(
+        self,
+        query: VectorStoreQuery,
+    ) -> VectorStoreQueryResult:
+        with span(
+            "retrieve",
+            rows=self._size,
+            top_k=query.similarity_top_k,
+            ann=self._ann_index is not None,
+        ):
+            return self._query(query)
+
+    def query_many(
+        self, query_embeddings, similarity_top_k: int
+    ) -> List[VectorStoreQueryResult]:
+        # Exact top k of many queries with one matrix product per block of
+        # queries, the blocks keep the score matrix under MAX_SCORE_ELEMENTS
+        with span(
+            "retrieve",
+            rows=self._size,
+            queries=len(query_embeddings),
+            top_k=similarity_top_k,
+        ):
+            queries, _ = normalize_rows(query_embeddings)
+            mask = self.live_rows_mask()
+            k = min(similarity_top_k, int(mask.sum()))
+            if k <= 0:
+                return [
+                    VectorStoreQueryResult(similarities=[], ids=[]) for _ in queries
+                ]
+
+            results = []
+            block = max(1, MAX_SCORE_ELEMENTS // max(self._size, 1))
+            for start in range(0, len(queries), block):
+                scores = self._matrix[: self._size] @ queries[start : start + block].T
+                scores[~mask] = -np.inf
+                top_rows = np.argpartition(-scores, k - 1, axis=0)[:k]
+                for column in range(scores.shape[1]):
+                    rows = top_rows[:, column]
+                    column_scores = scores[rows, column]
+                    order = np.argsort(-column_scores, kind="stable")
+                    results.append(
+                        VectorStoreQueryResult(
+                            similarities=column_scores[order].tolist(),
+                            ids=[self._ids[r] for r in rows[order]],
+                        )
+                    )
+            return results
+
+    def _query(self, query: VectorStoreQuery) -> VectorStoreQueryResult:
+        if (
+            self._ann_index is not None
+            and query.mode == VectorStoreQueryMode.DEFAULT
+            and query.doc_ids is None
+        ):
+            result = self._ann_top_k(query.query_embedding, query.similarity_top_k)
+            if result is not None:
+                return result
+            # Too few candidates in the probed lists, fall back to exact search
+
+        mask = self.live_rows_mask(query.doc_ids)
+
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            # Learner modes fit a model per query and need the raw rows anyway
+            rows = np.flatnonzero(mask)
+            top_similarities, top_ids = get_top_k_embeddings_learner(
+                query.query_embedding,
+                (self._matrix[rows] * self._norms[rows, None]).tolist(),
+                similarity_top_k=query.similarity_top_k,
+                embedding_ids=[self._ids[r] for r in rows],
+                query_mode=query.mode,
+            )
+            return VectorStoreQueryResult(similarities=top_similarities, ids=top_ids)
+
+        if self._size == 0:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        scores = self.query_scores(query.query_embedding)
+        top_rows, scores = self.top_k_rows(scores, mask, query.similarity_top_k)
+        return VectorStoreQueryResult(
+            similarities=scores[top_rows].tolist(),
+            ids=[self._ids[r] for r in top_rows],
+        )
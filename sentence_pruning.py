@@ -0,0 +1,196 @@
+import hashlib
+import math
+import os
+import re
+import threading
+import numpy as np
+from llama_index.optimization.optimizer import BaseTokenUsageOptimizer
+from llama_index.utils import globals_helper
+from batch_embedding import embed_texts
+from numpy_vector_store import normalize_rows
+
+# Sentence embeddings of every chunk, computed when the chunk is indexed and
+# stored next to the index (see index_store.py). The chatbot uses them to drop
+# the sentences of a retrieved chunk that are least similar to the question
+# before the chunk goes into the prompt, without embedding anything at query
+# time. Chunks indexed without sentence embeddings are sent whole.
+
+# 1 computes sentence embeddings at index time, about the chunk tokens again
+SENTENCE_EMBEDDINGS = os.getenv("SENTENCE_EMBEDDINGS", "") == "1"
+# Fraction of each chunk's sentences kept, the most similar ones. 0 turns it off.
+CONTEXT_PRUNING_PERCENTILE = float(os.getenv("CONTEXT_PRUNING_PERCENTILE", "0"))
+# Sentences less similar than this to the question are dropped, 0 turns it off
+CONTEXT_PRUNING_THRESHOLD = float(os.getenv("CONTEXT_PRUNING_THRESHOLD", "0"))
+# Chunks with fewer sentences are always sent whole
+CONTEXT_PRUNING_MIN_SENTENCES = 3
+# A sentence ends at . ! or ? followed by whitespace, or at a line break
+SENTENCE_PATTERN = re.compile(r".+?(?:[.!?]+(?=\s)|\n|$)", re.S)
+
+
+def split_sentences(text):
+    # (start, end) of each non-blank sentence, so the text itself isn't stored
+    return [
+        (match.start(), match.end())
+        for match in SENTENCE_PATTERN.finditer(text)
+        if match.group().strip()
+    ]
+
+
+def text_key(text):
+    # Chunks are looked up by their text, the optimizer hook only gets the text
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class SentenceStore:
+    """Unit-length float16 sentence embeddings per chunk text."""
+
+    def __init__(self):
+        # text key -> (matrix, first row, sentence spans)
+        self._chunks = {}
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def get(self, text):
+        entry = self._chunks.get(text_key(text))
+        if entry is None:
+            return None
+        matrix, row, spans = entry
+        return matrix[row : row + len(spans)], spans
+
+    def add_chunks(self, texts, embed_model):
+        new_texts = {}
+        for text in texts:
+            key = text_key(text)
+            if key not in self._chunks:
+                new_texts[key] = text
+        spans_by_key = {key: split_sentences(text) for key, text in new_texts.items()}
+        sentences = [
+            new_texts[key][start:end]
+            for key, spans in spans_by_key.items()
+            for start, end in spans
+        ]
+        if not sentences:
+            return 0
+
+        # Past the embedding cache, sentences would crowd the chunks out of it
+        embed_model = getattr(embed_model, "embed_model", embed_model)
+        matrix = normalize_rows(embed_texts(embed_model, sentences))[0]
+        matrix = matrix.astype(np.float16)
+        row = 0
+        for key, spans in spans_by_key.items():
+            self._chunks[key] = (matrix, row, spans)
+            row += len(spans)
+        return len(sentences)
+
+    def merge(self, other):
+        self._chunks.update(other._chunks)
+
+    def to_arrays(self, texts):
+        # Only the chunks of `texts`, deleted chunks are left behind
+        parts = []
+        chunks = {}
+        row = 0
+        for key in dict.fromkeys(map(text_key, texts)):
+            if key in self._chunks and key not in chunks:
+                matrix, start, spans = self._chunks[key]
+                parts.append(matrix[start : start + len(spans)])
+                chunks[key] = [row, spans]
+                row += len(spans)
+        if not parts:
+            return np.zeros((0, 0), dtype=np.float16), chunks
+        return np.concatenate(parts).astype(np.float16, copy=False), chunks
+
+    @classmethod
+    def from_arrays(cls, matrix, chunks):
+        store = cls()
+        for key, (row, spans) in chunks.items():
+            store._chunks[key] = (matrix, row, [tuple(span) for span in spans])
+        return store
+
+
+class ContextPruner(BaseTokenUsageOptimizer):
+    """Keeps the sentences of a chunk most similar to the question.
+
+    Passed to index.query(optimizer=...) or a ResponseSynthesizer, one per
+    request. report() gives the tokens saved over the chunks it has seen.
+    """
+
+    def __init__(
+        self,
+        sentence_stores,
+        percentile=CONTEXT_PRUNING_PERCENTILE,
+        threshold=CONTEXT_PRUNING_THRESHOLD,
+    ):
+        self.sentence_stores = sentence_stores
+        self.percentile = percentile
+        self.threshold = threshold
+        self._stats = dict.fromkeys(
+            ["chunks", "pruned_chunks", "tokens_before", "tokens_after"], 0
+        )
+        self._lock = threading.Lock()
+
+    def optimize(self, query_bundle, text):
+        pruned = self._prune(query_bundle.embedding, text)
+        tokens_before = len(globals_helper.tokenizer(text))
+        tokens_after = (
+            tokens_before if pruned is text else len(globals_helper.tokenizer(pruned))
+        )
+        with self._lock:
+            self._stats["chunks"] += 1
+            self._stats["pruned_chunks"] += pruned is not text
+            self._stats["tokens_before"] += tokens_before
+            self._stats["tokens_after"] += tokens_after
+        return pruned
+
+    def _prune(self, query_embedding, text):
+        entry = None
+        for store in self.sentence_stores:
+            entry = store.get(text)
+            if entry is not None:
+                break
+        if (
+            entry is None
+            or query_embedding is None
+            or len(entry[1]) < CONTEXT_PRUNING_MIN_SENTENCES
+        ):
+            return text
+
+        embeddings, spans = entry
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = embeddings.astype(np.float32) @ query
+
+        keep = np.ones(len(spans), dtype=bool)
+        if self.percentile > 0:
+            count = max(1, math.ceil(len(spans) * self.percentile))
+            keep[np.argsort(-scores, kind="stable")[count:]] = False
+        if self.threshold > 0:
+            keep &= scores >= self.threshold
+        # Never an empty chunk, the best sentence always stays
+        keep[int(np.argmax(scores))] = True
+        if keep.all():
+            return text
+        # In their original order, so the context still reads as text
+        return " ".join(
+            text[start:end].strip() for (start, end), kept in zip(spans, keep) if kept
+        )
+
+    def report(self):
+        with self._lock:
+            report = dict(self._stats)
+        report["tokens_saved"] = report["tokens_before"] - report["tokens_after"]
+        return report
+
+
+def context_pruner(*indices):
+    # A pruner for a request on these indices, or None if pruning is off or
+    # none of them has sentence embeddings
+    if CONTEXT_PRUNING_PERCENTILE <= 0 and CONTEXT_PRUNING_THRESHOLD <= 0:
+        return None
+    stores = [
+        index.sentence_store
+        for index in indices
+        if len(getattr(index, "sentence_store", ()))
+    ]
+    return ContextPruner(stores) if stores else None
@@ -1,35 +1,140 @@
+from functools import lru_cache
+import os
+import openai
+import requests
+from requests.adapters import HTTPAdapter
 from llama_index import (
-    LLMPredictor,
     PromptHelper,
     ServiceContext,
 )
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.langchain_helpers.text_splitter import TokenTextSplitter
+from llama_index.node_parser.simple import SimpleNodeParser
 from langchain.chat_models import ChatOpenAI
+from embedding_cache import CachedEmbedding
+from fake_llm import FakeEmbedding, FakeLLM
+from streaming_llm import StreamingLLMPredictor
 
+# Defaults shared by every entry point, override per call or through the environment
+DEFAULT_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "gpt-3.5-turbo")
+DEFAULT_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.3"))
+DEFAULT_NUM_OUTPUTS = int(os.getenv("LLM_MAX_TOKENS", "1024"))
+DEFAULT_MAX_INPUT_SIZE = 4096
+DEFAULT_MAX_CHUNK_OVERLAP = 20
+# Tokens per chunk when documents are split, 0 keeps llama_index's default
+INDEX_CHUNK_SIZE = int(os.getenv("INDEX_CHUNK_SIZE", "0"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))
+# Local testing without OpenAI, see fake_llm.py
+FAKE_LLM = os.getenv("FAKE_LLM", "") == "1"
 
-def load_service_context():
-    try:
-        # Defining the parameters for the index
-        max_input_size = 4096
-        num_outputs = 1024
-        max_chunk_overlap = 20
 
-        prompt_helper = PromptHelper(
-            max_input_size,
-            num_outputs,
-            max_chunk_overlap,
-        )
+class PooledSession(requests.Session):
+    """Session of one openai thread over the process-wide connection pool."""
+
+    def close(self):
+        # openai closes the session of a thread every few minutes to replace
+        # it. The adapter is shared by every thread, so it stays open.
+        pass
+
+
+@lru_cache(maxsize=None)
+def get_http_adapter():
+    # One pool per process so warm invocations and all threads reuse TLS connections
+    return HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE)
+
+
+def create_http_session():
+    session = PooledSession()
+    session.mount("https://", get_http_adapter())
+    session.mount("http://", get_http_adapter())
+    return session
+
+
+@lru_cache(maxsize=None)
+def use_http_pool():
+    # The openai client (used by ChatOpenAI and the embeddings) calls this
+    # factory for the session of each thread since 0.27.8
+    openai.requestssession = create_http_session
+
 
-        llm_predictor = LLMPredictor(
-            llm=ChatOpenAI(
-                temperature=0.3, model_name="gpt-3.5-turbo", max_tokens=num_outputs
+@lru_cache(maxsize=None)
+def load_llm(
+    temperature=DEFAULT_TEMPERATURE,
+    model_name=DEFAULT_MODEL_NAME,
+    max_tokens=DEFAULT_NUM_OUTPUTS,
+):
+    if FAKE_LLM:
+        return FakeLLM()
+    use_http_pool()
+    return ChatOpenAI(
+        temperature=temperature, model_name=model_name, max_tokens=max_tokens
+    )
+
+
+@lru_cache(maxsize=None)
+def _build_service_context(
+    temperature,
+    model_name,
+    num_outputs,
+    max_input_size,
+    max_chunk_overlap,
+    embedding_cache,
+):
+    prompt_helper = PromptHelper(
+        max_input_size,
+        num_outputs,
+        max_chunk_overlap,
+    )
+
+    llm = load_llm(
+        temperature=temperature, model_name=model_name, max_tokens=num_outputs
+    )
+    # Same as LLMPredictor, plus token streaming for chat models
+    llm_predictor = StreamingLLMPredictor(
+        llm=llm, stream_fn=llm.stream_tokens if FAKE_LLM else None
+    )
+
+    embed_model = FakeEmbedding() if FAKE_LLM else OpenAIEmbedding()
+    if embedding_cache is not None:
+        embed_model = CachedEmbedding(embed_model, embedding_cache)
+
+    node_parser = None
+    if INDEX_CHUNK_SIZE:
+        # llama_index's own splitter would keep its 200 token overlap, which
+        # leaves nothing of a small chunk but the overlap
+        node_parser = SimpleNodeParser(
+            text_splitter=TokenTextSplitter(
+                chunk_size=INDEX_CHUNK_SIZE, chunk_overlap=max_chunk_overlap
             )
         )
 
-        service_context = ServiceContext.from_defaults(
-            llm_predictor=llm_predictor, prompt_helper=prompt_helper
-        )
+    return ServiceContext.from_defaults(
+        llm_predictor=llm_predictor,
+        prompt_helper=prompt_helper,
+        embed_model=embed_model,
+        node_parser=node_parser,
+        chunk_size_limit=INDEX_CHUNK_SIZE or None,
+    )
 
-        return service_context
+
+def load_service_context(
+    temperature=DEFAULT_TEMPERATURE,
+    model_name=DEFAULT_MODEL_NAME,
+    num_outputs=DEFAULT_NUM_OUTPUTS,
+    max_input_size=DEFAULT_MAX_INPUT_SIZE,
+    max_chunk_overlap=DEFAULT_MAX_CHUNK_OVERLAP,
+    embedding_cache=None,
+):
+    try:
+        # Built once per process for each distinct set of parameters
+        return _build_service_context(
+            temperature,
+            model_name,
+            num_outputs,
+            max_input_size,
+            max_chunk_overlap,
+            embedding_cache,
+        )
 
     except Exception as e:
         print("Error loading service context", e)
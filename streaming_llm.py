@@ -0,0 +1,88 @@
+from typing import Any, Callable, Generator, Iterable, Optional, Tuple
+from langchain.chat_models import ChatOpenAI
+from llama_index import LLMPredictor
+from llama_index.prompts.base import Prompt
+from tracing import span, start_span
+
+# langchain message types -> OpenAI chat roles
+MESSAGE_ROLES = {"human": "user", "ai": "assistant", "system": "system"}
+
+
+class StreamingLLMPredictor(LLMPredictor):
+    """LLMPredictor whose stream() also works for chat models.
+
+    llama_index only streams completion models. Chat models are streamed with
+    ChatCompletion(stream=True), and `stream_fn(formatted_prompt)` can replace
+    the model altogether (see fake_llm.py).
+    """
+
+    def __init__(
+        self,
+        llm: Any,
+        stream_fn: Optional[Callable[[str], Iterable[str]]] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(llm=llm, **kwargs)
+        self._stream_fn = stream_fn
+
+    def predict(self, prompt: Prompt, **prompt_args: Any) -> Tuple[str, str]:
+        with span("llm", model=self._model_name()) as llm_span:
+            tokens_before = self._total_tokens_used
+            prediction, formatted_prompt = super().predict(prompt, **prompt_args)
+            tokens = self._total_tokens_used - tokens_before
+            completion_tokens = self._count_tokens(prediction)
+            llm_span.set(
+                prompt_tokens=tokens - completion_tokens,
+                completion_tokens=completion_tokens,
+            )
+        return prediction, formatted_prompt
+
+    def stream(self, prompt: Prompt, **prompt_args: Any) -> Tuple[Generator, str]:
+        formatted_prompt = prompt.format(llm=self._llm, **prompt_args)
+        if self._stream_fn is not None:
+            tokens = self._stream_fn(formatted_prompt)
+        elif isinstance(self._llm, ChatOpenAI):
+            tokens = self._stream_chat(prompt, prompt_args)
+        else:
+            return super().stream(prompt, **prompt_args)
+        return self._count_stream(tokens, formatted_prompt), formatted_prompt
+
+    def _stream_chat(self, prompt, prompt_args):
+        lc_prompt = prompt.get_langchain_prompt(llm=self._llm)
+        full_prompt_args = prompt.get_full_format_args(dict(prompt_args))
+        full_prompt_args.pop("stop", None)
+        messages = lc_prompt.format_prompt(**full_prompt_args).to_messages()
+
+        # Same parameters and retries as ChatOpenAI uses for predict()
+        message_dicts, params = self._llm._create_message_dicts(messages, stop=None)
+        params["stream"] = True
+        response = self._llm.completion_with_retry(messages=message_dicts, **params)
+        for chunk in response:
+            content = chunk["choices"][0]["delta"].get("content")
+            if content:
+                yield content
+
+    def _count_stream(self, tokens, formatted_prompt):
+        # Tokens are counted once the answer is complete. The span isn't made
+        # the active one, the caller runs between the tokens.
+        llm_span = start_span("llm", model=self._model_name(), stream=True)
+        parts = []
+        try:
+            for token in tokens:
+                if not parts:
+                    llm_span.set(first_token_ms=llm_span.elapsed_ms())
+                parts.append(token)
+                yield token
+        finally:
+            usage = self._count_tokens(formatted_prompt + "".join(parts))
+            self._total_tokens_used += usage
+            self.last_token_usage = usage
+            completion_tokens = self._count_tokens("".join(parts))
+            llm_span.set(
+                prompt_tokens=usage - completion_tokens,
+                completion_tokens=completion_tokens,
+            )
+            llm_span.end()
+
+    def _model_name(self):
+        return getattr(self._llm, "model_name", type(self._llm).__name__)
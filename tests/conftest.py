@@ -0,0 +1,76 @@
+import os
+import sys
+import pytest
+
+# The fake models of fake_llm.py instead of OpenAI, read when the modules load
+os.environ.setdefault("FAKE_LLM", "1")
+os.environ.setdefault("FAKE_LLM_LATENCY", "0")
+os.environ.setdefault("FAKE_LLM_TOKEN_DELAY", "0")
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, "benchmarks")]
+
+from llama_index.data_structs.node_v2 import DocumentRelationship, Node
+from custom_class import CustomGPTSimpleVectorIndex
+from fakes import FakeBucket, install
+from service_context import load_service_context
+import embedding_cache
+import index_store
+
+# firebase_utils creates its clients from these fakes, for the entry points
+firestore_db, storage_bucket = install()
+
+
+@pytest.fixture
+def service_context():
+    return load_service_context(temperature=0.2)
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_store, "LOCAL_INDEX_DIR", str(tmp_path / "gptIndices"))
+    return FakeBucket()
+
+
+@pytest.fixture
+def firebase(tmp_path, monkeypatch):
+    # The Firestore client and the bucket of firebase_utils, emptied per test
+    monkeypatch.setattr(index_store, "LOCAL_INDEX_DIR", str(tmp_path / "gptIndices"))
+    monkeypatch.setattr(
+        embedding_cache, "LOCAL_CACHE_DIR", str(tmp_path / "embeddingCache")
+    )
+    for collection in firestore_db._collections.values():
+        collection._documents.clear()
+    storage_bucket._blobs.clear()
+    return firestore_db, storage_bucket
+
+
+def make_nodes(texts_by_doc):
+    # {doc_id: [chunk text, ...]} -> nodes with stable ids
+    return [
+        Node(
+            text=text,
+            doc_id=f"{doc_id}-{position}",
+            relationships={DocumentRelationship.SOURCE: doc_id},
+        )
+        for doc_id, texts in texts_by_doc.items()
+        for position, text in enumerate(texts)
+    ]
+
+
+def make_index(service_context, texts_by_doc, nodes=None):
+    if nodes is None:
+        nodes = make_nodes(texts_by_doc)
+    return CustomGPTSimpleVectorIndex(nodes=nodes, service_context=service_context)
+
+
+def live_doc_ids(index):
+    # doc_id -> sorted texts of the chunks listed under it
+    return {
+        doc_id: sorted(
+            index.docstore.get_node(index.index_struct.nodes_dict[text_id]).text
+            for text_id in text_ids
+        )
+        for doc_id, text_ids in index.index_struct.doc_id_dict.items()
+    }
@@ -0,0 +1,90 @@
+import numpy as np
+import index_store
+from ann_index import IVFIndex, recall_report
+from custom_class import CustomGPTSimpleVectorIndex
+from conftest import make_index
+from llama_index.vector_stores.types import VectorStoreQuery
+from numpy_vector_store import NumpyVectorStore, normalize_rows
+
+rng = np.random.default_rng(0)
+
+
+def clustered_rows(num_rows=2000, dim=32, num_topics=40):
+    # Chunks of a knowledge base gather around a few topics
+    topics = rng.normal(size=(num_topics, dim))
+    rows = topics[rng.integers(num_topics, size=num_rows)]
+    rows += 0.3 * rng.normal(size=(num_rows, dim))
+    matrix, _ = normalize_rows(rows)
+    return matrix
+
+
+def exact_ids(vector_store, query, k):
+    result = vector_store.query(
+        VectorStoreQuery(query_embedding=query, similarity_top_k=k)
+    )
+    return result.ids
+
+
+def test_recall_grows_with_the_probes_and_is_exact_probing_all_lists():
+    matrix = clustered_rows()
+    ivf_index = IVFIndex.build(matrix)
+    assert sorted(ivf_index.list_rows.tolist()) == list(range(len(matrix)))
+
+    report = recall_report(matrix, ivf_index, nprobes=[1, 8, ivf_index.nlist])
+    recalls = [line["recall_at_10"] for line in report]
+    assert recalls == sorted(recalls)
+    assert recalls[1] >= 0.9 and recalls[2] == 1.0
+
+    loaded = IVFIndex.from_bytes(ivf_index.to_bytes())
+    np.testing.assert_array_equal(loaded.list_rows, ivf_index.list_rows)
+    np.testing.assert_array_equal(loaded.centroids, ivf_index.centroids)
+
+
+def test_vector_store_queries_through_the_ann_index():
+    matrix = clustered_rows()
+    ids = [f"node-{row}" for row in range(len(matrix))]
+    doc_ids = [f"doc-{row}" for row in range(len(matrix))]
+    exact = NumpyVectorStore.from_arrays(ids, doc_ids, matrix, np.ones(len(matrix)))
+    vector_store = NumpyVectorStore.from_arrays(
+        ids, doc_ids, matrix, np.ones(len(matrix))
+    )
+    ivf_index = IVFIndex.build(matrix)
+    vector_store.attach_ann(ivf_index, nprobe=ivf_index.nlist)
+
+    # Rows added or deleted after the ANN index was built
+    extra = clustered_rows(num_rows=20)
+    for store in (exact, vector_store):
+        store.add_arrays(
+            [f"extra-{row}" for row in range(20)],
+            [f"extra-doc-{row}" for row in range(20)],
+            extra,
+            np.ones(20, np.float32),
+        )
+        store.delete("doc-0")
+        store.delete("extra-doc-0")
+
+    queries = [matrix[0], extra[0]] + list(clustered_rows(num_rows=10))
+    for query in queries:
+        assert exact_ids(vector_store, query, 10) == exact_ids(exact, query, 10)
+
+    # A single probed list holds fewer rows than asked for: exact search
+    vector_store.attach_ann(ivf_index, nprobe=1)
+    k = len(matrix) // 2
+    assert exact_ids(vector_store, matrix[1], k) == exact_ids(exact, matrix[1], k)
+
+
+def test_ann_index_is_saved_with_large_indices(bucket, service_context, monkeypatch):
+    monkeypatch.setattr(index_store, "ANN_MIN_ROWS", 50)
+    texts = {f"doc_{i}": [f"chunk {i} {word}" for word in "abc"] for i in range(20)}
+    index_store._save_binary(bucket, "idx", make_index(service_context, texts))
+    loaded = index_store.load_index(
+        bucket, "idx", CustomGPTSimpleVectorIndex, service_context=service_context
+    )
+    assert loaded.vector_store.ann_index.num_rows == 60
+
+    monkeypatch.setattr(index_store, "ANN_MIN_ROWS", 100)
+    index_store._save_binary(bucket, "small", make_index(service_context, texts))
+    loaded = index_store.load_index(
+        bucket, "small", CustomGPTSimpleVectorIndex, service_context=service_context
+    )
+    assert loaded.vector_store.ann_index is None
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+import answer_cache
+from answer_cache import AnswerCache
+
+
+def blob(name="idx.manifest.json", generation=1):
+    return SimpleNamespace(name=name, generation=generation)
+
+
+def test_exact_and_semantic_hits():
+    cache = AnswerCache(similarity=0.9)
+    cache.put(blob(), "What is the refund policy?", [1.0, 0.0], "30 days")
+
+    assert cache.get_exact(blob(), "  what is the REFUND policy ") == "30 days"
+    assert cache.get_exact(blob(), "What is the shipping policy?") is None
+    # Close enough to the cached question's embedding, or not
+    assert cache.get_similar(blob(), [0.95, 0.1]) == "30 days"
+    assert cache.get_similar(blob(), [0.7, 0.7]) is None
+    assert cache.stats() == {
+        "entries": 1,
+        "exact_hits": 1,
+        "semantic_hits": 1,
+        "misses": 1,
+        "evictions": 0,
+        "hit_rate": 0.6667,
+    }
+
+
+def test_answers_are_scoped_to_one_index_generation():
+    cache = AnswerCache()
+    cache.put(blob(), "question", [1.0, 0.0], "old answer")
+    cache.put(blob("other.manifest.json"), "question", [1.0, 0.0], "other answer")
+
+    assert cache.get_exact(blob(generation=2), "question") is None
+    assert cache.get_similar(blob(generation=2), [1.0, 0.0]) is None
+    # Dropped once the new generation was seen, other indices are kept
+    assert cache.get_exact(blob(generation=1), "question") is None
+    assert cache.get_exact(blob("other.manifest.json"), "question") == "other answer"
+    assert cache.stats()["entries"] == 1
+
+
+def test_expired_and_least_recently_used_answers_are_dropped(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(answer_cache.time, "monotonic", lambda: now[0])
+    cache = AnswerCache(ttl=60, max_entries=2)
+    cache.put(blob(), "first", [1.0, 0.0], "1")
+    cache.put(blob(), "second", [0.0, 1.0], "2")
+    assert cache.get_exact(blob(), "first") == "1"
+    cache.put(blob(), "third", [-1.0, 0.0], "3")
+
+    assert cache.get_exact(blob(), "second") is None
+    assert cache.stats()["evictions"] == 1
+
+    now[0] = 61.0
+    assert cache.get_exact(blob(), "first") is None
+    assert cache.get_similar(blob(), [-1.0, 0.0]) is None
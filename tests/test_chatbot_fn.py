@@ -0,0 +1,57 @@
+import pytest
+import chatbot_fn
+import index_store
+from answer_cache import AnswerCache
+from custom_class import CustomGPTSimpleVectorIndex
+from fake_llm import FakeLLM
+from index_cache import IndexCache
+from conftest import make_index
+
+TEXTS = {
+    "doc_a": ["alpha one two three four five six"],
+    "doc_b": ["beta seven eight nine ten eleven"],
+}
+
+
+@pytest.fixture
+def chatbot(firebase, service_context, monkeypatch):
+    # An index in the bucket of the entry points, and cold caches
+    _, bucket = firebase
+    index_store.update_index(
+        bucket,
+        "idx",
+        [("insert", make_index(service_context, TEXTS))],
+        CustomGPTSimpleVectorIndex,
+        service_context=service_context,
+    )
+    monkeypatch.setattr(chatbot_fn, "index_cache", IndexCache())
+    monkeypatch.setattr(chatbot_fn, "answer_cache", AnswerCache())
+
+    completions = []
+    stream_tokens = FakeLLM.stream_tokens
+
+    def counted(self, prompt):
+        completions.append(prompt)
+        return stream_tokens(self, prompt)
+
+    monkeypatch.setattr(FakeLLM, "stream_tokens", counted)
+    return completions
+
+
+def test_batch_answers_each_question_once(chatbot):
+    completions = chatbot
+    questions = ["What is alpha?", "what is  alpha", "What is beta?", "What is beta"]
+
+    result = chatbot_fn.chatbot_batch_fn(questions, "idx", concurrency=2)
+
+    answers = result["answers"]
+    assert [answer["question"] for answer in answers] == questions
+    assert all(answer["response"] and not answer["cached"] for answer in answers)
+    assert answers[0]["response"] == answers[1]["response"]
+    assert answers[2]["response"] == answers[3]["response"]
+    # Questions differing only in case, spacing and punctuation share a completion
+    assert len(completions) == 2
+
+    result = chatbot_fn.chatbot_batch_fn(questions, "idx")
+    assert all(answer["cached"] for answer in result["answers"])
+    assert len(completions) == 2
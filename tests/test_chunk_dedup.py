@@ -0,0 +1,119 @@
+import random
+import index_store
+from chunk_dedup import dedup_nodes, shared_doc_ids
+from custom_class import CustomGPTSimpleVectorIndex
+from conftest import live_doc_ids, make_index, make_nodes
+
+rng = random.Random(0)
+VOCABULARY = [f"word{i}" for i in range(500)]
+
+
+def words(count):
+    return [rng.choice(VOCABULARY) for _ in range(count)]
+
+
+BOILERPLATE = " ".join(words(150))
+
+
+def test_exact_and_near_duplicates_are_collapsed():
+    near = BOILERPLATE.split()
+    near[75] = "changed"
+    half = BOILERPLATE.split()[:75] + words(75)
+    nodes = make_nodes(
+        {
+            "doc_a": [BOILERPLATE, " ".join(words(150))],
+            "doc_b": ["  " + BOILERPLATE.upper() + "\n"],
+            "doc_c": [" ".join(near)],
+            "doc_d": [" ".join(half)],
+        }
+    )
+
+    kept, report = dedup_nodes(nodes, threshold=0.9)
+
+    assert [node.ref_doc_id for node in kept] == ["doc_a", "doc_a", "doc_d"]
+    assert shared_doc_ids(kept[0]) == ["doc_a", "doc_b", "doc_c"]
+    assert shared_doc_ids(kept[1]) == shared_doc_ids(kept[2]) == []
+    assert report["exact_duplicates"] == 1 and report["near_duplicates"] == 1
+
+    kept, report = dedup_nodes(nodes, threshold=1)
+    assert len(kept) == 4 and report["near_duplicates"] == 0
+
+
+def shared_index(service_context):
+    nodes, _ = dedup_nodes(
+        make_nodes(
+            {
+                "doc_a": [BOILERPLATE, "only in a"],
+                "doc_b": [BOILERPLATE, "only in b"],
+                "doc_c": [BOILERPLATE],
+            }
+        )
+    )
+    return make_index(service_context, None, nodes=nodes)
+
+
+def test_shared_chunk_is_reference_counted_on_delete(service_context):
+    index = shared_index(service_context)
+    assert index.vector_store.num_nodes == 3
+    assert live_doc_ids(index) == {
+        "doc_a": sorted([BOILERPLATE, "only in a"]),
+        "doc_b": sorted([BOILERPLATE, "only in b"]),
+        "doc_c": [BOILERPLATE],
+    }
+
+    # doc_a owned the shared chunk, it moves to doc_b
+    index.delete("doc_a")
+    assert live_doc_ids(index) == {
+        "doc_b": sorted([BOILERPLATE, "only in b"]),
+        "doc_c": [BOILERPLATE],
+    }
+    ids, doc_ids, _, _ = index.vector_store.to_arrays()
+    assert sorted(doc_ids) == ["doc_b", "doc_b"]
+
+    index.delete("doc_b")
+    assert live_doc_ids(index) == {"doc_c": [BOILERPLATE]}
+    assert index.vector_store.num_nodes == 1
+
+    index.delete("doc_c")
+    assert live_doc_ids(index) == {}
+    assert index.vector_store.num_nodes == 0
+    assert len(index.docstore.docs) == 0
+
+
+def test_references_survive_tombstones_and_compaction(bucket, service_context):
+    def update(change):
+        index_store.update_index(
+            bucket,
+            "idx",
+            [change],
+            CustomGPTSimpleVectorIndex,
+            service_context=service_context,
+        )
+
+    def load():
+        return index_store.load_index(
+            bucket, "idx", CustomGPTSimpleVectorIndex, service_context=service_context
+        )
+
+    update(("insert", make_index(service_context, {"doc_x": ["unrelated"]})))
+    update(("insert", shared_index(service_context)))
+    update(("delete", ["doc_a"]))
+    assert live_doc_ids(load()) == {
+        "doc_x": ["unrelated"],
+        "doc_b": sorted([BOILERPLATE, "only in b"]),
+        "doc_c": [BOILERPLATE],
+    }
+
+    index_store.compact_index(
+        bucket, "idx", CustomGPTSimpleVectorIndex, service_context=service_context
+    )
+    update(("delete", ["doc_b"]))
+    index = load()
+    assert live_doc_ids(index) == {"doc_x": ["unrelated"], "doc_c": [BOILERPLATE]}
+    shared = index.docstore.get_node(
+        index.index_struct.nodes_dict[index.index_struct.doc_id_dict["doc_c"][0]]
+    )
+    assert shared.ref_doc_id == "doc_c" and shared_doc_ids(shared) == []
+
+    update(("delete", ["doc_c"]))
+    assert live_doc_ids(load()) == {"doc_x": ["unrelated"]}
@@ -0,0 +1,57 @@
+import gzip
+import json
+import pytest
+import compression
+from compression import JsonDecoder, decode_json, download_json, encode_json
+from fakes import FakeBucket
+
+# Multi-byte characters, split across the chunks written to the decoder
+OBJ = {
+    "embedding_dict": {f"node-{i}": [i / 7, -i / 3] for i in range(2000)},
+    "text": "naïve café ✓ " * 500,
+}
+
+
+@pytest.fixture(params=["gzip", "zstd", "none"])
+def method(request, monkeypatch):
+    if request.param == "zstd" and compression.zstandard is None:
+        pytest.skip("zstandard is not installed")
+    # Several compressed chunks even for this small object
+    monkeypatch.setattr(compression, "ENCODE_CHUNK_SIZE", 1000)
+    return request.param
+
+
+def test_round_trip_written_in_small_pieces(method):
+    data, content_type = encode_json(OBJ, compression=method)
+    assert content_type == compression.CONTENT_TYPES[method]
+    if method != "none":
+        assert len(data) < len(json.dumps(OBJ)) / 2
+
+    decoder = JsonDecoder()
+    for start in range(0, len(data), 3):
+        decoder.write(data[start : start + 3])
+    assert decoder.load() == OBJ
+    assert decoder.compressed_size == len(data)
+    assert decoder.text_size == len(json.dumps(OBJ, separators=(",", ":")).encode())
+
+
+def test_download_json_streams_the_blob(method):
+    blob = FakeBucket().blob("idx.meta.json")
+    data, content_type = encode_json(OBJ, compression=method)
+    blob.upload_from_string(data, content_type=content_type)
+    blob.reload()
+
+    loaded, size = download_json(blob, blob.generation)
+    assert loaded == OBJ
+    assert size == len(json.dumps(OBJ, separators=(",", ":")).encode())
+
+
+def test_blobs_written_before_compression_still_load(monkeypatch):
+    assert decode_json(json.dumps(OBJ).encode()) == OBJ
+    # Shorter than the magic bytes
+    assert decode_json(b"{}") == {}
+    assert decode_json(gzip.compress(b'{"a": 1}')) == {"a": 1}
+
+    monkeypatch.setattr(compression, "zstandard", None)
+    data, content_type = encode_json(OBJ, compression="zstd")
+    assert content_type == "application/gzip" and decode_json(data) == OBJ
@@ -0,0 +1,39 @@
+import os
+import threading
+import embedding_cache
+from embedding_cache import EmbeddingCache
+from fakes import FakeBucket, Latency
+
+MODEL = "model"
+TEXTS = [f"chunk {i}" for i in range(64)]
+EMBEDDINGS = [[float(i), 1.0] for i in range(64)]
+
+
+def test_concurrent_shard_loads_share_the_local_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, "LOCAL_CACHE_DIR", str(tmp_path))
+    # Slow enough that the downloads overlap
+    bucket = FakeBucket(latency=Latency(0.02))
+    writer = EmbeddingCache(bucket)
+    writer.put_many(MODEL, TEXTS, EMBEDDINGS)
+    writer.flush()
+
+    results = []
+    errors = []
+
+    def get_all():
+        # One cache per thread, like separate instances sharing /tmp
+        try:
+            results.append(EmbeddingCache(bucket).get_many(MODEL, TEXTS))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=get_all) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert results == [EMBEDDINGS] * 8
+    assert len(os.listdir(tmp_path)) == embedding_cache.NUM_SHARDS
+    assert not any(name.endswith(".part") for name in os.listdir(tmp_path))
@@ -0,0 +1,78 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from index_cache import IndexCache
+
+
+def blob(name, generation=1):
+    return SimpleNamespace(name=name, generation=generation)
+
+
+def test_evicts_least_recently_used_beyond_the_byte_budget():
+    cache = IndexCache(max_bytes=100)
+    loads = []
+
+    def load(size):
+        def load_fn(blob):
+            loads.append(blob.name)
+            return f"{blob.name}@{blob.generation}", size
+
+        return load_fn
+
+    assert cache.get(blob("a"), load(40)) == "a@1"
+    assert cache.get(blob("b"), load(40)) == "b@1"
+    # A hit makes "a" the most recently used
+    assert cache.get(blob("a"), load(40)) == "a@1"
+    cache.get(blob("c"), load(40))
+    assert list(cache._entries) == ["a", "c"] and cache._total_bytes == 80
+
+    # A new generation replaces the entry, too big an index isn't kept
+    assert cache.get(blob("a", 2), load(40)) == "a@2"
+    cache.get(blob("d"), load(200))
+    assert list(cache._entries) == ["c", "a"]
+    assert loads == ["a", "b", "c", "a", "d"]
+    assert (cache.hits, cache.misses) == (1, 5)
+
+
+def test_concurrent_misses_share_one_load():
+    cache = IndexCache()
+    started = threading.Event()
+    release = threading.Event()
+    loads = []
+
+    def load_fn(blob):
+        loads.append(blob.generation)
+        started.set()
+        release.wait(5)
+        return "index", 10
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get(blob("a"), load_fn)))
+        for _ in range(8)
+    ]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # Gives the others time to find the load in progress
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert loads == [1] and results == ["index"] * 8
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_failed_load_is_raised_and_not_cached():
+    cache = IndexCache()
+
+    def failing_load(blob):
+        raise FileNotFoundError(blob.name)
+
+    with pytest.raises(FileNotFoundError):
+        cache.get(blob("a"), failing_load)
+    assert cache._loading == {}
+    assert cache.get(blob("a"), lambda blob: ("index", 10)) == "index"
@@ -0,0 +1,90 @@
+import pytest
+from llama_index import Document
+import index_docs_fn
+import index_jobs
+import index_store
+from custom_class import CustomGPTSimpleVectorIndex
+from conftest import live_doc_ids
+
+TEXTS = {f"file{i}": f"contents of file {i} " * 20 for i in range(6)}
+
+
+@pytest.fixture
+def backlog(firebase, monkeypatch):
+    # Six unindexed documents, "downloaded" without a file server
+    db, bucket = firebase
+    monkeypatch.setattr(index_docs_fn, "embedding_cache", None)
+    for name in TEXTS:
+        db.collection("documents").document(name).set(
+            {"url": f"https://files/{name}", "indexed": False}
+        )
+
+    def download(urls):
+        return [
+            Document(
+                TEXTS[url.rsplit("/", 1)[1]],
+                doc_id=f"doc_id_{url.rsplit('/', 1)[1]}",
+                extra_info={"url": url},
+            )
+            for url in urls
+        ]
+
+    monkeypatch.setattr(index_jobs, "download_files_and_create_documents", download)
+    return db, bucket
+
+
+def indexed_doc_ids(bucket, service_context):
+    index = index_store.load_index(
+        bucket, "idx", CustomGPTSimpleVectorIndex, service_context=service_context
+    )
+    return {doc_id: len(texts) for doc_id, texts in live_doc_ids(index).items()}
+
+
+def test_chunk_stored_before_a_crash_is_not_indexed_twice(
+    backlog, service_context, monkeypatch
+):
+    db, bucket = backlog
+    checkpoint = index_jobs._checkpoint
+
+    def crash_after_upload(job_ref, job, state):
+        if state and state["stage"] == "uploaded" and job["chunks_done"] == 1:
+            raise RuntimeError("instance stopped")
+        checkpoint(job_ref, job, state)
+
+    monkeypatch.setattr(index_jobs, "_checkpoint", crash_after_upload)
+    job_id = index_jobs.start_job("idx", chunk_size=2)
+    status = index_jobs.run_job(job_id)
+    # The second chunk's segment is committed, its checkpoint isn't
+    assert status["status"] == "error" and status["checkpoint"] == "indexing"
+    assert status["documents_done"] == 2
+    assert len(index_store.read_manifest(bucket, "idx")["segments"]) == 1
+
+    monkeypatch.setattr(index_jobs, "_checkpoint", checkpoint)
+    status = index_jobs.run_job(job_id)
+    assert status["status"] == "done" and status["documents_done"] == 6
+    # One chunk per document, none of them twice
+    assert indexed_doc_ids(bucket, service_context) == {
+        f"doc_id_{name}": 1 for name in TEXTS
+    }
+
+
+def test_overlapping_triggers_share_the_backlog(backlog, service_context):
+    db, bucket = backlog
+    job_id = index_jobs.start_job("idx", chunk_size=2)
+    assert index_jobs.start_job("idx") == job_id
+
+    # While a job for another index holds the backlog, this one waits
+    other_id = index_jobs.start_job("other", chunk_size=2)
+    assert other_id != job_id
+    other_ref = index_jobs.jobs_ref.document(other_id)
+    assert index_jobs._acquire_lease(db.transaction(), other_ref, "runner")
+    assert index_jobs.run_job(job_id)["status"] == "pending"
+
+    index_jobs._update_lease(
+        db.transaction(), other_ref, "runner", {"status": "paused", "lease_until": 0}
+    )
+    status = index_jobs.run_job(job_id)
+    assert status["status"] == "done" and status["documents_done"] == 6
+    assert indexed_doc_ids(bucket, service_context) == {
+        f"doc_id_{name}": 1 for name in TEXTS
+    }
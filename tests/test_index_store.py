@@ -0,0 +1,259 @@
+import json
+import os
+import threading
+import numpy as np
+import index_store
+from custom_class import CustomGPTSimpleVectorIndex
+from conftest import live_doc_ids, make_index
+
+TEXTS = {
+    "doc_a": ["alpha one two three", "alpha four five six"],
+    "doc_b": ["beta seven eight nine"],
+    "doc_c": ["gamma ten eleven twelve", "gamma thirteen fourteen"],
+}
+
+
+def load(bucket, service_context, name="idx"):
+    return index_store.load_index(
+        bucket, name, CustomGPTSimpleVectorIndex, service_context=service_context
+    )
+
+
+def assert_same_index(loaded, original):
+    ids, doc_ids, matrix, norms = original.vector_store.to_arrays()
+    loaded_ids, loaded_doc_ids, loaded_matrix, loaded_norms = (
+        loaded.vector_store.to_arrays()
+    )
+    assert sorted(loaded_ids) == sorted(ids)
+    rows = {text_id: row for row, text_id in enumerate(loaded_ids)}
+    order = [rows[text_id] for text_id in ids]
+    assert [loaded_doc_ids[row] for row in order] == doc_ids
+    np.testing.assert_allclose(loaded_matrix[order], matrix, atol=1e-6)
+    np.testing.assert_allclose(loaded_norms[order], norms, rtol=1e-6)
+    assert live_doc_ids(loaded) == live_doc_ids(original)
+
+
+def test_binary_round_trip(bucket, service_context):
+    index = make_index(service_context, TEXTS)
+    index_store._save_binary(bucket, "idx", index)
+
+    loaded = load(bucket, service_context)
+    assert_same_index(loaded, index)
+    # The embeddings are memory-mapped from the local copy
+    assert isinstance(loaded.vector_store.to_arrays()[2], np.memmap)
+
+
+def test_legacy_json_round_trip(bucket, service_context):
+    index = make_index(service_context, TEXTS)
+    index_json = index.save_to_string()
+    embeddings, meta = index_store.json_to_binary(index_json)
+    assert json.loads(index_store.binary_to_json(embeddings, meta)) == json.loads(
+        index_json
+    )
+
+    # Still read when only the old {name}.json exists
+    bucket.blob(index_store.legacy_blob_path("idx")).upload_from_string(index_json)
+    assert_same_index(load(bucket, service_context), index)
+
+
+def update(bucket, service_context, change):
+    return index_store.update_index(
+        bucket,
+        "idx",
+        [change],
+        CustomGPTSimpleVectorIndex,
+        service_context=service_context,
+    )
+
+
+def insert(bucket, service_context, texts):
+    return update(
+        bucket, service_context, ("insert", make_index(service_context, texts))
+    )
+
+
+def compact(bucket, service_context):
+    return index_store.compact_index(
+        bucket, "idx", CustomGPTSimpleVectorIndex, service_context=service_context
+    )
+
+
+def test_inserts_append_segments_without_rewriting_the_base(
+    bucket, service_context, monkeypatch
+):
+    monkeypatch.setattr(index_store, "INDEX_MAX_SEGMENTS", 2)
+    insert(bucket, service_context, {"doc_a": TEXTS["doc_a"]})
+    base = index_store.read_manifest(bucket, "idx")["base"]
+    base_blobs = {
+        path: bucket.get_blob(path).generation
+        for path in [
+            index_store.meta_blob_path(base["name"]),
+            index_store.embeddings_blob_path(base["name"]),
+        ]
+    }
+
+    insert(bucket, service_context, {"doc_b": TEXTS["doc_b"]})
+    insert(bucket, service_context, {"doc_c": TEXTS["doc_c"]})
+    manifest = index_store.read_manifest(bucket, "idx")
+    assert manifest["base"] == base and len(manifest["segments"]) == 2
+    for path, generation in base_blobs.items():
+        assert bucket.get_blob(path).generation == generation
+    assert sorted(live_doc_ids(load(bucket, service_context))) == [
+        "doc_a",
+        "doc_b",
+        "doc_c",
+    ]
+
+    # One segment too many, compacted into a new base
+    insert(bucket, service_context, {"doc_d": ["delta fifteen"]})
+    manifest = index_store.read_manifest(bucket, "idx")
+    assert manifest["base"] != base and manifest["segments"] == []
+    assert len(live_doc_ids(load(bucket, service_context))) == 4
+
+
+def test_segments_tombstones_and_compaction(bucket, service_context, monkeypatch):
+    monkeypatch.setattr(index_store, "INDEX_MAX_SEGMENTS", 100)
+
+    insert(bucket, service_context, {"doc_a": TEXTS["doc_a"]})
+    insert(bucket, service_context, {"doc_b": TEXTS["doc_b"]})
+    insert(bucket, service_context, {"doc_c": TEXTS["doc_c"]})
+    update(bucket, service_context, ("delete", ["doc_b"]))
+    # A document indexed again after its deletion is kept
+    insert(bucket, service_context, {"doc_b": ["beta again"]})
+
+    manifest = index_store.read_manifest(bucket, "idx")
+    assert len(manifest["segments"]) == 3
+    assert list(manifest["tombstones"]) == ["doc_b"]
+
+    expected = {
+        "doc_a": sorted(TEXTS["doc_a"]),
+        "doc_b": ["beta again"],
+        "doc_c": sorted(TEXTS["doc_c"]),
+    }
+    assert live_doc_ids(load(bucket, service_context)) == expected
+
+    old_blobs = [manifest["base"]["name"]] + [s["name"] for s in manifest["segments"]]
+    compact(bucket, service_context)
+    manifest = index_store.read_manifest(bucket, "idx")
+    assert manifest["segments"] == [] and manifest["tombstones"] == {}
+    compacted = load(bucket, service_context)
+    assert live_doc_ids(compacted) == expected
+    assert compacted.vector_store.num_nodes == 5
+    for name in old_blobs:
+        assert not bucket.blob(index_store.meta_blob_path(name)).exists()
+
+
+def test_update_rereads_a_manifest_replaced_before_its_download(
+    bucket, service_context, monkeypatch
+):
+    monkeypatch.setattr(index_store, "_backoff", lambda attempt: None)
+    insert(bucket, service_context, {"doc_a": TEXTS["doc_a"]})
+
+    get_blob = bucket.get_blob
+    raced = []
+
+    def racing_get_blob(name):
+        blob = get_blob(name)
+        if name == index_store.manifest_blob_path("idx") and not raced:
+            # Another writer commits between the lookup and the download
+            raced.append(name)
+            insert(bucket, service_context, {"doc_b": TEXTS["doc_b"]})
+        return blob
+
+    monkeypatch.setattr(bucket, "get_blob", racing_get_blob)
+    insert(bucket, service_context, {"doc_c": TEXTS["doc_c"]})
+
+    assert raced
+    assert sorted(live_doc_ids(load(bucket, service_context))) == [
+        "doc_a",
+        "doc_b",
+        "doc_c",
+    ]
+
+
+def test_failed_compaction_keeps_the_committed_update(
+    bucket, service_context, monkeypatch
+):
+    monkeypatch.setattr(index_store, "INDEX_MAX_SEGMENTS", 1)
+    insert(bucket, service_context, {"doc_a": TEXTS["doc_a"]})
+    insert(bucket, service_context, {"doc_b": TEXTS["doc_b"]})
+
+    def failing_compaction(*args, **kwargs):
+        raise RuntimeError("compaction failed")
+
+    monkeypatch.setattr(index_store, "compact_index", failing_compaction)
+    manifest_blob = insert(bucket, service_context, {"doc_c": TEXTS["doc_c"]})
+
+    assert manifest_blob.name == index_store.manifest_blob_path("idx")
+    assert len(index_store.read_manifest(bucket, "idx")["segments"]) == 2
+    assert "doc_c" in live_doc_ids(load(bucket, service_context))
+
+
+def test_loads_reread_the_manifest_after_a_concurrent_compaction(
+    bucket, service_context, monkeypatch
+):
+    monkeypatch.setattr(index_store, "_backoff", lambda attempt: None)
+    monkeypatch.setattr(index_store, "INDEX_MAX_SEGMENTS", 100)
+    for doc_id, texts in TEXTS.items():
+        insert(bucket, service_context, {doc_id: texts})
+    expected = live_doc_ids(load(bucket, service_context))
+
+    # A reader that looked the manifest up just before a compaction deleted
+    # the blobs it lists
+    stale_blob = index_store.get_index_blob(bucket, "idx")
+    compact(bucket, service_context)
+    index, _ = index_store.load_index_from_blob(
+        bucket, stale_blob, CustomGPTSimpleVectorIndex, service_context=service_context
+    )
+    assert live_doc_ids(index) == expected
+
+    # A compaction that read the manifest just before another one
+    insert(bucket, service_context, {"doc_d": ["delta fifteen"]})
+    read_manifest = index_store._read_manifest_for_update
+    raced = []
+
+    def racing_read(*args):
+        result = read_manifest(*args)
+        if not raced:
+            raced.append(result)
+            compact(bucket, service_context)
+        return result
+
+    monkeypatch.setattr(index_store, "_read_manifest_for_update", racing_read)
+    compact(bucket, service_context)
+
+    assert raced
+    assert index_store.read_manifest(bucket, "idx")["segments"] == []
+    assert live_doc_ids(load(bucket, service_context)) == dict(
+        expected, doc_d=["delta fifteen"]
+    )
+
+
+def test_concurrent_downloads_share_the_local_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_store, "LOCAL_INDEX_DIR", str(tmp_path))
+    # Older generation of this index, and a copy of another index sharing its prefix
+    (tmp_path / "foo-1.npy").write_bytes(b"old")
+    (tmp_path / "foo-bar-3.npy").write_bytes(b"other")
+
+    class Blob:
+        def download_to_filename(self, filename, if_generation_match=None):
+            with open(filename, "wb") as f:
+                np.save(f, np.ones((4, 2), dtype=np.float32))
+
+    errors = []
+
+    def download():
+        try:
+            array, _ = index_store._download_array(Blob(), "foo", 7)
+            assert array.shape == (4, 2)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=download) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(os.listdir(tmp_path)) == ["foo-7.npy", "foo-bar-3.npy"]
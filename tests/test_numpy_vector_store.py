@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from llama_index.data_structs.node_v2 import Node
+from llama_index.indices.query.embedding_utils import get_top_k_embeddings
+from llama_index.vector_stores.simple import SimpleVectorStore
+from llama_index.vector_stores.types import NodeEmbeddingResult, VectorStoreQuery
+from numpy_vector_store import NumpyVectorStore
+
+rng = np.random.default_rng(0)
+EMBEDDINGS = rng.normal(size=(300, 16)).astype(np.float32)
+IDS = [f"node-{row}" for row in range(len(EMBEDDINGS))]
+DOC_IDS = [f"doc-{row % 30}" for row in range(len(EMBEDDINGS))]
+
+
+def results(rows):
+    return [
+        NodeEmbeddingResult(
+            id=IDS[row],
+            node=Node(text=IDS[row], doc_id=IDS[row]),
+            embedding=EMBEDDINGS[row].tolist(),
+            doc_id=DOC_IDS[row],
+        )
+        for row in rows
+    ]
+
+
+def make_store():
+    # Added in small batches, so the matrix grows past its first capacity
+    vector_store = NumpyVectorStore()
+    for start in range(0, len(EMBEDDINGS), 50):
+        vector_store.add(results(range(start, start + 50)))
+    return vector_store
+
+
+def expected_top_k(query, k, rows=None):
+    # The pure Python top k of llama_index over the same rows
+    rows = range(len(EMBEDDINGS)) if rows is None else rows
+    similarities, ids = get_top_k_embeddings(
+        query.tolist(),
+        [EMBEDDINGS[row].tolist() for row in rows],
+        similarity_top_k=k,
+        embedding_ids=[IDS[row] for row in rows],
+    )
+    return similarities, ids
+
+
+def assert_same_result(result, expected):
+    similarities, ids = expected
+    assert result.ids == ids
+    np.testing.assert_allclose(result.similarities, similarities, atol=1e-5)
+
+
+def test_top_k_matches_the_reference():
+    vector_store = make_store()
+    for query in rng.normal(size=(10, 16)).astype(np.float32):
+        result = vector_store.query(
+            VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=5)
+        )
+        assert_same_result(result, expected_top_k(query, 5))
+
+
+def test_deleted_rows_and_doc_filters():
+    vector_store = make_store()
+    vector_store.delete("doc-3")
+    vector_store.delete_nodes(["node-0"])
+    live = [row for row in range(len(EMBEDDINGS)) if DOC_IDS[row] != "doc-3"][1:]
+    query = rng.normal(size=16).astype(np.float32)
+
+    result = vector_store.query(
+        VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=8)
+    )
+    assert_same_result(result, expected_top_k(query, 8, live))
+
+    doc_ids = ["doc-3", "doc-4", "doc-5"]
+    result = vector_store.query(
+        VectorStoreQuery(
+            query_embedding=query.tolist(), similarity_top_k=50, doc_ids=doc_ids
+        )
+    )
+    rows = [row for row in live if DOC_IDS[row] in doc_ids]
+    # Fewer rows than asked for, all of them are returned
+    assert_same_result(result, expected_top_k(query, len(rows), rows))
+
+    queries = rng.normal(size=(4, 16)).astype(np.float32)
+    for result, query in zip(vector_store.query_many(queries, 8), queries):
+        assert_same_result(result, expected_top_k(query, 8, live))
+
+
+def test_same_layout_as_simple_vector_store():
+    vector_store = make_store()
+    vector_store.delete("doc-7")
+    config = vector_store.config_dict["simple_vector_store_data_dict"]
+    assert len(config["embedding_dict"]) == 290
+    np.testing.assert_allclose(config["embedding_dict"]["node-1"], EMBEDDINGS[1])
+
+    # Readable by llama_index, and read back the same
+    SimpleVectorStore(simple_vector_store_data_dict=config)
+    reloaded = NumpyVectorStore(simple_vector_store_data_dict=config)
+    assert reloaded.to_arrays()[0] == vector_store.to_arrays()[0]
+
+    with pytest.raises(ValueError):
+        reloaded.add_arrays(["x"], ["doc-x"], np.ones((1, 8), np.float32), [1.0])
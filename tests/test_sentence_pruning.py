@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+import index_store
+import sentence_pruning
+from custom_class import CustomGPTSimpleVectorIndex
+from conftest import make_index
+from sentence_pruning import ContextPruner, SentenceStore, split_sentences
+
+SENTENCES = [
+    "The warranty covers two years.",
+    "Shipping takes five days!",
+    "Returns are free within thirty days?",
+    "Contact support by email.",
+]
+CHUNK = " ".join(SENTENCES[:3]) + "\n" + SENTENCES[3]
+SHORT_CHUNK = "Only one sentence here. And a second one."
+
+
+def question(service_context, position):
+    # A question whose embedding is exactly the one of this sentence of CHUNK
+    start, end = split_sentences(CHUNK)[position]
+    embedding = service_context.embed_model.get_text_embedding(CHUNK[start:end])
+    return SimpleNamespace(embedding=embedding)
+
+
+def sentence_store(service_context):
+    store = SentenceStore()
+    embedded = store.add_chunks([CHUNK, SHORT_CHUNK, CHUNK], service_context)
+    # Each chunk is embedded once
+    assert embedded == 6 and store.add_chunks([CHUNK], service_context) == 0
+    return store
+
+
+def test_split_sentences():
+    assert [CHUNK[start:end].strip() for start, end in split_sentences(CHUNK)] == (
+        SENTENCES
+    )
+    assert split_sentences("  \n") == []
+
+
+def test_keeps_the_sentences_most_similar_to_the_question(service_context):
+    pruner = ContextPruner([sentence_store(service_context)], percentile=0.5)
+
+    shipping = question(service_context, 1)
+    # Half of the sentences, the asked one among them, in their original order
+    assert pruner.optimize(shipping, CHUNK) in [
+        f"{SENTENCES[0]} {SENTENCES[1]}",
+        f"{SENTENCES[1]} {SENTENCES[2]}",
+        f"{SENTENCES[1]} {SENTENCES[3]}",
+    ]
+
+    # Too short, or indexed without sentence embeddings: sent whole
+    assert pruner.optimize(shipping, SHORT_CHUNK) is SHORT_CHUNK
+    assert pruner.optimize(shipping, "Not indexed. At all. Ever.") == (
+        "Not indexed. At all. Ever."
+    )
+
+    report = pruner.report()
+    assert (report["chunks"], report["pruned_chunks"]) == (3, 1)
+    assert report["tokens_saved"] > 0
+
+    # A threshold no sentence reaches still keeps the best one
+    pruner = ContextPruner([sentence_store(service_context)], threshold=1.5)
+    assert pruner.optimize(shipping, CHUNK) == SENTENCES[1]
+
+
+def test_sentence_embeddings_are_saved_with_the_segment(
+    bucket, service_context, monkeypatch
+):
+    index = make_index(service_context, {"doc_a": [CHUNK], "doc_b": [SHORT_CHUNK]})
+    index.sentence_store = sentence_store(service_context)
+    index_store.update_index(
+        bucket,
+        "idx",
+        [("insert", index)],
+        CustomGPTSimpleVectorIndex,
+        service_context=service_context,
+    )
+    loaded = index_store.load_index(
+        bucket, "idx", CustomGPTSimpleVectorIndex, service_context=service_context
+    )
+    assert len(loaded.sentence_store) == 2
+    embeddings, spans = loaded.sentence_store.get(CHUNK)
+    assert spans == split_sentences(CHUNK) and embeddings.shape[0] == 4
+
+    monkeypatch.setattr(sentence_pruning, "CONTEXT_PRUNING_PERCENTILE", 0)
+    assert sentence_pruning.context_pruner(loaded) is None
+    monkeypatch.setattr(sentence_pruning, "CONTEXT_PRUNING_PERCENTILE", 0.5)
+    pruner = sentence_pruning.context_pruner(loaded)
+    shipping = question(service_context, 1)
+    assert SENTENCES[1] in pruner.optimize(shipping, CHUNK)
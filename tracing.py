@@ -0,0 +1,246 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Structured timing of the stages of a request. A span times one stage
+# (download, parse, chunk, embed, index load, retrieve, LLM call, serialize,
+# upload, Firestore write) and is logged as one JSON line when it ends, with
+# its duration and counters like bytes and tokens. Spans inside another span
+# share its trace id, so the lines of one request can be put together. Cloud
+# Logging turns JSON lines on stdout into structured entries.
+#
+#   with span("embed", chunks=len(texts)) as s:
+#       ...
+#       s.set(tokens=tokens)
+
+# 0 stops the JSON lines, e.g. when only exporting
+TRACE_LOG = os.getenv("TRACE_LOG", "1") == "1"
+# "otlp" also exports the spans with OpenTelemetry, to the collector set by the
+# usual OTEL_EXPORTER_OTLP_* variables
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "")
+# Set by Cloud Functions, links the lines to the request's trace in the console
+PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", os.getenv("GCP_PROJECT", ""))
+
+_current = contextvars.ContextVar("current_span", default=None)
+_exporter = None
+_exporter_lock = threading.Lock()
+_listeners = []
+
+
+class Span:
+    def __init__(self, name, parent=None, attributes=None):
+        # parent: (trace_id, span_id) of the parent span, or None for a new trace
+        self.name = name
+        self.trace_id, self.parent_id = parent or (uuid.uuid4().hex, None)
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start_time = time.time()
+        self.duration_ms = None
+        self._start = time.perf_counter()
+
+    @property
+    def context(self):
+        # Handed to work running in other threads or processes
+        return (self.trace_id, self.span_id)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self._start) * 1000, 2)
+
+    def end(self):
+        if self.duration_ms is None:
+            self.duration_ms = self.elapsed_ms()
+            _emit(self)
+
+    def to_dict(self):
+        entry = {
+            "severity": "ERROR" if self.error else "INFO",
+            "message": f"{self.name} {self.duration_ms} ms",
+            "span": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "duration_ms": self.duration_ms,
+            **self.attributes,
+        }
+        if self.error:
+            entry["error"] = self.error
+        if PROJECT_ID:
+            entry["logging.googleapis.com/trace"] = (
+                f"projects/{PROJECT_ID}/traces/{self.trace_id}"
+            )
+            entry["logging.googleapis.com/spanId"] = self.span_id
+        return entry
+
+
+def current_context():
+    # (trace_id, span_id) of the active span, for span(parent=...) elsewhere
+    current = _current.get()
+    return current.context if current is not None else None
+
+
+def start_span(name, parent=None, **attributes):
+    # A span that isn't made the active one, for generators that yield while it
+    # runs. It is emitted by end().
+    return Span(name, parent or current_context(), attributes)
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    # Threads and processes don't see the active span, pass parent=current_context()
+    active = start_span(name, parent, **attributes)
+    previous = _current.get()
+    _current.set(active)
+    try:
+        yield active
+    except BaseException as e:
+        active.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.set(previous)
+        active.end()
+
+
+def request_context(request):
+    # Continues the trace Cloud Functions started for the request, if any
+    header = request.headers.get("X-Cloud-Trace-Context", "")
+    trace_id = header.split("/")[0]
+    if len(trace_id) == 32:
+        return (trace_id, None)
+    return None
+
+
+def traced(fn):
+    """Runs an entry point in a span named after it."""
+
+    @functools.wraps(fn)
+    def handle(request):
+        with span(
+            fn.__name__, parent=request_context(request), method=request.method
+        ) as root:
+            response = fn(request)
+            status = getattr(response, "status_code", None)
+            if status is None and isinstance(response, tuple):
+                status = response[1]
+            root.set(status=status)
+            return response
+
+    return handle
+
+
+def add_listener(listener):
+    # listener(span) is called with every finished span, e.g. by the benchmarks
+    _listeners.append(listener)
+
+
+def _emit(finished):
+    for listener in _listeners:
+        listener(finished)
+    if TRACE_LOG:
+        print(json.dumps(finished.to_dict(), default=str), flush=True)
+    if TRACE_EXPORTER == "otlp":
+        exporter = _get_exporter()
+        if exporter is not None:
+            exporter.export(finished)
+
+
+def _get_exporter():
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            try:
+                _exporter = OtlpExporter()
+            except ImportError as e:
+                print(
+                    "TRACE_EXPORTER=otlp needs opentelemetry-sdk and "
+                    f"opentelemetry-exporter-otlp-proto-http, not exporting: {e}"
+                )
+                _exporter = False
+        return _exporter or None
+
+
+class OtlpExporter:
+    """Re-creates finished spans with the OpenTelemetry SDK and exports them.
+
+    The OpenTelemetry spans keep the ids of ours, so the logged lines and the
+    exported trace match.
+    """
+
+    def __init__(self):
+        from opentelemetry import trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.trace.id_generator import IdGenerator
+
+        ids = self._ids = threading.local()
+
+        class SpanIds(IdGenerator):
+            def generate_span_id(self):
+                return ids.span_id
+
+            def generate_trace_id(self):
+                return ids.trace_id
+
+        self._trace = trace
+        self._provider = TracerProvider(
+            resource=Resource.create(
+                {"service.name": os.getenv("K_SERVICE", "document-indexing")}
+            ),
+            id_generator=SpanIds(),
+        )
+        self._provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self._tracer = self._provider.get_tracer(__name__)
+
+    def export(self, finished):
+        trace = self._trace
+        trace_id = int(finished.trace_id, 16)
+        self._ids.trace_id = trace_id
+        self._ids.span_id = int(finished.span_id, 16)
+        context = None
+        if finished.parent_id is not None:
+            parent = trace.SpanContext(
+                trace_id,
+                int(finished.parent_id, 16),
+                is_remote=True,
+                trace_flags=trace.TraceFlags(trace.TraceFlags.SAMPLED),
+            )
+            context = trace.set_span_in_context(trace.NonRecordingSpan(parent))
+
+        start_ns = int(finished.start_time * 1e9)
+        otel_span = self._tracer.start_span(
+            finished.name,
+            context=context,
+            start_time=start_ns,
+            attributes={
+                key: (
+                    value
+                    if isinstance(value, (str, bool, int, float))
+                    else json.dumps(value, default=str)
+                )
+                for key, value in finished.attributes.items()
+                if value is not None
+            },
+        )
+        if finished.error:
+            otel_span.set_status(trace.Status(trace.StatusCode.ERROR, finished.error))
+        otel_span.end(end_time=start_ns + int(finished.duration_ms * 1e6))
+
+        if finished.parent_id is None:
+            # The instance may be frozen after the response, send the request's spans now
+            self._provider.force_flush()